@@ -0,0 +1,211 @@
+"""
+Conversions between Arrow data and shapely geometries without per-row Python objects. The coordinates of the Arrow tables and of the
+GeoArrow arrays (the native geometry encoding of GeoParquet 1.1) are read from and written to the Arrow buffers as numpy arrays, and the
+geometries are built from them in bulk (`shapely.points`, `shapely.from_ragged_array`, `shapely.to_ragged_array`).
+
+GeoArrow layouts used here:
+    - "geoarrow.point": struct<x, y> (separated coordinates) or fixed_size_list<xy: double>[2] (interleaved coordinates)
+    - "geoarrow.multipolygon": list<polygons: list<rings: list<vertices: fixed_size_list<xy: double>[2]>>>
+"""
+import json
+from typing import Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import shapely
+
+EXTENSION_NAME = b"ARROW:extension:name"
+EXTENSION_METADATA = b"ARROW:extension:metadata"
+GEOARROW_POINT = "geoarrow.point"
+GEOARROW_MULTIPOLYGON = "geoarrow.multipolygon"
+
+_XY = pa.list_(pa.field("xy", pa.float64(), nullable=False), 2)
+MULTIPOLYGON_TYPE = pa.list_(
+    pa.field("polygons", pa.list_(pa.field("rings", pa.list_(pa.field("vertices", _XY, nullable=False)), nullable=False)), nullable=False)
+)
+
+
+def _single_chunk(array) -> pa.Array:
+    if isinstance(array, pa.ChunkedArray):
+        return array.chunk(0) if array.num_chunks == 1 else array.combine_chunks()
+    return array
+
+
+def _numpy(array) -> np.ndarray:
+    """
+    float64 numpy view of an Arrow numeric array, copied only when it has several chunks, nulls (turned into NaN) or another type
+    """
+    array = _single_chunk(array)
+    if array.null_count:
+        array = pc.fill_null(array.cast(pa.float64()), np.nan)
+    if array.type != pa.float64():
+        array = array.cast(pa.float64())
+    return array.to_numpy(zero_copy_only=True)
+
+
+def is_geoarrow_point(field: pa.Field) -> bool:
+    """
+    Whether an Arrow field holds GeoArrow points (from its extension name, or from its layout when the extension name is missing)
+    """
+    if field.metadata and field.metadata.get(EXTENSION_NAME) == GEOARROW_POINT.encode():
+        return True
+    if pa.types.is_struct(field.type):
+        return [child.name for child in field.type] == ["x", "y"]
+    return pa.types.is_fixed_size_list(field.type) and field.type.list_size == 2
+
+
+def point_coordinates(array) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The x and y coordinates of a GeoArrow point array (NaN for null points)
+    """
+    array = _single_chunk(array)
+    if pa.types.is_struct(array.type):
+        # `flatten` applies the offset of sliced arrays and the null points to the children
+        x, y = array.flatten()
+        return _numpy(x), _numpy(y)
+    coordinates = _numpy(array.values.slice(array.offset * 2, len(array) * 2)).reshape(-1, 2)
+    xs, ys = coordinates[:, 0], coordinates[:, 1]
+    if array.null_count:
+        null = array.is_null().to_numpy(zero_copy_only=False)
+        xs, ys = np.where(null, np.nan, xs), np.where(null, np.nan, ys)
+    return xs, ys
+
+
+def points_from_arrow(data, x: str = "longitude", y: str = "latitude") -> np.ndarray:
+    """
+    Build shapely Points from an Arrow table (coordinate columns `x` and `y`) or from a GeoArrow point array
+
+    Args:
+        data (pa.Table, pa.RecordBatch, pa.Array or pa.ChunkedArray):
+        x (str, optional): the column of the x coordinates of a table. Defaults to "longitude".
+        y (str, optional): the column of the y coordinates of a table. Defaults to "latitude".
+
+    Returns:
+        np.ndarray: the Points (None for null or NaN coordinates)
+    """
+    if isinstance(data, (pa.Table, pa.RecordBatch)):
+        xs, ys = _numpy(data.column(x)), _numpy(data.column(y))
+    else:
+        xs, ys = point_coordinates(data)
+    points = shapely.points(xs, ys)
+    points[np.isnan(xs) | np.isnan(ys)] = None
+    return points
+
+
+def arrow_to_frame(table: pa.Table, x: str = "longitude", y: str = "latitude") -> pd.DataFrame:
+    """
+    Convert an Arrow table of addresses to pandas without per-row Python objects: the strings are dictionary-encoded (categoricals), the
+    numeric columns are not copied when possible, and a GeoArrow point column is replaced by the coordinate columns `x` and `y`
+    """
+    columns = {}
+    for field, column in zip(table.schema, table.columns):
+        if is_geoarrow_point(field):
+            columns[x], columns[y] = point_coordinates(column)
+        elif pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            columns[field.name] = _single_chunk(pc.dictionary_encode(column)).to_pandas()
+        else:
+            columns[field.name] = _single_chunk(column).to_pandas()
+    return pd.DataFrame(columns)
+
+
+def geometries_to_arrow(geometries: np.ndarray, crs=None, name: str = "geometry") -> Tuple[pa.Array, pa.Field]:
+    """
+    Encode Polygon and MultiPolygon geometries as a "geoarrow.multipolygon" array, from the coordinate and offset arrays of
+    `shapely.to_ragged_array`. Missing and empty geometries are null
+
+    Args:
+        geometries (np.ndarray): shapely Polygons or MultiPolygons (or None)
+        crs (optional): stored in the metadata of the field. Defaults to None.
+        name (str, optional): name of the field. Defaults to "geometry".
+
+    Returns:
+        Tuple[pa.Array, pa.Field]: the array, and the field carrying the GeoArrow extension metadata
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    valid = ~shapely.is_missing(geometries)
+    valid[valid] = ~shapely.is_empty(geometries[valid])
+    assert np.isin(
+        shapely.get_type_id(geometries[valid]), [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON]
+    ).all(), "only Polygon and MultiPolygon geometries can be encoded as geoarrow.multipolygon"
+    counts = np.zeros(len(geometries), dtype=np.int32)
+    if valid.any():
+        geometry_type, coordinates, offsets = shapely.to_ragged_array(geometries[valid])
+        if geometry_type == shapely.GeometryType.POLYGON:
+            # each Polygon is a MultiPolygon with one part
+            ring_offsets, polygon_offsets = offsets
+            geometry_offsets = np.arange(len(polygon_offsets), dtype=np.int64)
+        else:
+            ring_offsets, polygon_offsets, geometry_offsets = offsets
+        counts[valid] = np.diff(geometry_offsets)
+    else:
+        coordinates = np.empty((0, 2))
+        ring_offsets, polygon_offsets = np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    vertices = pa.FixedSizeListArray.from_arrays(pa.array(coordinates[:, :2].ravel(), type=pa.float64()), 2)
+    rings = pa.ListArray.from_arrays(pa.array(ring_offsets, type=pa.int32()), vertices)
+    polygons = pa.ListArray.from_arrays(pa.array(polygon_offsets, type=pa.int32()), rings)
+    array = pa.ListArray.from_arrays(
+        pa.array(np.concatenate([[0], np.cumsum(counts)]), type=pa.int32()),
+        polygons,
+        mask=pa.array(~valid),
+    ).cast(MULTIPOLYGON_TYPE)
+    metadata = {
+        EXTENSION_NAME: GEOARROW_MULTIPOLYGON.encode(),
+        EXTENSION_METADATA: json.dumps({} if crs is None else {"crs": gpd.GeoSeries([], crs=crs).crs.to_json_dict()}).encode(),
+    }
+    return array, pa.field(name, array.type, metadata=metadata)
+
+
+def geometries_from_arrow(array) -> np.ndarray:
+    """
+    Decode a geometry array: WKB, GeoArrow points, polygons or multipolygons (null and empty entries are None)
+
+    Args:
+        array (pa.Array or pa.ChunkedArray):
+
+    Returns:
+        np.ndarray: shapely geometries
+    """
+    array = _single_chunk(array)
+    if pa.types.is_binary(array.type) or pa.types.is_large_binary(array.type):
+        return shapely.from_wkb(array.to_numpy(zero_copy_only=False))
+    if pa.types.is_struct(array.type) or pa.types.is_fixed_size_list(array.type):
+        return points_from_arrow(array)
+    # depth of the nested lists: 2 for polygons (rings, vertices), 3 for multipolygons (polygons, rings, vertices)
+    depth, value_type = 0, array.type
+    while pa.types.is_list(value_type) or pa.types.is_large_list(value_type):
+        depth, value_type = depth + 1, value_type.value_type
+    geometries = np.full(len(array), None, dtype=object)
+    # the null and empty entries are left out (GEOS does not build empty parts)
+    valid = (pc.fill_null(pc.list_value_length(array), 0).to_numpy(zero_copy_only=False) > 0)
+    if not valid.any():
+        return geometries
+    levels = [array.filter(pa.array(valid))]
+    while len(levels) < depth:
+        levels.append(levels[-1].flatten())
+    coordinates = _numpy(levels[-1].flatten().flatten()).reshape(-1, 2)
+    # offsets of each level, starting at 0 (the levels come from `filter` and `flatten`)
+    offsets = [(level.offsets.to_numpy() - level.offsets[0].as_py()) for level in reversed(levels)]
+    geometry_type = shapely.GeometryType.MULTIPOLYGON if depth == 3 else shapely.GeometryType.POLYGON
+    geometries[valid] = shapely.from_ragged_array(geometry_type, coordinates, tuple(offsets))
+    return geometries
+
+
+def contours_to_arrow(gdf: gpd.GeoDataFrame) -> pa.Table:
+    """
+    Arrow table of contours: the attributes, and the geometry as "geoarrow.multipolygon"
+    """
+    table = pa.Table.from_pandas(pd.DataFrame(gdf.drop(columns=gdf.geometry.name)), preserve_index=False)
+    array, field = geometries_to_arrow(gdf.geometry.to_numpy(), crs=gdf.crs)
+    return table.append_column(field, array)
+
+
+def contours_from_arrow(table: pa.Table, geometry: str = "geometry", crs=None) -> gpd.GeoDataFrame:
+    """
+    GeoDataFrame of a table of contours, whatever the encoding of the geometry column (see `geometries_from_arrow`)
+    """
+    return gpd.GeoDataFrame(
+        table.drop([geometry]).to_pandas(), geometry=geometries_from_arrow(table.column(geometry)), crs=crs
+    )
@@ -0,0 +1,244 @@
+"""
+Quality audit of the generated contours: in every commune, the contours of the bureaux de vote should tile the commune polygon, without
+gaps nor overlaps, each bureau being made of few connected components. The contours are matched to the communes with a spatial index,
+and the measures are computed with bulk set operations, the communes being processed in parallel.
+
+Usage:
+    python audit.py geojson/ --communes ../communes-5m.geojson --report audit_report.csv
+"""
+import argparse
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from commune_store import CommuneStore, write_commune_store
+from contour_io import read_contours
+from geo import _area_m2
+from merge_departements import departement_files
+
+AUDIT_COLUMNS = [
+    "departement",
+    "insee",
+    "n_bureaux",
+    "commune_area_m2",
+    "uncovered_m2",
+    "uncovered_ratio",
+    "overlap_m2",
+    "outside_m2",
+    "n_gaps",
+    "n_slivers",
+    "n_fragmented_bureaux",
+    "max_components",
+]
+
+
+def _total_area_m2(*geometries: shapely.Geometry) -> float:
+    """
+    Total area in square meters of geometries in longitude/latitude, empty geometries included
+    """
+    geometries = np.array(geometries, dtype=object)
+    geometries = geometries[~shapely.is_empty(geometries)]
+    return float(_area_m2(geometries).sum()) if len(geometries) else 0.0
+
+
+def match_communes(contours: gpd.GeoDataFrame, communes: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    Find the commune of each contour: the commune containing a point inside the contour, or else the nearest commune
+
+    Args:
+        contours (gpd.GeoDataFrame):
+        communes (gpd.GeoDataFrame): with column "insee"
+
+    Returns:
+        np.ndarray: the "insee" code of the commune of each contour
+    """
+    points = shapely.point_on_surface(shapely.make_valid(contours.geometry.to_numpy()))
+    tree = shapely.STRtree(communes.geometry.to_numpy())
+    matched = np.full(len(points), -1, dtype=np.int64)
+    point_idx, commune_idx = tree.query(points, predicate="within")
+    matched[point_idx] = commune_idx
+    missing = np.flatnonzero(matched < 0)
+    if len(missing):
+        point_idx, commune_idx = tree.query_nearest(points[missing])
+        _, first = np.unique(point_idx, return_index=True)
+        matched[missing[point_idx[first]]] = commune_idx[first]
+    return communes["insee"].to_numpy()[matched]
+
+
+def audit_commune(
+    insee: str,
+    commune: shapely.Geometry,
+    contours: np.ndarray,
+    min_area: float = 1,
+    sliver_area: float = 100,
+    max_components: int = 3,
+) -> dict:
+    """
+    Measure how well the contours of the bureaux of a commune tile the commune polygon
+
+    Args:
+        insee (str): the code of the commune
+        commune (shapely.Geometry): the commune polygon
+        contours (np.ndarray): the contours of the bureaux of the commune, one (Multi)Polygon per bureau
+        min_area (float, optional): gaps below this area (in square meters) are ignored. Defaults to 1.
+        sliver_area (float, optional): components of a bureau below this area (in square meters) are counted as slivers. Defaults to 100.
+        max_components (int, optional): bureaux with more connected components are counted as fragmented. Defaults to 3.
+
+    Returns:
+        dict: one row of the report (see `AUDIT_COLUMNS`)
+    """
+    commune = shapely.make_valid(commune)
+    commune_area = _total_area_m2(commune)
+    contours = shapely.make_valid(contours)
+    union = shapely.union_all(contours) if len(contours) else shapely.Polygon()
+    uncovered = shapely.get_parts(shapely.difference(commune, union))
+    uncovered_areas = np.array([_total_area_m2(part) for part in uncovered])
+    parts, part_contour = shapely.get_parts(contours, return_index=True)
+    polygonal = (shapely.get_type_id(parts) == 3) & ~shapely.is_empty(parts)
+    parts, part_contour = parts[polygonal], part_contour[polygonal]
+    part_areas = _area_m2(parts) if len(parts) else np.array([])
+    components = np.bincount(part_contour, minlength=len(contours))
+    return {
+        "insee": insee,
+        "n_bureaux": len(contours),
+        "commune_area_m2": commune_area,
+        "uncovered_m2": uncovered_areas.sum(),
+        "uncovered_ratio": uncovered_areas.sum() / commune_area if commune_area else np.nan,
+        # the area covered by several bureaux
+        "overlap_m2": max(part_areas.sum() - _total_area_m2(union), 0.0),
+        "outside_m2": _total_area_m2(shapely.difference(union, commune)),
+        "n_gaps": int((uncovered_areas > min_area).sum()),
+        "n_slivers": int((part_areas < sliver_area).sum()),
+        "n_fragmented_bureaux": int((components > max_components).sum()),
+        "max_components": int(components.max()) if len(components) else 0,
+    }
+
+
+def _audit_communes(tasks: List[tuple], store: CommuneStore = None) -> List[dict]:
+    if store is not None:
+        # the shapes of the communes are read from the memory-mapped store instead of being sent with the tasks
+        communes = store.geometries([task[0] for task in tasks])
+        tasks = [(task[0], commune, *task[2:]) for task, commune in zip(tasks, communes)]
+    return [audit_commune(*task) for task in tasks]
+
+
+def audit_departement(
+    contours: gpd.GeoDataFrame,
+    communes: gpd.GeoDataFrame,
+    min_area: float = 1,
+    sliver_area: float = 100,
+    max_components: int = 3,
+    workers: int = None,
+    chunk_size: int = 50,
+    store: CommuneStore = None,
+) -> pd.DataFrame:
+    """
+    Audit the contours of a département, commune by commune (see `audit_commune` for the thresholds)
+
+    Args:
+        contours (gpd.GeoDataFrame): the contours of the bureaux of the département
+        communes (gpd.GeoDataFrame): the communes of the département, with column "insee"
+        workers (int, optional): number of processes. Defaults to None (the number of CPUs), 1 to run in the current process.
+        chunk_size (int, optional): number of communes sent at once to a process. Defaults to 50.
+        store (CommuneStore, optional): when given, the processes read the shapes of the communes from this store instead of receiving them. Defaults to None.
+
+    Returns:
+        pd.DataFrame: one row per commune
+    """
+    contours = contours[contours.geometry.notna() & ~contours.geometry.is_empty]
+    geometries = contours.geometry.to_numpy()
+    positions = pd.Series(np.arange(len(geometries))).groupby(match_communes(contours, communes)).indices
+    tasks = [
+        (
+            insee,
+            None if store is not None else commune,
+            geometries[positions.get(insee, [])],
+            min_area,
+            sliver_area,
+            max_components,
+        )
+        for insee, commune in zip(communes["insee"], communes.geometry)
+    ]
+    chunks = [tasks[start:start + chunk_size] for start in range(0, len(tasks), chunk_size)]
+    if workers == 1:
+        rows = [row for chunk in chunks for row in _audit_communes(chunk, store)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rows = [
+                row for result in executor.map(_audit_communes, chunks, [store] * len(chunks)) for row in result
+            ]
+    return pd.DataFrame(rows, columns=AUDIT_COLUMNS[1:])
+
+
+def audit_contours(
+    directory: str = "geojson/",
+    communes_path: str = "./../communes-5m.geojson",
+    report: str = None,
+    departements: List[str] = None,
+    **kwargs,
+) -> pd.DataFrame:
+    """
+    Audit the contour files of a directory (`voronoi_contours_{DEP}`, produced by `generate_areas_geojson.py`)
+
+    Args:
+        directory (str, optional): Defaults to "geojson/".
+        communes_path (str, optional): the shapes of the communes, or a store written by `commune_store.write_commune_store` (".store"). Defaults to "./../communes-5m.geojson".
+        report (str, optional): path of a CSV file where the report is written. Defaults to None.
+        departements (List[str], optional): only audit these départements. Defaults to None (all of them).
+        kwargs: passed to `audit_departement`
+
+    Returns:
+        pd.DataFrame: one row per commune (see `AUDIT_COLUMNS`)
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if os.path.splitext(communes_path)[1] == ".store":
+            store = CommuneStore(communes_path)
+        else:
+            communes_france = gpd.read_file(communes_path).rename({"code": "insee"}, axis=1)[["insee", "geometry"]]
+            store = CommuneStore(write_commune_store(communes_france, os.path.join(tmp_dir, "communes.store")))
+            del communes_france
+        reports = []
+        for dep, path in departement_files(directory):
+            if departements is not None and dep not in departements:
+                continue
+            audit = audit_departement(read_contours(path), store.departement(dep), store=store, **kwargs)
+            audit.insert(0, "departement", dep)
+            reports.append(audit)
+            print(
+                f"### {dep}: {len(audit)} communes, {(audit['n_gaps'] > 0).sum()} with gaps, "
+                f"{(audit['overlap_m2'] > kwargs.get('min_area', 1)).sum()} with overlaps, "
+                f"{audit['n_fragmented_bureaux'].sum()} fragmented bureaux"
+            )
+    audit = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame(columns=AUDIT_COLUMNS)
+    if report is not None:
+        audit.to_csv(report, index=False)
+    return audit
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the contours of the bureaux tile their commune")
+    parser.add_argument("directory", nargs="?", default="geojson/")
+    parser.add_argument("--communes", default="./../communes-5m.geojson")
+    parser.add_argument("--report", default="audit_report.csv")
+    parser.add_argument("--departements", nargs="*", default=None)
+    parser.add_argument("--min-area", type=float, default=1, help="gaps below this area (m2) are ignored")
+    parser.add_argument("--sliver-area", type=float, default=100, help="components below this area (m2) are slivers")
+    parser.add_argument("--max-components", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    audit_contours(
+        args.directory,
+        args.communes,
+        args.report,
+        args.departements,
+        min_area=args.min_area,
+        sliver_area=args.sliver_area,
+        max_components=args.max_components,
+        workers=args.workers,
+    )
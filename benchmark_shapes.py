@@ -0,0 +1,126 @@
+"""
+Benchmark of the ways of drawing the bureaux de vote around their addresses on a whole département: convex hulls, concave hulls
+(`geo.concave_hull`, the fast preview), Voronoi cells approximated on a grid (`raster_preview`) and clipped Voronoi cells
+(`geo.get_clipped_voronoi_shapes`, the published contours).
+For each mode, the script reports the wall time (best of `--repeat` runs, building the input geometries included), the number of shapes
+and of vertices, the share of the communes covered by the shapes and the area where shapes overlap.
+
+Usage:
+    python benchmark_shapes.py 09 --communes ../communes-5m.geojson --report benchmark_shapes_09.csv
+"""
+import argparse
+import time
+from typing import Callable, Dict, List
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from audit import _total_area_m2
+from geo import (
+    build_geojson_multipoint,
+    build_geojson_point,
+    concave_hull,
+    convex_hull,
+    get_clipped_voronoi_shapes,
+)
+from loader import read_addresses
+from raster_preview import raster_preview_shapes
+
+MODES = ["convex", "concave", "raster", "voronoi"]
+
+
+def _convex_shapes(addresses: pd.DataFrame, communes: gpd.GeoDataFrame) -> gpd.GeoSeries:
+    return convex_hull(build_geojson_multipoint(addresses))
+
+
+def _concave_shapes(addresses: pd.DataFrame, communes: gpd.GeoDataFrame) -> gpd.GeoSeries:
+    return concave_hull(build_geojson_point(addresses), communes).geometry
+
+
+def _raster_shapes(addresses: pd.DataFrame, communes: gpd.GeoDataFrame) -> gpd.GeoSeries:
+    return raster_preview_shapes(build_geojson_point(addresses), communes).geometry
+
+
+def _voronoi_shapes(addresses: pd.DataFrame, communes: gpd.GeoDataFrame) -> gpd.GeoSeries:
+    return get_clipped_voronoi_shapes(build_geojson_point(addresses), communes).geometry
+
+
+SHAPE_FUNCTIONS: Dict[str, Callable[[pd.DataFrame, gpd.GeoDataFrame], gpd.GeoSeries]] = {
+    "convex": _convex_shapes,
+    "concave": _concave_shapes,
+    "raster": _raster_shapes,
+    "voronoi": _voronoi_shapes,
+}
+
+
+def benchmark_modes(
+    addresses: pd.DataFrame, communes: gpd.GeoDataFrame, modes: List[str] = MODES, repeat: int = 1
+) -> pd.DataFrame:
+    """
+    Time the computation of the shapes of the bureaux de vote with each mode, and measure the shapes
+
+    Args:
+        addresses (pd.DataFrame): the cleaned addresses of a département, with columns "id_bv", "result_citycode", "longitude" and "latitude"
+        communes (gpd.GeoDataFrame): the shapes of the communes of the département, with column "insee"
+        modes (List[str], optional): subset of MODES. Defaults to MODES.
+        repeat (int, optional): number of runs per mode, the best time is kept. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: one row per mode
+    """
+    communes_union = shapely.union_all(shapely.make_valid(communes.geometry.values))
+    communes_area = _total_area_m2(communes_union)
+    rows = []
+    for mode in modes:
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            shapes = SHAPE_FUNCTIONS[mode](addresses, communes)
+            seconds.append(time.perf_counter() - start)
+        geometries = shapely.make_valid(shapes.values[~shapes.isna().to_numpy()])
+        geometries = geometries[shapely.get_dimensions(geometries) == 2]
+        union = shapely.union_all(geometries)
+        overlap = _total_area_m2(*geometries) - _total_area_m2(union)
+        rows.append(
+            {
+                "mode": mode,
+                "seconds": min(seconds),
+                "n_shapes": len(geometries),
+                "n_vertices": int(shapely.get_num_coordinates(geometries).sum()),
+                "covered_ratio": _total_area_m2(shapely.intersection(union, communes_union)) / communes_area
+                if communes_area
+                else 0.0,
+                "overlap_m2": max(overlap, 0.0),
+            }
+        )
+        print(f"### {mode}: {min(seconds):.2f}s, {len(geometries)} shapes")
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the convex, concave, raster and voronoi shapes of the bureaux de vote")
+    parser.add_argument("departement")
+    parser.add_argument("--addresses", default=None, help="defaults to parquet/table_{DEP}.parquet")
+    parser.add_argument("--communes", default="./../communes-5m.geojson")
+    parser.add_argument("--modes", nargs="*", default=MODES, choices=MODES)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--report", default=None, help="CSV file of the results")
+    args = parser.parse_args()
+
+    DEP = args.departement
+    addresses_df = read_addresses(
+        args.addresses or f"parquet/table_{DEP}.parquet",
+        columns=["id_brut_bv", "code_commune_ref", "longitude", "latitude"],
+    )
+    addresses_df["id_bv"] = addresses_df["id_brut_bv"]
+    addresses_df["commune_bv"] = addresses_df["code_commune_ref"]
+    addresses_df["result_citycode"] = addresses_df["code_commune_ref"]
+    communes_france = gpd.read_file(args.communes)
+    communes_france = communes_france.rename({"code": "insee"}, axis=1)[["insee", "geometry"]]
+    communes_dep = communes_france[communes_france.insee.str.startswith(str(DEP))]
+
+    results = benchmark_modes(addresses_df, communes_dep, modes=args.modes, repeat=args.repeat)
+    print(results.to_string(index=False))
+    if args.report:
+        results.to_csv(args.report, index=False)
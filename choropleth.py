@@ -0,0 +1,257 @@
+"""
+Choropleth maps of election results per bureau de vote, drawn on the contours already computed (the outputs of `generate_areas_geojson.py`
+or `merge_departements.py`), without computing any geometry again. The results table (one row per bureau, one numeric column per result,
+e.g. the share of a candidate at several elections) is joined by position on "id_bv" to the contours, and all the maps are prepared in
+one batch: the contours are (optionally simplified and) turned into coordinate arrays once, and each result only adds its values and a
+precomputed colour per bureau.
+
+Outputs:
+    - a choropleth layer: the contours with, for each result, its values and its colours packed as 0xRRGGBB integers, written
+    in any format of `contour_io` (e.g. GeoParquet, where the geometry is stored once for all the results)
+    - one HTML map per result (pydeck)
+
+Usage:
+    python choropleth.py geojson/voronoi_contours_france.parquet resultats.csv --columns abstention_2022 abstention_2024 --output-dir maps/
+"""
+import argparse
+import os
+from typing import Dict, List, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pydeck as pdk
+import shapely
+
+from contour_io import open_contour_writer, read_contours
+from topology import simplification_levels
+
+# colour stops of the ramps, from the lowest to the highest value
+RAMPS = {
+    "sequential": [(255, 255, 204), (161, 218, 180), (65, 182, 196), (44, 127, 184), (37, 52, 148)],
+    "diverging": [(202, 0, 32), (244, 165, 130), (247, 247, 247), (146, 197, 222), (5, 113, 176)],
+}
+# colour of the bureaux without result
+MISSING_COLOR = (200, 200, 200)
+# the ends of the ramps are the values at these percentiles, so that a few extreme bureaux do not flatten the map
+RAMP_PERCENTILES = (2, 98)
+
+
+def join_results(
+    contours: gpd.GeoDataFrame, results: pd.DataFrame, columns: List[str] = None, id_column: str = "id_bv"
+) -> pd.DataFrame:
+    """
+    Align the results of the bureaux on the rows of the contours (a bureau can have several rows)
+
+    Args:
+        contours (gpd.GeoDataFrame): with column `id_column`
+        results (pd.DataFrame): one row per bureau, with column `id_column`
+        columns (List[str], optional): the columns of `results` to join. Defaults to None (all of them).
+        id_column (str, optional): Defaults to "id_bv".
+
+    Returns:
+        pd.DataFrame: the columns of the results, one row per contour (NaN for the bureaux without result), with the index of `contours`
+    """
+    results = results.drop_duplicates(id_column)
+    columns = columns or [column for column in results.columns if column != id_column]
+    # the ids are compared as strings, whatever the formats of both files
+    positions = pd.Index(results[id_column].astype(str)).get_indexer(contours[id_column].astype(str))
+    found = positions >= 0
+    joined = {}
+    for column in columns:
+        values = results[column].to_numpy(dtype=float)
+        joined[column] = np.where(found, values[np.maximum(positions, 0)], np.nan)
+    return pd.DataFrame(joined, index=contours.index)
+
+
+def color_ramp(values: np.ndarray, ramp: str = "sequential", vmin: float = None, vmax: float = None) -> np.ndarray:
+    """
+    Colours of values along a ramp of RAMPS (linear interpolation between its stops)
+
+    Args:
+        values (np.ndarray): NaN for missing values, coloured with MISSING_COLOR
+        ramp (str, optional): a key of RAMPS. Defaults to "sequential".
+        vmin (float, optional): the value of the first colour. Defaults to None (the percentile RAMP_PERCENTILES[0] of the values; for a diverging ramp, the opposite of the largest absolute bound).
+        vmax (float, optional): the value of the last colour. Defaults to None (the percentile RAMP_PERCENTILES[1] of the values).
+
+    Returns:
+        np.ndarray: (n, 3) uint8 RGB colours
+    """
+    values = np.asarray(values, dtype=float)
+    known = ~np.isnan(values)
+    colors = np.tile(np.array(MISSING_COLOR, dtype=np.uint8), (len(values), 1))
+    if not known.any():
+        return colors
+    low, high = np.percentile(values[known], RAMP_PERCENTILES)
+    if ramp == "diverging":
+        # the middle colour is 0
+        bound = max(abs(low), abs(high))
+        low, high = -bound, bound
+    vmin = low if vmin is None else vmin
+    vmax = high if vmax is None else vmax
+    stops = np.array(RAMPS[ramp], dtype=float)
+    positions = np.clip((values[known] - vmin) / (vmax - vmin) if vmax > vmin else 0.5, 0, 1) * (len(stops) - 1)
+    for channel in range(3):
+        colors[known, channel] = np.rint(np.interp(positions, np.arange(len(stops)), stops[:, channel]))
+    return colors
+
+
+def pack_colors(colors: np.ndarray) -> np.ndarray:
+    """
+    RGB colours (n, 3) as 0xRRGGBB integers
+    """
+    colors = colors.astype(np.uint32)
+    return (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+
+
+def unpack_colors(packed: np.ndarray) -> np.ndarray:
+    """
+    0xRRGGBB integers as RGB colours (n, 3)
+    """
+    packed = np.asarray(packed, dtype=np.uint32)
+    return np.column_stack([(packed >> 16) & 255, (packed >> 8) & 255, packed & 255]).astype(np.uint8)
+
+
+def choropleth_table(
+    contours: gpd.GeoDataFrame,
+    results: pd.DataFrame,
+    columns: List[str],
+    ramps: Dict[str, str] = None,
+    id_column: str = "id_bv",
+    detail_zoom: int = None,
+) -> gpd.GeoDataFrame:
+    """
+    Join the results to the contours and colour each result
+
+    Args:
+        contours (gpd.GeoDataFrame): the contours of the bureaux, in longitude/latitude, with column `id_column`
+        results (pd.DataFrame): one row per bureau, with column `id_column` and the numeric columns `columns`
+        columns (List[str]): the results to map
+        ramps (Dict[str, str], optional): the ramp of each column (see RAMPS). Defaults to None ("sequential" for every column).
+        id_column (str, optional): Defaults to "id_bv".
+        detail_zoom (int, optional): the contours are simplified for this zoom level, neighbouring bureaux keeping a common border (see `topology.simplification_levels`; the bureaux smaller than a pixel are dropped). Defaults to None (the full resolution).
+
+    Returns:
+        gpd.GeoDataFrame: one row per contour, with columns `id_column`, each column of `columns`, its colour "{column}_color" (0xRRGGBB) and "geometry"
+    """
+    ramps = ramps or {}
+    contours = contours[contours.geometry.notna() & ~contours.geometry.is_empty].reset_index(drop=True)
+    table = contours[[id_column, contours.geometry.name]]
+    if detail_zoom is not None and len(table):
+        table = simplification_levels(table, [detail_zoom])[detail_zoom]
+    joined = join_results(table, results, columns, id_column=id_column)
+    data = {id_column: table[id_column].to_numpy()}
+    for column in columns:
+        data[column] = joined[column].to_numpy()
+        data[f"{column}_color"] = pack_colors(color_ramp(data[column], ramps.get(column, "sequential")))
+    return gpd.GeoDataFrame(data, geometry=table.geometry.to_numpy(), crs=contours.crs)
+
+
+def polygon_coordinates(geometries: np.ndarray) -> Tuple[list, np.ndarray]:
+    """
+    Coordinates of the exterior rings of the polygons, as expected by pydeck, computed in bulk
+
+    Returns:
+        Tuple[list, np.ndarray]: the coordinates of each polygon (the parts of the MultiPolygons are separate polygons), and the position of the geometry of each polygon
+    """
+    parts, index = shapely.get_parts(geometries, return_index=True)
+    polygonal = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    parts, index = parts[polygonal], index[polygonal]
+    coordinates, ring_index = shapely.get_coordinates(shapely.get_exterior_ring(parts), return_index=True)
+    rings = np.split(coordinates, np.flatnonzero(np.diff(ring_index)) + 1) if len(coordinates) else []
+    return [[ring.tolist()] for ring in rings], index
+
+
+def prepare_layer_choropleth(coordinates: list, colors: np.ndarray, data: Dict[str, np.ndarray] = None) -> pdk.Layer:
+    """
+    Get a layer with polygons filled with precomputed colours
+
+    Args:
+        coordinates (list): the coordinates of the polygons (see `polygon_coordinates`)
+        colors (np.ndarray): (n, 3) RGB colour of each polygon
+        data (Dict[str, np.ndarray], optional): columns shown in the tooltip, one value per polygon. Defaults to None.
+
+    Returns:
+        pdk.Layer: a pydeck Layer with the coloured polygons
+    """
+    displayed = pd.DataFrame(data or {})
+    displayed["coordinates"] = coordinates
+    displayed["color_r"], displayed["color_g"], displayed["color_b"] = colors[:, 0], colors[:, 1], colors[:, 2]
+    return pdk.Layer(
+        "PolygonLayer",
+        displayed,
+        pickable=True,
+        opacity=0.7,
+        stroked=True,
+        filled=True,
+        line_width_min_pixels=0,
+        get_polygon="coordinates",
+        get_fill_color=["color_r", "color_g", "color_b"],
+        get_line_color=[255, 255, 255],
+    )
+
+
+def export_choropleth_maps(
+    table: gpd.GeoDataFrame, columns: List[str], output_dir: str, id_column: str = "id_bv"
+) -> List[str]:
+    """
+    Write one HTML map per result of a choropleth table (see `choropleth_table`), the coordinates being computed once for all the maps
+
+    Returns:
+        List[str]: the paths of the maps
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    coordinates, index = polygon_coordinates(table.geometry.to_numpy())
+    xmin, ymin, xmax, ymax = table.total_bounds
+    view_state = pdk.ViewState(latitude=(ymin + ymax) / 2, longitude=(xmin + xmax) / 2, zoom=6, bearing=0, pitch=0)
+    paths = []
+    for column in columns:
+        layer = prepare_layer_choropleth(
+            coordinates,
+            unpack_colors(table[f"{column}_color"].to_numpy()[index]),
+            {id_column: table[id_column].to_numpy()[index], column: np.round(table[column].to_numpy()[index], 4)},
+        )
+        path = os.path.join(output_dir, f"{column}.html")
+        pdk.Deck(
+            map_style="light",
+            layers=[layer],
+            initial_view_state=view_state,
+            tooltip={"text": f"{id_column}: {{{id_column}}} \n{column}: {{{column}}}"},
+        ).to_html(path, open_browser=False)
+        paths.append(path)
+        print(f"### {path}")
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map results per bureau de vote on precomputed contours")
+    parser.add_argument("contours", help="the contours of the bureaux, e.g. voronoi_contours_france.parquet")
+    parser.add_argument("results", help="CSV or parquet table with one row per bureau")
+    parser.add_argument("--columns", nargs="*", default=None, help="the results to map. Defaults to every column but the id")
+    parser.add_argument("--diverging", nargs="*", default=[], help="the columns coloured with the diverging ramp (centered on 0)")
+    parser.add_argument("--id-column", default="id_bv")
+    parser.add_argument("--output-dir", default="maps/")
+    parser.add_argument("--layer", default=None, help="file of the choropleth layer (any format of contour_io). Defaults to choropleth.parquet in the output directory")
+    parser.add_argument("--no-html", action="store_true", help="only write the choropleth layer")
+    parser.add_argument("--detail-zoom", type=int, default=None, help="simplify the contours for this zoom level (e.g. 12). Defaults to the full resolution")
+    args = parser.parse_args()
+
+    contours_gdf = read_contours(args.contours)
+    if args.results.endswith(".parquet"):
+        results_df = pd.read_parquet(args.results)
+    else:
+        results_df = pd.read_csv(args.results, dtype={args.id_column: str})
+    result_columns = args.columns or [column for column in results_df.columns if column != args.id_column]
+    choropleth = choropleth_table(
+        contours_gdf,
+        results_df,
+        result_columns,
+        ramps={column: "diverging" for column in args.diverging},
+        id_column=args.id_column,
+        detail_zoom=args.detail_zoom,
+    )
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open_contour_writer(args.layer or os.path.join(args.output_dir, "choropleth.parquet")) as writer:
+        writer.write(choropleth)
+    if not args.no_html:
+        export_choropleth_maps(choropleth, result_columns, args.output_dir, id_column=args.id_column)
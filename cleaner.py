@@ -4,8 +4,12 @@ that have been previously geocoded with the "geo" module.
 """
 
 import pandas as pd
+import numpy as np
+import geopandas as gpd
+import shapely
 from difflib import SequenceMatcher
-import re
+from typing import List
+from loader import compact_addresses, compact_id_bv
     
     
 def clean_dataset(df: pd.DataFrame) -> pd.DataFrame:
@@ -114,28 +118,110 @@ def remove_names(x: str) -> str:
 
 def clean_geocoded_types(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Clean some dtypes of the dataframe after the geocoding step
+    Clean some dtypes of the dataframe after the geocoding step (see `loader.compact_addresses`). The columns are converted in place
 
     Args:
-        df (pd.DataFrame): _description_
+        df (pd.DataFrame): a dataframe where geocoding has already been performed with API-adresse
+
+    Returns:
+        pd.DataFrame: the geocoded rows, with coordinates and scores as floats and codes as categoricals
+    """
+    geocoded_df = compact_addresses(df)
+    return geocoded_df.take(np.flatnonzero(geocoded_df["result_label"].notna()))
+
+
+def _equal_codes(a: pd.Series, b: pd.Series) -> pd.Series:
+    """
+    Compare element-wise two columns of codes, which may be categoricals with different categories
+    """
+    if isinstance(a.dtype, pd.CategoricalDtype) and isinstance(b.dtype, pd.CategoricalDtype):
+        categories = a.cat.categories.union(b.cat.categories)
+        return a.cat.set_categories(categories) == b.cat.set_categories(categories)
+    if isinstance(a.dtype, pd.CategoricalDtype):
+        a = a.astype(object)
+    if isinstance(b.dtype, pd.CategoricalDtype):
+        b = b.astype(object)
+    return a == b
+
+
+def flag_outside_communes(
+    df: pd.DataFrame, communes: gpd.GeoDataFrame, code_column: str = "result_citycode"
+) -> np.ndarray:
+    """
+    Find the geocoded points that are not inside the shape of their declared commune, with one bulk query of all the points against a spatial index of the communes.
+    Points whose commune has no shape in `communes` are not flagged
+
+    Args:
+        df (pd.DataFrame): must include columns "longitude", "latitude" and `code_column`
+        communes (gpd.GeoDataFrame): the shapes of communes (same coordinates system as the addresses), with column "result_citycode" or "insee"
+        code_column (str, optional): the column with the declared commune of each address. Defaults to "result_citycode".
+
+    Returns:
+        np.ndarray: booleans, True for the points outside their declared commune
+    """
+    if "result_citycode" in communes.columns:
+        commune_codes = communes["result_citycode"].astype(str).to_numpy()
+    else:
+        commune_codes = communes["insee"].astype(str).to_numpy()
+    declared = df[code_column].astype(str).to_numpy()
+    points = shapely.points(df["longitude"].to_numpy(dtype=float), df["latitude"].to_numpy(dtype=float))
+    # pairs (point, commune) such that the point is inside (or on the border of) the commune
+    point_idx, commune_idx = shapely.STRtree(communes.geometry.to_numpy()).query(
+        points, predicate="intersects"
+    )
+    inside = np.zeros(len(df), dtype=bool)
+    inside[point_idx[commune_codes[commune_idx] == declared[point_idx]]] = True
+    return ~inside & np.isin(declared, commune_codes)
+
+
+def flag_distance_outliers(
+    df: pd.DataFrame,
+    group_columns: List[str],
+    max_distance_ratio: float = 10,
+    min_distance: float = 1000,
+) -> np.ndarray:
+    """
+    Find the points that are extremely far from the other points of their bureau de vote: the distance to the (median) centre of the bureau
+    is above `max_distance_ratio` times the median distance in this bureau, and above `min_distance`
+
+    Args:
+        df (pd.DataFrame): must include columns "longitude", "latitude" and `group_columns`
+        group_columns (List[str]): the columns identifying a bureau de vote (e.g. ["id_bv"])
+        max_distance_ratio (float, optional): Defaults to 10.
+        min_distance (float, optional): in meters. Defaults to 1000.
 
     Returns:
-        pd.DataFrame: _description_
+        np.ndarray: booleans, True for the outliers
     """
-    geocoded_df = df.copy()
-    geocoded_df["latitude"] = geocoded_df["latitude"].astype(float)
-    geocoded_df["longitude"] = geocoded_df["longitude"].astype(float)
-    geocoded_df["result_score"] = geocoded_df["result_score"].astype(float)
-    geocoded_df = geocoded_df[geocoded_df["result_label"].notna()]
-    return geocoded_df
+    groups = df.groupby(group_columns, observed=True, sort=False)
+    lon_center = groups["longitude"].transform("median").to_numpy(dtype=float)
+    lat_center = groups["latitude"].transform("median").to_numpy(dtype=float)
+    # equirectangular approximation of distances, precise enough at the scale of a commune
+    dx = (df["longitude"].to_numpy(dtype=float) - lon_center) * np.cos(np.radians(lat_center)) * 111320
+    dy = (df["latitude"].to_numpy(dtype=float) - lat_center) * 110540
+    distance = pd.Series(np.hypot(dx, dy), index=df.index)
+    median_distance = distance.groupby([df[col] for col in group_columns], observed=True, sort=False).transform("median")
+    threshold = np.maximum(max_distance_ratio * median_distance.to_numpy(), min_distance)
+    return distance.to_numpy() > threshold
 
 
-def clean_failed_geocoding(df: pd.DataFrame) -> pd.DataFrame:
+def clean_failed_geocoding(
+    df: pd.DataFrame,
+    communes: gpd.GeoDataFrame = None,
+    max_distance_ratio: float = None,
+    min_outlier_distance: float = 1000,
+    flag_only: bool = False,
+) -> pd.DataFrame:
     """
     Remove both failed geocoding (geocoding score below a threshold) + also remove lines where the voter does not inhabit in the same code commune + also remove lines where the geocoding is not consistent with the postcode indicated in the INSEE file
+    Optionally, also remove the points located outside the shape of their commune (see `flag_outside_communes`) and the points extremely far from the other points of their bureau de vote (see `flag_distance_outliers`)
 
     Args:
         df (pd.DataFrame): a dataframe where geocoding has already been performed with API-adresse
+        communes (gpd.GeoDataFrame, optional): the shapes of communes, with column "result_citycode" or "insee". Defaults to None (no spatial check).
+        max_distance_ratio (float, optional): see `flag_distance_outliers`. Defaults to None (no check of distance outliers).
+        min_outlier_distance (float, optional): see `flag_distance_outliers` (in meters). Defaults to 1000.
+        flag_only (bool, optional): if True, the spatial checks only add boolean columns "outside_commune" and "distance_outlier" instead of removing the rows. Defaults to False.
 
     Returns:
         pd.DataFrame: a cleaned subset of this dataframe
@@ -149,11 +235,33 @@ def clean_failed_geocoding(df: pd.DataFrame) -> pd.DataFrame:
         and "Code communeRéférentiel" in df.columns
     ), "the dataframe does not include required columns for cleaning"
     # the comparison is performed on column "result_postcode" (because there is no citycode in INSEE input file) but other functions will only refer to "result_citycode" (because it is a good practice to prefer this column)
-    return df[
+    keep = (
         (df.result_score > 0.5)
-        & (df.result_citycode == df["Code communeRéférentiel"])
-        & (df.result_postcode == df.CP)
-    ].dropna(subset=["CP", "result_citycode", "result_postcode"])
+        & _equal_codes(df.result_citycode, df["Code communeRéférentiel"])
+        & _equal_codes(df.result_postcode, df.CP)
+        & df[["CP", "result_citycode", "result_postcode"]].notna().all(axis=1)
+    )
+    # `take` returns a new dataframe (not a view), so that the next steps can add columns to it
+    cleaned = df.take(np.flatnonzero(keep.to_numpy()))
+    if communes is not None:
+        outside = flag_outside_communes(cleaned, communes)
+        if flag_only:
+            cleaned["outside_commune"] = outside
+        else:
+            cleaned = cleaned.take(np.flatnonzero(~outside))
+    if max_distance_ratio is not None:
+        group_columns = ["id_bv"] if "id_bv" in cleaned.columns else ["result_citycode", "Code_BV"]
+        # when points are only flagged, the points outside their commune do not take part in the centres of the bureaux
+        checked = np.flatnonzero(~cleaned["outside_commune"].to_numpy()) if "outside_commune" in cleaned.columns else np.arange(len(cleaned))
+        outlier = np.zeros(len(cleaned), dtype=bool)
+        outlier[checked] = flag_distance_outliers(
+            cleaned.take(checked), group_columns, max_distance_ratio, min_outlier_distance
+        )
+        if flag_only:
+            cleaned["distance_outlier"] = outlier
+        else:
+            cleaned = cleaned.take(np.flatnonzero(~outlier))
+    return cleaned
 
 
 def get_address(row) -> str:
@@ -188,51 +296,47 @@ def get_address(row) -> str:
         return (address + " " + str(row["lieu-dit-clean"]).lower()).strip()
 
 
-def prepare_ids(df: pd.DataFrame) -> pd.DataFrame:
+def prepare_ids(
+    df: pd.DataFrame,
+    bv_column: str = "Code_BV",
+    citycode_column: str = "result_citycode",
+    max_bv_per_city: int = 1000,
+) -> pd.DataFrame:
     """
-    Prepare `id_bv` (integers) column
+    Prepare `id_bv` (integers) column. The column is added in place: the input dataframe is not copied
 
     Args:
-        df (pd.DataFrame): a dataframe including columns "Code_BV" and "result_citycode"
+        df (pd.DataFrame): a dataframe including columns `bv_column` and `citycode_column`
+        bv_column (str, optional): the column with the number of the bureau de vote inside the city. Defaults to "Code_BV".
+        citycode_column (str, optional): the column with the citycode. Defaults to "result_citycode".
+        max_bv_per_city (int, optional): assuming there is always less than this number of bv in a city. This is important to grant the uniqueness of id_bv. Defaults to 1000.
 
     Returns:
         pd.DataFrame: a dataframe similar to the input, with a supplementary column "id_bv" (integers) unique for every bureau de vote
     """
-    assert ("Code_BV" in df.columns) and (
-        "result_citycode" in df.columns
+    assert (bv_column in df.columns) and (
+        citycode_column in df.columns
     ), "There is no identifiers for bureau de vote"
-    df_copy = df.copy()
+    max_code_commune = 10**5
 
-    def prepare_id_bv(row):
+    def parse_code(codes: pd.Series, default: int) -> np.ndarray:
         """
-        Combine the unique id of a city (citycode) and the number of the bureau de vote inside the city to compute a nationalwide id of bureau de vote
-
-        Args:
-            row (_type_): _description_
-
-        Returns:
-            id_bv: integer serving as unique id of a bureau de vote
+        Parse a column of codes as integers. When a code is not a number, keep the first number found in the string (if there is one), else use `default`
         """
-        max_bv_per_city = 1000  # assuming there is always less than this number of bv in a city. This is important to grant the uniqueness of id_bv
-        max_code_commune = 10**5
-        try:
-            code_bv = int(row["Code_BV"])
-        except:
-            # keep as Code_BV the first number found in the string (if there is one)
-            found = re.search(r"\d+", row["Code_BV"])
-            if found:
-                code_bv = int(found.group())
-            else:
-                code_bv = max_bv_per_city  # this code will indicate parsing errors but won't raise exception
-        try:
-            code_commune = int(row["result_citycode"])
-        except:
-            found = re.search(r"\d+", row["result_citycode"])
-            if found:
-                code_commune = int(found.group())
-            else:
-                code_commune = max_code_commune
-        return max_bv_per_city * code_commune + code_bv
+        # codes are parsed once per distinct value (the columns are usually categoricals)
+        if isinstance(codes.dtype, pd.CategoricalDtype):
+            positions, values = codes.cat.codes.to_numpy(), codes.cat.categories
+        else:
+            positions, values = pd.factorize(codes)
+        values = pd.Series(values.astype(str))
+        parsed = pd.to_numeric(values, errors="coerce")
+        found = pd.to_numeric(values.str.extract(r"(\d+)", expand=False), errors="coerce")
+        parsed = parsed.fillna(found).fillna(default).astype("int64").to_numpy()
+        # missing codes have position -1, and get the default value appended at the end
+        return np.append(parsed, default)[positions]
 
-    df_copy["id_bv"] = df_copy.apply(prepare_id_bv, axis=1)
-    return df_copy
+    # a code_bv equal to max_bv_per_city indicates parsing errors but won't raise exception
+    code_bv = parse_code(df[bv_column], max_bv_per_city)
+    code_commune = parse_code(df[citycode_column], max_code_commune)
+    df["id_bv"] = compact_id_bv(pd.Series(max_bv_per_city * code_commune + code_bv, index=df.index))
+    return df
@@ -0,0 +1,177 @@
+"""
+Read-only store of the shapes of the communes, shared by the worker processes without copies. The shapes are serialized once as WKB in
+a single file, along with the sorted INSEE codes and the offsets of their WKB: the file is memory-mapped, so that the processes attach to
+it in constant time (pickling a `CommuneStore` only sends its path) and share the pages of the OS cache, and each process only parses the
+communes it processes, looked up by binary search on the codes.
+
+File layout: an 8-byte header length, a JSON header, then the codes, the offsets and the WKB buffer, aligned on 8 bytes.
+
+Usage:
+    python commune_store.py ../communes-5m.geojson communes.store
+"""
+import argparse
+import json
+import os
+from typing import Iterable
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+HEADER_SIZE_BYTES = 8
+
+
+def _aligned(position: int) -> int:
+    return (position + 7) // 8 * 8
+
+
+def write_commune_store(communes: gpd.GeoDataFrame, path: str) -> str:
+    """
+    Serialize the shapes of the communes in a store file. Several rows with the same code are merged
+
+    Args:
+        communes (gpd.GeoDataFrame): the shapes of the communes, with column "insee"
+        path (str): the store file, written under a temporary name and moved to `path` once complete
+
+    Returns:
+        str: path
+    """
+    codes = communes["insee"].astype(str).to_numpy()
+    geometries = communes.geometry.to_numpy()
+    order = np.argsort(codes, kind="stable")
+    codes, geometries = codes[order], geometries[order]
+    unique_codes, starts = np.unique(codes, return_index=True)
+    if len(unique_codes) < len(codes):
+        geometries = np.array(
+            [
+                geometries[start] if end - start == 1 else shapely.union_all(geometries[start:end])
+                for start, end in zip(starts, np.append(starts[1:], len(codes)))
+            ],
+            dtype=object,
+        )
+    wkbs = shapely.to_wkb(geometries)
+    sizes = np.array([0 if wkb is None else len(wkb) for wkb in wkbs], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    encoded_codes = np.array(unique_codes, dtype="S")
+
+    header = {
+        "n_communes": len(unique_codes),
+        "code_dtype": encoded_codes.dtype.str,
+        "wkb_size": int(offsets[-1]),
+        "crs": communes.crs.to_string() if communes.crs is not None else None,
+    }
+    # the sections start after the header, at positions known once the header length is fixed
+    position = _aligned(HEADER_SIZE_BYTES + len(json.dumps({**header, "sections": [0, 0, 0]}).encode()) + 64)
+    header["sections"] = []
+    for array in (encoded_codes, offsets):
+        header["sections"].append(position)
+        position = _aligned(position + array.nbytes)
+    header["sections"].append(position)
+    encoded_header = json.dumps(header).encode()
+
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".tmp_{name}")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(len(encoded_header).to_bytes(HEADER_SIZE_BYTES, "little"))
+            f.write(encoded_header)
+            for start, array in zip(header["sections"][:2], (encoded_codes, offsets)):
+                f.seek(start)
+                f.write(array.tobytes())
+            f.seek(header["sections"][2])
+            for wkb in wkbs:
+                if wkb is not None:
+                    f.write(wkb)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+class CommuneStore:
+    """
+    Memory-mapped shapes of the communes, written by `write_commune_store`
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            header_size = int.from_bytes(f.read(HEADER_SIZE_BYTES), "little")
+            self.header = json.loads(f.read(header_size))
+        n = self.header["n_communes"]
+        codes_start, offsets_start, wkb_start = self.header["sections"]
+        self.codes = np.memmap(path, dtype=self.header["code_dtype"], mode="r", offset=codes_start, shape=(n,))
+        self.offsets = np.memmap(path, dtype=np.int64, mode="r", offset=offsets_start, shape=(n + 1,))
+        self.wkb = np.memmap(path, dtype=np.uint8, mode="r", offset=wkb_start, shape=(max(self.header["wkb_size"], 1),))
+        self.crs = self.header["crs"]
+
+    def __getstate__(self) -> dict:
+        # the worker processes open the file again instead of receiving the arrays
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state["path"])
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __contains__(self, insee: str) -> bool:
+        return self.positions([insee])[0] >= 0
+
+    @property
+    def insee(self) -> np.ndarray:
+        return self.codes.astype(str)
+
+    def positions(self, insees: Iterable[str]) -> np.ndarray:
+        """
+        Positions of the INSEE codes in the store (-1 for the unknown codes)
+        """
+        keys = np.array([str(insee) for insee in insees], dtype="S")
+        positions = np.searchsorted(self.codes, keys)
+        found = positions < len(self.codes)
+        found[found] = self.codes[positions[found]] == keys[found]
+        return np.where(found, positions, -1)
+
+    def _geometries_at(self, positions: np.ndarray) -> np.ndarray:
+        wkbs = np.full(len(positions), None, dtype=object)
+        for k, position in enumerate(positions):
+            # missing codes and missing geometries (empty WKB) stay None
+            if position >= 0 and self.offsets[position + 1] > self.offsets[position]:
+                wkbs[k] = self.wkb[self.offsets[position]:self.offsets[position + 1]].tobytes()
+        return shapely.from_wkb(wkbs)
+
+    def _communes_at(self, positions: np.ndarray) -> gpd.GeoDataFrame:
+        return gpd.GeoDataFrame(
+            {"insee": self.codes[positions].astype(str)}, geometry=self._geometries_at(positions), crs=self.crs
+        )
+
+    def geometries(self, insees: Iterable[str]) -> np.ndarray:
+        """
+        The shapes of the communes (None for the unknown codes), only these communes being parsed
+        """
+        return self._geometries_at(self.positions(insees))
+
+    def communes(self, insees: Iterable[str] = None) -> gpd.GeoDataFrame:
+        """
+        GeoDataFrame with columns "insee" and "geometry" of the known communes among `insees` (all the communes if None)
+        """
+        positions = np.arange(len(self)) if insees is None else self.positions(insees)
+        return self._communes_at(positions[positions >= 0])
+
+    def departement(self, departement: str) -> gpd.GeoDataFrame:
+        """
+        The communes of a département (their codes start with the code of the département), found by binary search on the sorted codes
+        """
+        prefix = str(departement).encode()
+        start, end = np.searchsorted(self.codes, [prefix, prefix + b"\xff"])
+        return self._communes_at(np.arange(start, end))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the shapes of the communes in a memory-mapped store")
+    parser.add_argument("communes", help="any format read by geopandas, with column 'insee' or 'code'")
+    parser.add_argument("output", nargs="?", default="communes.store")
+    args = parser.parse_args()
+    communes_france = gpd.read_file(args.communes).rename({"code": "insee"}, axis=1)[["insee", "geometry"]]
+    print(f"### {len(communes_france)} communes written in {write_commune_store(communes_france, args.output)}")
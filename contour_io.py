@@ -0,0 +1,394 @@
+"""
+Writing and reading of contour files. The writers receive the contours by batches and stream them to the output file, instead of
+serializing a whole département into one JSON string. The file is written under a temporary name and only moved to its final path
+once complete (atomic finalization), so that an interrupted run never leaves a truncated output behind.
+
+Supported formats (chosen from the extension of the output path):
+    - ".geojson": GeoJSON FeatureCollection
+    - ".geojsonl", ".geojsons": GeoJSON sequence, one feature per line
+    - ".parquet": GeoParquet, geometries encoded as WKB (or GeoArrow), with a bounding box column per row for spatial filtering
+    - ".fgb": FlatGeobuf, geometries encoded as WKB, with a packed spatial index
+    - ".topojson": TopoJSON, the borders shared by neighbouring contours being stored once (see `topology`)
+"""
+import json
+import os
+from typing import List
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import shapely
+
+from arrow_geometry import contours_from_arrow, contours_to_arrow, geometries_to_arrow
+from topology import build_topology, simplify_topology, topology_to_geodataframe
+
+GEOJSON_SEQ_EXTENSIONS = (".geojsonl", ".geojsons")
+# extensions of the contour files written by the writers below
+CONTOUR_EXTENSIONS = (".geojson", ".geojsonl", ".geojsons", ".parquet", ".fgb", ".topojson")
+
+
+class ContourWriter:
+    """
+    Base class of the writers: handles the temporary file and the atomic finalization.
+    Use it as a context manager: the output is finalized when the block ends normally, and removed if an exception is raised
+
+    Args:
+        path (str): the final path of the output
+        batch_size (int, optional): number of features serialized at once. Defaults to 10000.
+    """
+
+    def __init__(self, path: str, batch_size: int = 10000):
+        self.path = path
+        # same directory (so that the final move is atomic) and same extension (GDAL picks the format from it)
+        directory, name = os.path.split(path)
+        self.tmp_path = os.path.join(directory, f".tmp_{name}")
+        self.batch_size = batch_size
+        self.n_features = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, gdf: gpd.GeoDataFrame):
+        """
+        Append contours to the output
+        """
+        for start in range(0, len(gdf), self.batch_size):
+            batch = gdf.iloc[start:start + self.batch_size]
+            self._write_batch(batch)
+            self.n_features += len(batch)
+
+    def _write_batch(self, gdf: gpd.GeoDataFrame):
+        raise NotImplementedError
+
+    def _finalize(self):
+        pass
+
+    def close(self):
+        """
+        Complete the output, and move it to its final path
+        """
+        self._finalize()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Drop the incomplete output
+        """
+        try:
+            self._finalize()
+        finally:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+
+def _geojson_features(gdf: gpd.GeoDataFrame) -> List[str]:
+    """
+    Serialize a batch of contours as GeoJSON features (one string per feature), the geometries being serialized in bulk
+    """
+    properties = gdf.drop(columns=gdf.geometry.name)
+    if len(properties.columns):
+        properties = properties.to_json(orient="records", lines=True).splitlines()
+    else:
+        properties = ["{}"] * len(gdf)
+    geometries = shapely.to_geojson(gdf.geometry.to_numpy())
+    return [
+        f'{{"id": {json.dumps(str(index))}, "type": "Feature", "properties": {props}, "geometry": {geometry if geometry is not None else "null"}}}'
+        for index, props, geometry in zip(gdf.index, properties, geometries)
+    ]
+
+
+class GeoJSONWriter(ContourWriter):
+    """
+    Stream the contours to a GeoJSON FeatureCollection, the format of `GeoDataFrame.to_json()`
+    """
+
+    def __init__(self, path: str, batch_size: int = 10000):
+        super().__init__(path, batch_size)
+        self.file = open(self.tmp_path, "w")
+        self.file.write('{"type": "FeatureCollection", "features": [')
+
+    def _write_batch(self, gdf: gpd.GeoDataFrame):
+        features = _geojson_features(gdf)
+        if self.n_features and len(features):
+            self.file.write(", ")
+        self.file.write(", ".join(features))
+
+    def _finalize(self):
+        if not self.file.closed:
+            self.file.write("]}")
+            self.file.close()
+
+
+class GeoJSONSeqWriter(ContourWriter):
+    """
+    Stream the contours to a GeoJSON sequence (one feature per line), which can be read back feature by feature
+    """
+
+    def __init__(self, path: str, batch_size: int = 10000):
+        super().__init__(path, batch_size)
+        self.file = open(self.tmp_path, "w")
+
+    def _write_batch(self, gdf: gpd.GeoDataFrame):
+        for feature in _geojson_features(gdf):
+            self.file.write(feature + "\n")
+
+    def _finalize(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def _contour_table(gdf: gpd.GeoDataFrame, schema: pa.Schema = None, geometry_encoding: str = "WKB") -> pa.Table:
+    """
+    Arrow table of a batch of contours: the attributes, the geometry (as WKB, or as GeoArrow multipolygons, see `arrow_geometry`) and the
+    bounding box of each geometry
+    """
+    geometries = gdf.geometry.to_numpy()
+    bounds = shapely.bounds(geometries)
+    attributes = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    # the object columns are written as strings: the ids of the bureaux mix the integers of `cleaner.prepare_ids` with the "{insee}_X"
+    # strings of the communes without addresses, which Arrow cannot store in one column (and a batch may only hold integers)
+    for column in attributes.columns[attributes.dtypes == object]:
+        values = attributes[column]
+        attributes[column] = values.where(values.isna(), values.astype(str))
+    table = pa.Table.from_pandas(attributes, preserve_index=False)
+    if geometry_encoding == "geoarrow":
+        array, field = geometries_to_arrow(geometries)
+        table = table.append_column(field, array)
+    else:
+        table = table.append_column("geometry", pa.array(shapely.to_wkb(geometries), type=pa.binary()))
+    table = table.append_column(
+        "bbox",
+        pa.StructArray.from_arrays(
+            [pa.array(bounds[:, k]) for k in range(4)], names=["xmin", "ymin", "xmax", "ymax"]
+        ),
+    )
+    if schema is not None:
+        table = table.cast(schema)
+    return table
+
+
+class GeoParquetWriter(ContourWriter):
+    """
+    Stream the contours to a GeoParquet file (one row group per batch). The "bbox" column lets readers skip row groups
+    that do not intersect their area of interest
+
+    Args:
+        crs (optional): the coordinates reference system of the contours. Defaults to "EPSG:4326".
+        geometry_encoding (str, optional): "WKB", or "geoarrow" for the native GeoArrow encoding of GeoParquet 1.1 (MultiPolygons whose
+            coordinates are written from and read into numpy arrays without parsing each geometry). Defaults to "WKB".
+    """
+
+    def __init__(self, path: str, batch_size: int = 10000, crs="EPSG:4326", geometry_encoding: str = "WKB"):
+        super().__init__(path, batch_size)
+        assert geometry_encoding in ["WKB", "geoarrow"], "the geometry encodings are WKB or geoarrow"
+        self.crs = crs
+        self.geometry_encoding = geometry_encoding
+        self.writer = None
+
+    def _write_batch(self, gdf: gpd.GeoDataFrame):
+        if self.writer is None:
+            table = _contour_table(gdf, geometry_encoding=self.geometry_encoding)
+            self.writer = pq.ParquetWriter(self.tmp_path, table.schema.with_metadata(self._geo_metadata()))
+        else:
+            table = _contour_table(gdf, self.writer.schema, geometry_encoding=self.geometry_encoding)
+        self.writer.write_table(table)
+
+    def _geo_metadata(self) -> dict:
+        geoarrow = self.geometry_encoding == "geoarrow"
+        column = {
+            "encoding": "multipolygon" if geoarrow else "WKB",
+            # the geometry types are only known once every batch is written: an empty list means "any type"
+            "geometry_types": ["MultiPolygon"] if geoarrow else [],
+            "covering": {
+                "bbox": {
+                    "xmin": ["bbox", "xmin"],
+                    "ymin": ["bbox", "ymin"],
+                    "xmax": ["bbox", "xmax"],
+                    "ymax": ["bbox", "ymax"],
+                }
+            },
+        }
+        if self.crs is not None:
+            column["crs"] = gpd.GeoSeries([], crs=self.crs).crs.to_json_dict()
+        return {
+            b"geo": json.dumps(
+                {"version": "1.1.0", "primary_column": "geometry", "columns": {"geometry": column}}
+            ).encode()
+        }
+
+    def _finalize(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        elif not os.path.exists(self.tmp_path):
+            # no contour at all: write an empty file
+            gpd.GeoDataFrame(geometry=[], crs=self.crs).to_parquet(self.tmp_path)
+
+
+class FlatGeobufWriter(ContourWriter):
+    """
+    Write the contours to a FlatGeobuf file with a spatial index.
+    The packed spatial index of FlatGeobuf is built from all the features, so the batches are kept as WKB (much more compact than
+    GeoDataFrames or JSON strings) and written when the writer is closed
+    """
+
+    def __init__(self, path: str, batch_size: int = 10000, crs="EPSG:4326"):
+        super().__init__(path, batch_size)
+        self.crs = crs
+        self.tables = []
+
+    def _write_batch(self, gdf: gpd.GeoDataFrame):
+        self.tables.append(_contour_table(gdf, self.tables[0].schema if self.tables else None))
+
+    def abort(self):
+        self.tables = None
+        super().abort()
+
+    def _finalize(self):
+        if self.tables is None:
+            return
+        tables, self.tables = self.tables, None
+        if not tables:
+            gdf = gpd.GeoDataFrame(geometry=[], crs=self.crs)
+        else:
+            table = pa.concat_tables(tables)
+            gdf = gpd.GeoDataFrame(
+                table.drop(["geometry", "bbox"]).to_pandas(),
+                geometry=gpd.GeoSeries.from_wkb(table.column("geometry").to_numpy(zero_copy_only=False)),
+                crs=self.crs,
+            )
+        gdf.to_file(self.tmp_path, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+
+
+class TopoJSONWriter(ContourWriter):
+    """
+    Write the contours to a TopoJSON file. The arcs are shared between all the contours, so the batches are kept as WKB
+    (as for FlatGeobuf) and the topology is built when the writer is closed
+
+    Args:
+        quantization (int, optional): see `topology.build_topology`. Defaults to 10**6.
+        tolerance (float, optional): if set, the arcs are simplified with this tolerance (see `topology.simplify_topology`). Defaults to None.
+    """
+
+    def __init__(self, path: str, batch_size: int = 10000, quantization: int = 10**6, tolerance: float = None):
+        super().__init__(path, batch_size)
+        self.quantization = quantization
+        self.tolerance = tolerance
+        self.tables = []
+
+    def _write_batch(self, gdf: gpd.GeoDataFrame):
+        self.tables.append(_contour_table(gdf, self.tables[0].schema if self.tables else None))
+
+    def abort(self):
+        self.tables = None
+        super().abort()
+
+    def _finalize(self):
+        if self.tables is None:
+            return
+        tables, self.tables = self.tables, None
+        if not tables:
+            gdf = gpd.GeoDataFrame(geometry=[])
+        else:
+            table = pa.concat_tables(tables)
+            gdf = gpd.GeoDataFrame(
+                table.drop(["geometry", "bbox"]).to_pandas(),
+                geometry=gpd.GeoSeries.from_wkb(table.column("geometry").to_numpy(zero_copy_only=False)),
+            )
+        topology = build_topology(gdf, quantization=self.quantization)
+        if self.tolerance is not None:
+            topology = simplify_topology(topology, self.tolerance)
+        with open(self.tmp_path, "w") as file:
+            json.dump(topology, file, separators=(",", ":"))
+
+
+def open_contour_writer(
+    path: str, batch_size: int = 10000, crs="EPSG:4326", geometry_encoding: str = "WKB"
+) -> ContourWriter:
+    """
+    Open the writer matching the extension of `path` (see the module docstring). `geometry_encoding` only applies to GeoParquet
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".geojson":
+        return GeoJSONWriter(path, batch_size)
+    if extension in GEOJSON_SEQ_EXTENSIONS:
+        return GeoJSONSeqWriter(path, batch_size)
+    if extension == ".parquet":
+        return GeoParquetWriter(path, batch_size, crs=crs, geometry_encoding=geometry_encoding)
+    if extension == ".fgb":
+        return FlatGeobufWriter(path, batch_size, crs=crs)
+    if extension == ".topojson":
+        return TopoJSONWriter(path, batch_size)
+    raise ValueError(f"unsupported contour format: {extension}")
+
+
+def read_contours_table(path: str, columns: List[str] = None, bbox: tuple = None) -> pa.Table:
+    """
+    Read a contour file as an Arrow table, the geometry column being GeoArrow multipolygons (see `arrow_geometry`). The GeoParquet files
+    written with `geometry_encoding="geoarrow"` are read without decoding any geometry
+
+    Args: see `read_contours`
+
+    Returns:
+        pa.Table: the attributes and the "geometry" column
+    """
+    if os.path.splitext(path)[1].lower() == ".parquet":
+        table = _read_geoparquet(path, columns, bbox)
+        if not pa.types.is_binary(table.schema.field("geometry").type):
+            return table
+        return contours_to_arrow(contours_from_arrow(table))
+    return contours_to_arrow(read_contours(path, columns, bbox))
+
+
+def _read_geoparquet(path: str, columns: List[str] = None, bbox: tuple = None) -> pa.Table:
+    filters = None
+    if bbox is not None:
+        filters = (
+            (pc.field("bbox", "xmax") >= bbox[0])
+            & (pc.field("bbox", "ymax") >= bbox[1])
+            & (pc.field("bbox", "xmin") <= bbox[2])
+            & (pc.field("bbox", "ymin") <= bbox[3])
+        )
+    table = pq.read_table(path, columns=None if columns is None else columns + ["geometry"], filters=filters)
+    return table.drop([c for c in ["bbox"] if c in table.column_names])
+
+
+def read_contours(path: str, columns: List[str] = None, bbox: tuple = None) -> gpd.GeoDataFrame:
+    """
+    Read a contour file written by one of the writers above
+
+    Args:
+        path (str):
+        columns (List[str], optional): the attributes to read. Defaults to None (all of them).
+        bbox (tuple, optional): (xmin, ymin, xmax, ymax), only read the contours intersecting this box. Defaults to None.
+
+    Returns:
+        gpd.GeoDataFrame: the contours
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".parquet":
+        table = _read_geoparquet(path, columns, bbox)
+        crs = json.loads(table.schema.metadata[b"geo"])["columns"]["geometry"].get("crs")
+        # WKB or GeoArrow geometries
+        return contours_from_arrow(table, crs=None if crs is None else json.dumps(crs))
+    if extension == ".topojson":
+        with open(path) as file:
+            gdf = topology_to_geodataframe(json.load(file)).set_crs("EPSG:4326")
+        if bbox is not None:
+            gdf = gdf.iloc[gdf.sindex.query(shapely.box(*bbox))].sort_index()
+        if columns is not None:
+            gdf = gdf[columns + [gdf.geometry.name]]
+        return gdf
+    # GDAL reads GeoJSON, GeoJSON sequences and FlatGeobuf (using its spatial index when a bbox is given)
+    gdf = gpd.read_file(path, bbox=bbox)
+    if columns is not None:
+        gdf = gdf[columns + [gdf.geometry.name]]
+    return gdf
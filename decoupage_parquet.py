@@ -1,14 +1,15 @@
-import pandas as pd
-import os
-
-path_in = "./../work/table_adresses.parquet"
-df = pd.read_parquet(path_in)
-df['dep_bv'] = df['code_commune_ref'].apply(lambda s: s[:3] if s[:2]=='97' else s[:2])
-
-for k in df.dep_bv.unique():
-    print(k)
-    path_out = f"parquet/table_{k}.parquet"
-    if f"table_{k}.parquet" in os.listdir("parquet/"):
-        print('Already processed')
-    else:
-        df[df.dep_bv == k].to_parquet(path_out)
+import os
+from streaming import iter_address_batches, partition_by_departement
+
+path_in = "./../work/table_adresses.parquet"
+# the national table is read by batches and appended to one file per département, without loading the whole of France in memory
+already_processed = [
+    name[len("table_"):-len(".parquet")] for name in os.listdir("parquet/")
+    if name.startswith("table_") and name.endswith(".parquet")
+]
+print(f"Already processed: {already_processed}")
+counts = partition_by_departement(
+    iter_address_batches(path_in), "parquet/", citycode_column="code_commune_ref", skip=already_processed
+)
+for k, n in sorted(counts.items()):
+    print(k, n)
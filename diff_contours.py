@@ -0,0 +1,245 @@
+"""
+Differences between the contours of two snapshots of the REU (the outputs of `generate_areas_geojson.py` on two extracts), to find the
+bureaux de vote whose shape changed without comparing the maps by eye. The bureaux are matched by id; the bureaux whose id only exists in
+one snapshot (renumbered, created or deleted bureaux) are matched with a spatial index to the bureau of the other snapshot they overlap
+the most. The areas of the symmetric differences are computed with bulk set operations, only for the bureaux whose geometry is not
+identical in both snapshots, and only the changed bureaux are reported.
+
+Usage:
+    python diff_contours.py geojson_2023/ geojson_2024/ --report diff_report.csv
+"""
+import argparse
+import os
+from typing import List, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from contour_io import read_contours
+from geo import _area_m2
+from merge_departements import departement_files
+
+DIFF_COLUMNS = [
+    "departement",
+    "id_bv",
+    "status",
+    "old_id_bv",
+    "old_area_m2",
+    "new_area_m2",
+    "sym_diff_m2",
+    "change_ratio",
+]
+
+
+def bureau_shapes(contours: gpd.GeoDataFrame, id_column: str = "id_bv") -> Tuple[np.ndarray, np.ndarray]:
+    """
+    One MultiPolygon per bureau, gathering the polygons of its rows (a bureau can be written as several connected components)
+
+    Args:
+        contours (gpd.GeoDataFrame): with column `id_column`
+        id_column (str, optional): Defaults to "id_bv".
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the ids (as strings) and the shapes of the bureaux
+    """
+    contours = contours[contours.geometry.notna() & ~contours.geometry.is_empty]
+    codes, ids = pd.factorize(contours[id_column].astype(str))
+    parts, index = shapely.get_parts(contours.geometry.to_numpy(), return_index=True)
+    polygonal = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    parts, index = parts[polygonal], codes[index[polygonal]]
+    order = np.argsort(index, kind="stable")
+    shapes = np.full(len(ids), None, dtype=object)
+    present = np.unique(index)
+    # the components of a bureau do not overlap, so they are gathered without computing their union
+    shapes[present] = shapely.multipolygons(parts[order], indices=np.searchsorted(present, index[order]))
+    return np.asarray(ids, dtype=str), shapes
+
+
+def _areas_m2(geometries: np.ndarray) -> np.ndarray:
+    """
+    Areas in square meters of geometries in longitude/latitude, 0 for the empty geometries
+    """
+    areas = np.zeros(len(geometries))
+    non_empty = ~shapely.is_empty(geometries)
+    if non_empty.any():
+        areas[non_empty] = _area_m2(geometries[non_empty])
+    return areas
+
+
+def _compare(old: np.ndarray, new: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Areas in square meters of pairs of shapes and of their symmetric differences, the identical pairs being skipped
+    """
+    old_areas, new_areas = _areas_m2(old), _areas_m2(new)
+    sym_diff = np.zeros(len(old))
+    different = ~shapely.equals_exact(old, new, tolerance=0)
+    if different.any():
+        # area(A △ B) = area(A) + area(B) - 2 area(A ∩ B)
+        inter_areas = _areas_m2(shapely.intersection(shapely.make_valid(old[different]), shapely.make_valid(new[different])))
+        sym_diff[different] = np.maximum(old_areas[different] + new_areas[different] - 2 * inter_areas, 0.0)
+    return old_areas, new_areas, sym_diff
+
+
+def diff_contours(
+    old: gpd.GeoDataFrame, new: gpd.GeoDataFrame, id_column: str = "id_bv", min_area: float = 1
+) -> pd.DataFrame:
+    """
+    Compare the contours of the bureaux de vote of two snapshots
+
+    Args:
+        old (gpd.GeoDataFrame): the contours of the previous snapshot, in longitude/latitude
+        new (gpd.GeoDataFrame): the contours of the new snapshot, in longitude/latitude
+        id_column (str, optional): the id of the bureaux. Defaults to "id_bv".
+        min_area (float, optional): bureaux whose symmetric difference is below this area (in square meters) are unchanged. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: one row per changed bureau (see `DIFF_COLUMNS`, without "departement"). The status is "changed" (same id, different
+        shape), "renumbered" (new id overlapping a bureau whose id disappeared, compared to it, reported even with the same shape), "added" (new id overlapping no
+        disappeared bureau) or "removed" (disappeared id matched by no new bureau). "change_ratio" is the symmetric difference divided
+        by the area of the union of both shapes (1 for the added and removed bureaux)
+    """
+    old_ids, old_shapes = bureau_shapes(old, id_column)
+    new_ids, new_shapes = bureau_shapes(new, id_column)
+    old_valid, new_valid = ~shapely.is_missing(old_shapes), ~shapely.is_missing(new_shapes)
+    old_ids, old_shapes = old_ids[old_valid], old_shapes[old_valid]
+    new_ids, new_shapes = new_ids[new_valid], new_shapes[new_valid]
+    common, old_common, new_common = np.intersect1d(old_ids, new_ids, return_indices=True)
+    old_areas, new_areas, sym_diff = _compare(old_shapes[old_common], new_shapes[new_common])
+    frames = [
+        pd.DataFrame(
+            {
+                "id_bv": common,
+                "status": "changed",
+                "old_id_bv": common,
+                "old_area_m2": old_areas,
+                "new_area_m2": new_areas,
+                "sym_diff_m2": sym_diff,
+            }
+        )
+    ]
+
+    # the bureaux whose id is in one snapshot only are matched to the bureau of the other one they overlap the most
+    removed = np.setdiff1d(np.arange(len(old_ids)), old_common)
+    added = np.setdiff1d(np.arange(len(new_ids)), new_common)
+    matched = np.full(len(added), -1)
+    if len(removed) and len(added):
+        new_idx, old_idx = shapely.STRtree(old_shapes[removed]).query(new_shapes[added], predicate="intersects")
+        overlaps = _areas_m2(
+            shapely.intersection(shapely.make_valid(new_shapes[added][new_idx]), shapely.make_valid(old_shapes[removed][old_idx]))
+        )
+        keep = overlaps > min_area
+        new_idx, old_idx, overlaps = new_idx[keep], old_idx[keep], overlaps[keep]
+        order = np.lexsort((-overlaps, new_idx))
+        _, first = np.unique(new_idx[order], return_index=True)
+        matched[new_idx[order][first]] = old_idx[order][first]
+    renumbered = matched >= 0
+    if renumbered.any():
+        old_areas, new_areas, sym_diff = _compare(
+            old_shapes[removed[matched[renumbered]]], new_shapes[added[renumbered]]
+        )
+        frames.append(
+            pd.DataFrame(
+                {
+                    "id_bv": new_ids[added[renumbered]],
+                    "status": "renumbered",
+                    "old_id_bv": old_ids[removed[matched[renumbered]]],
+                    "old_area_m2": old_areas,
+                    "new_area_m2": new_areas,
+                    "sym_diff_m2": sym_diff,
+                }
+            )
+        )
+    new_areas = _areas_m2(new_shapes[added[~renumbered]])
+    frames.append(
+        pd.DataFrame(
+            {
+                "id_bv": new_ids[added[~renumbered]],
+                "status": "added",
+                "old_id_bv": None,
+                "old_area_m2": 0.0,
+                "new_area_m2": new_areas,
+                "sym_diff_m2": new_areas,
+            }
+        )
+    )
+    deleted = removed[~np.isin(np.arange(len(removed)), matched[renumbered])]
+    old_areas = _areas_m2(old_shapes[deleted])
+    frames.append(
+        pd.DataFrame(
+            {
+                "id_bv": old_ids[deleted],
+                "status": "removed",
+                "old_id_bv": old_ids[deleted],
+                "old_area_m2": old_areas,
+                "new_area_m2": 0.0,
+                "sym_diff_m2": old_areas,
+            }
+        )
+    )
+
+    diff = pd.concat([frame for frame in frames if len(frame)], ignore_index=True)
+    diff = diff[(diff["sym_diff_m2"] > min_area) | (diff["status"] != "changed")]
+    # area of the union: area(A) + area(B) - area(A ∩ B), with area(A ∩ B) = (area(A) + area(B) - area(A △ B)) / 2
+    union_areas = (diff["old_area_m2"] + diff["new_area_m2"] + diff["sym_diff_m2"]) / 2
+    diff = diff.assign(change_ratio=np.where(union_areas > 0, diff["sym_diff_m2"] / union_areas.where(union_areas > 0, 1), 0.0))
+    return diff.sort_values("sym_diff_m2", ascending=False, ignore_index=True)[DIFF_COLUMNS[1:]]
+
+
+def diff_snapshots(
+    old_path: str, new_path: str, report: str = None, departements: List[str] = None, **kwargs
+) -> pd.DataFrame:
+    """
+    Compare two contour outputs, either two directories of département files (`voronoi_contours_{DEP}`, compared département by
+    département, one file per département in each directory: see `merge_departements.departement_files`) or two contour files (e.g.
+    national files written by `merge_departements.py`)
+
+    Args:
+        old_path (str): the contours of the previous snapshot
+        new_path (str): the contours of the new snapshot
+        report (str, optional): path of a CSV file where the changed bureaux are written. Defaults to None.
+        departements (List[str], optional): only compare these départements. Defaults to None (all of them).
+        kwargs: passed to `diff_contours`
+
+    Returns:
+        pd.DataFrame: one row per changed bureau (see `DIFF_COLUMNS`)
+    """
+    if os.path.isdir(old_path) and os.path.isdir(new_path):
+        old_files = {dep: path for dep, path in departement_files(old_path)}
+        new_files = {dep: path for dep, path in departement_files(new_path)}
+        pairs = [(dep, old_files.get(dep), new_files.get(dep)) for dep in sorted(old_files.keys() | new_files.keys())]
+    else:
+        pairs = [("", old_path, new_path)]
+    empty = gpd.GeoDataFrame({kwargs.get("id_column", "id_bv"): []}, geometry=[], crs="EPSG:4326")
+    reports = []
+    for dep, old_file, new_file in pairs:
+        if departements is not None and dep not in departements:
+            continue
+        diff = diff_contours(
+            read_contours(old_file) if old_file else empty, read_contours(new_file) if new_file else empty, **kwargs
+        )
+        diff.insert(0, "departement", dep)
+        reports.append(diff)
+        print(
+            f"### {dep or new_path}: {(diff['status'] == 'changed').sum()} changed, {(diff['status'] == 'renumbered').sum()} renumbered, "
+            f"{(diff['status'] == 'added').sum()} added, {(diff['status'] == 'removed').sum()} removed bureaux"
+        )
+    diff = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame(columns=DIFF_COLUMNS)
+    if report is not None:
+        diff.to_csv(report, index=False)
+    return diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the bureaux de vote whose contour changed between two snapshots")
+    parser.add_argument("old", help="directory of the contours of the previous snapshot, or a contour file")
+    parser.add_argument("new", help="directory of the contours of the new snapshot, or a contour file")
+    parser.add_argument("--report", default="diff_report.csv")
+    parser.add_argument("--departements", nargs="*", default=None)
+    parser.add_argument("--id-column", default="id_bv")
+    parser.add_argument("--min-area", type=float, default=1, help="changes below this area (m2) are ignored")
+    args = parser.parse_args()
+    diff_snapshots(
+        args.old, args.new, args.report, args.departements, id_column=args.id_column, min_area=args.min_area
+    )
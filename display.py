@@ -8,14 +8,26 @@ import numpy as np
 import geopandas as gpd
 import geo
 from typing import Dict, List
-
-def prepare_layer_communes(communes: gpd.GeoDataFrame, filled=True) -> pdk.Layer:
+from topology import simplification_levels
+
+# columns of the address table that are shown in the tooltips
+TOOLTIP_COLUMNS = ["id_bv", "nb_addresses", "share_bv", "result_score", "geo_score", "commune_bv", "geo_adresse", "result_label", "adr_complete", "Commune"]
+# columns describing a single address, emptied on the points aggregating several addresses
+ADDRESS_COLUMNS = ["result_score", "geo_score", "geo_adresse", "result_label", "adr_complete"]
+# maximal number of points sent to a map
+MAX_DISPLAYED_POINTS = 50_000
+# suggested `detail_zoom` of the maps: the polygons are simplified to one pixel at this zoom level (about 40 m), see
+# `topology.simplification_levels`. The maps keep the full resolution by default
+DETAIL_ZOOM = 12
+
+def prepare_layer_communes(communes: gpd.GeoDataFrame, filled=True, detail_zoom: int = None) -> pdk.Layer:
     """
     Get a layer with the shapes of the communes
 
     Args:
         communes (gpd.GeoDataFrame): the shapes of the communes, and a column with the citycode
         filled (bool, optional): if True, fills the communes shapes with colours. Defaults to True.
+        detail_zoom (int, optional): the shapes are simplified for this zoom level, neighbouring communes keeping a common border. Defaults to None (the full resolution; DETAIL_ZOOM for lighter maps).
 
     Returns:
         pdk.Layer: a pydeck Layer with the polygonal shapes of the communes
@@ -27,25 +39,29 @@ def prepare_layer_communes(communes: gpd.GeoDataFrame, filled=True) -> pdk.Layer
         col = "result_citycode"
     else:
         col = "insee"
-    displayed = communes.copy()
+    # only the code and the colours are sent to the map, along with the coordinates
+    displayed = pd.DataFrame(index=communes.index)
     # Corsica: remove "a" and "b" in code commune
-    corsica_mask = displayed[col].str.contains("a|b|A|B", regex=True)
-    displayed[col] = displayed[col].str.split("a|b", regex=True, expand=True)
-    displayed = displayed.astype({col: int})
+    displayed[col] = communes[col].astype(str).str.replace("a|b|A|B", "", regex=True).astype(int)
     displayed["color_r"] = 7 * displayed[col] % 255
     displayed["color_g"] = 23 * displayed[col] % 255
     displayed["color_b"] = 67 * displayed[col] % 255
 
+    geometries = communes.geometry
+    if detail_zoom is not None and len(communes):
+        geometries = simplification_levels(communes[[communes.geometry.name]], [detail_zoom])[detail_zoom].geometry
+        # the communes smaller than a pixel are not drawn
+        displayed = displayed.loc[geometries.index]
     coordinates = []
-    for _, row in displayed.iterrows():
+    for geometry in geometries:
         try:
             coord = [
                 [
                     list(x)
                     for x in np.transpose(
                         [
-                            list(row["geometry"].exterior.coords.xy[0]),
-                            list(row["geometry"].exterior.coords.xy[1]),
+                            list(geometry.exterior.coords.xy[0]),
+                            list(geometry.exterior.coords.xy[1]),
                         ]
                     )
                 ]
@@ -59,7 +75,7 @@ def prepare_layer_communes(communes: gpd.GeoDataFrame, filled=True) -> pdk.Layer
 
     return pdk.Layer(
         "PolygonLayer",
-        pd.DataFrame(displayed),
+        displayed,
         pickable=False,
         opacity=0.05,
         stroked=True,
@@ -72,6 +88,91 @@ def prepare_layer_communes(communes: gpd.GeoDataFrame, filled=True) -> pdk.Layer
     )
 
 
+def thin_addresses(
+    addresses: pd.DataFrame,
+    max_points: int = MAX_DISPLAYED_POINTS,
+    zoom: int = None,
+    cell_pixels: int = 4,
+    max_zoom: int = 18,
+) -> pd.DataFrame:
+    """
+    Reduce the number of points to display by binning the addresses on a grid of `cell_pixels` screen pixels at a given zoom level
+    (Web Mercator tiles, as in the map). A cell holding a single address keeps it as is, so that sparse areas keep every point; the addresses
+    of a denser cell are replaced by one point, given to the bureau de vote with the most addresses in the cell and placed at the mean
+    position of its addresses there
+
+    Args:
+        addresses (pd.DataFrame): must include columns "longitude", "latitude" and "id_bv" (and optionally "nb_addresses", the number of addresses of each row)
+        max_points (int, optional): when `zoom` is not given, the finest zoom level giving at most this number of points is used. Defaults to MAX_DISPLAYED_POINTS.
+        zoom (int, optional): the zoom level of the grid. Defaults to None (chosen from `max_points`).
+        cell_pixels (int, optional): size of the cells, in pixels at the zoom level. Defaults to 4.
+        max_zoom (int, optional): the finest zoom level. Defaults to 18.
+
+    Returns:
+        pd.DataFrame: one row per address of the sparse cells, and one row per dense cell; the column "nb_addresses" gives the number of addresses of each point and "share_bv" the share of them belonging to its bureau
+    """
+    longitudes = addresses["longitude"].to_numpy(dtype=float)
+    latitudes = addresses["latitude"].to_numpy(dtype=float)
+    if "nb_addresses" in addresses.columns:
+        weights = addresses["nb_addresses"].to_numpy(dtype=float)
+    else:
+        weights = np.ones(len(addresses))
+    # pixel coordinates at the finest zoom level (Web Mercator)
+    world = 256 * 2**max_zoom
+    sin_latitudes = np.clip(np.sin(np.radians(latitudes)), -0.9999, 0.9999)
+    pixel_x = ((longitudes + 180) / 360 * world).astype(np.int64)
+    pixel_y = ((0.5 - np.log((1 + sin_latitudes) / (1 - sin_latitudes)) / (4 * np.pi)) * world).astype(np.int64)
+
+    def cells(level: int) -> np.ndarray:
+        return pd.factorize(
+            ((pixel_x >> (max_zoom - level)) // cell_pixels) * world + (pixel_y >> (max_zoom - level)) // cell_pixels
+        )[0]
+
+    if zoom is None:
+        zoom = next(
+            (level for level in range(max_zoom, -1, -1) if cells(level).max(initial=-1) < max_points), 0
+        )
+    cell = cells(zoom)
+    rows_per_cell = np.bincount(cell)
+    if (rows_per_cell <= 1).all():
+        return addresses
+
+    # weighted votes of the bureaux in each cell; ties are broken by the smallest id_bv
+    votes = pd.DataFrame(
+        {
+            "cell": cell,
+            "id_bv": addresses["id_bv"].to_numpy(),
+            "weight": weights,
+            "longitude": longitudes * weights,
+            "latitude": latitudes * weights,
+        }
+    ).groupby(["cell", "id_bv"], observed=True, sort=False).sum().reset_index()
+    total = np.bincount(votes["cell"].to_numpy(), weights=votes["weight"].to_numpy())
+    votes = votes.sort_values(["cell", "weight", "id_bv"], ascending=[True, False, True]).drop_duplicates("cell")
+    majority = np.empty(len(rows_per_cell), dtype=object)
+    majority[votes["cell"].to_numpy()] = votes["id_bv"].to_numpy()
+
+    dense = rows_per_cell[cell] > 1
+    sparse_rows = addresses.take(np.flatnonzero(~dense))
+    # the first address of the majority bureau of each dense cell carries the attributes of the point
+    is_majority = dense & (addresses["id_bv"].to_numpy() == majority[cell])
+    dense_cells, first = np.unique(cell[is_majority], return_index=True)
+    dense_rows = addresses.take(np.flatnonzero(is_majority)[first])
+    votes = votes.set_index("cell").loc[dense_cells]
+    dense_rows = dense_rows.assign(
+        longitude=(votes["longitude"] / votes["weight"]).to_numpy(),
+        latitude=(votes["latitude"] / votes["weight"]).to_numpy(),
+        nb_addresses=total[dense_cells],
+        share_bv=(votes["weight"].to_numpy() / total[dense_cells]).round(2),
+        **{col: None for col in ADDRESS_COLUMNS if col in addresses.columns},
+    )
+    thinned = pd.concat(
+        [sparse_rows.assign(nb_addresses=weights[~dense], share_bv=1.0), dense_rows], ignore_index=True
+    )
+    print(f"### {len(addresses)} addresses displayed as {len(thinned)} points (zoom {zoom})")
+    return thinned
+
+
 def prepare_layer_addresses(df: pd.DataFrame) -> pdk.Layer:
     """
     Put a table of addresses on a map
@@ -82,14 +183,15 @@ def prepare_layer_addresses(df: pd.DataFrame) -> pdk.Layer:
     Returns:
         pdk.Layer: every input address is figured with a point on the map
     """
-    data = df.copy()
-    data["radius"] = 6
-    data["coordinates"] = np.array(df[["longitude", "latitude"]]).tolist()
+    # only the columns shown in the tooltip are sent to the map, instead of a copy of the whole table
+    data = df[[col for col in TOOLTIP_COLUMNS if col in df.columns]]
+    # the points aggregating several addresses (see `thin_addresses`) are drawn bigger
+    radius = 6 * np.sqrt(df["nb_addresses"].to_numpy(dtype=float)) if "nb_addresses" in df.columns else 6
+    data = data.assign(radius=radius, coordinates=np.array(df[["longitude", "latitude"]]).tolist())
     #    NB: 7, 23 and 67 are coprime with 255. That implies two voting places in the same city will have the same colors if and only if their id_bv modulo 255 are the same. Moreover, two successive voting places will have rather different colors.
     data["id_bv_r"] = 7 * data["id_bv"] % 255
     data["id_bv_g"] = 23 * data["id_bv"] % 255
     data["id_bv_b"] = 67 * data["id_bv"] % 255
-    data.drop(columns=["latitude", "longitude"], inplace=True, errors="ignore")
     # Define a layer to display on a map
     return pdk.Layer(
         "ScatterplotLayer",
@@ -98,7 +200,7 @@ def prepare_layer_addresses(df: pd.DataFrame) -> pdk.Layer:
         opacity=0.9,
         filled=True,
         radius_min_pixels=1,
-        radius_max_pixels=6,
+        radius_max_pixels=12,
         line_width_min_pixels=2,
         get_position="coordinates",
         get_fill_color=["id_bv_r", "id_bv_g", "id_bv_b"],
@@ -111,40 +213,46 @@ def prepare_layer_polygons(
     geo_addresses: gpd.GeoDataFrame,
     communes: gpd.GeoDataFrame = gpd.GeoDataFrame(),
     mode="voronoi",
+    profiler=None,
+    detail_zoom: int = None,
 ) -> pdk.Layer:
     """
     Draw polygons around the addresses, so that addresses sharing the same bureau de vote are within the same polygon
 
-    :warning: The geometries of the `geo_addresses` must be either MultiPoint (if we want convex hull) or Point (if we want Voronoi cells)
+    :warning: The geometries of the `geo_addresses` must be either MultiPoint (if we want convex hull) or Point (if we want Voronoi cells, concave hulls or the raster preview)
 
     Args:
-        geo_addresses (gpd.GeoDataFrame): must include columns "id_bv" and "result_citycode". The geometries must be shapely Point (in the case of voronoi cells) or MultiPoint (in the case of convex hulls)
+        geo_addresses (gpd.GeoDataFrame): must include columns "id_bv" and "result_citycode". The geometries must be shapely Point (in the case of voronoi cells, concave hulls and raster preview) or MultiPoint (in the case of convex hulls)
         communes (gpd.GeoDataFrame, optional): the shapes of communes, if available
-        mode (str, optional): The way we want to compute polygons around the addresses : can be "convex" or "voronoi". Defaults to "voronoi".
+        mode (str, optional): The way we want to compute polygons around the addresses : can be "convex", "concave" (fast preview, see `geo.concave_hull`), "raster" (approximate Voronoi cells on a grid, requires `communes`, see `raster_preview`) or "voronoi". Defaults to "voronoi".
+        profiler (profiling.RunProfiler, optional): passed to `geo.get_clipped_voronoi_shapes` in "voronoi" mode. Defaults to None.
+        detail_zoom (int, optional): the Voronoi shapes are simplified for this zoom level, neighbouring bureaux keeping a common border. Defaults to None (the full resolution; DETAIL_ZOOM for lighter maps).
 
     Returns:
         pdk.Layer: calculated bureau de vote shapes are figured with polygons on the map
     """
     assert mode.lower() in [
         "convex",
+        "concave",
+        "raster",
         "voronoi",
-    ], "the implemented methods are voronoi cells or convex hulls"
+    ], "the implemented methods are voronoi cells, convex hulls, concave hulls or raster preview"
+    assert mode.lower() != "raster" or len(communes), "the raster preview needs the shapes of the communes"
     mode = mode.lower()
 
     coordinates = []
 
     if mode == "convex":
-        displayed = geo_addresses.copy()
-        displayed["hulls"] = geo.convex_hull(displayed)
-        for _, row in displayed.iterrows():
+        displayed = pd.DataFrame({"id_bv": geo_addresses["id_bv"].to_numpy()})
+        for hull in geo.convex_hull(geo_addresses):
             try:
                 coord = [
                     [
                         list(x)
                         for x in np.transpose(
                             [
-                                list(row["hulls"].exterior.coords.xy[0]),
-                                list(row["hulls"].exterior.coords.xy[1]),
+                                list(hull.exterior.coords.xy[0]),
+                                list(hull.exterior.coords.xy[1]),
                             ]
                         )
                     ]
@@ -154,10 +262,22 @@ def prepare_layer_polygons(
                 # print(e)
                 coordinates.append([])
                 pass
-        displayed.drop(columns=["geometry", "hulls"], inplace=True)
 
-    elif mode == "voronoi":
-        hulls = geo.get_clipped_voronoi_shapes(geo_addresses, communes)
+    else:
+        if mode == "voronoi":
+            hulls = geo.get_clipped_voronoi_shapes(geo_addresses, communes, profiler=profiler)
+        else:
+            if mode == "raster":
+                # the KD-tree backend (scipy) is only loaded for this mode
+                from raster_preview import raster_preview_shapes
+
+                hulls = raster_preview_shapes(geo_addresses, communes)
+            else:
+                hulls = geo.concave_hull(geo_addresses, communes)
+            # the parts of the clipped hulls are drawn as separate polygons
+            hulls = hulls.explode(index_parts=False).reset_index(drop=True)
+        if detail_zoom is not None and len(hulls):
+            hulls = simplification_levels(hulls, [detail_zoom])[detail_zoom]
         id_bvs = []
         for _, row in hulls.iterrows():
             id_bvs.append(row["id_bv"])
@@ -210,7 +330,7 @@ def prepare_tooltip(columns: List[str]) -> Dict:
         Dict: _description_
     """
     legend = ""
-    for col in ["id_bv", "result_score", "geo_score", "commune_bv", "geo_adresse", "result_label", "adr_complete", "Commune"]:
+    for col in TOOLTIP_COLUMNS:
         if col in columns:
             legend += f"{col}: "+"{"+f"{col}"+"} \n" 
     tooltip = {
@@ -220,21 +340,28 @@ def prepare_tooltip(columns: List[str]) -> Dict:
 
 
 def display_addresses(
-    addresses: pd.DataFrame, communes: gpd.GeoDataFrame = gpd.GeoDataFrame()
+    addresses: pd.DataFrame,
+    communes: gpd.GeoDataFrame = gpd.GeoDataFrame(),
+    max_points: int = MAX_DISPLAYED_POINTS,
+    detail_zoom: int = None,
 ) -> pdk.Deck:
     """
-    Display a map with one point per address
+    Display a map with one point per address (in dense areas, one point per group of neighbouring addresses, see `thin_addresses`)
 
     Args:
         addresses (pd.DataFrame): _description_
         communes (gpd.GeoDataFrame, optional): the shapes of communes, if available
+        max_points (int, optional): above this number of addresses, the addresses are thinned. Defaults to MAX_DISPLAYED_POINTS (None to display every address).
+        detail_zoom (int, optional): the level of detail of the shapes of the communes (see `prepare_layer_communes`). Defaults to None (the full resolution).
 
     Returns:
         pdk.Deck: _description_
     """
+    if max_points is not None and len(addresses) > max_points:
+        addresses = thin_addresses(addresses, max_points=max_points)
     addresses_layer = prepare_layer_addresses(addresses)
     if len(communes):
-        layers = [prepare_layer_communes(communes), addresses_layer]
+        layers = [prepare_layer_communes(communes, detail_zoom=detail_zoom), addresses_layer]
     else:
         layers = [addresses_layer]
 
@@ -256,6 +383,9 @@ def display_bureau_vote_shapes(
     addresses: pd.DataFrame,
     communes: gpd.GeoDataFrame = gpd.GeoDataFrame(),
     mode="voronoi",
+    profiler=None,
+    max_points: int = MAX_DISPLAYED_POINTS,
+    detail_zoom: int = None,
 ) -> pdk.Deck:
     """
     Display on the same map the addresses and the corresponding interpolated bureau de vote shapes
@@ -263,24 +393,30 @@ def display_bureau_vote_shapes(
     Args:
         addresses (pd.DataFrame): must include columns 'Commune' (strings), 'adr_complete' (strings), 'result_score' (floats), 'result_label' (strings), 'latitude' (floats), 'longitude' (floats)
         communes (gpd.GeoDataFrame, optional): the shapes of communes, if available
-        mode (str, optional): The way we want to compute polygons around the addresses : can be "convex" or "voronoi". Defaults to "voronoi".
+        mode (str, optional): The way we want to compute polygons around the addresses : can be "convex", "concave", "raster" or "voronoi". Defaults to "voronoi".
+        profiler (profiling.RunProfiler, optional): records per-stage and per-commune timings of the "voronoi" computation. Defaults to None.
+        max_points (int, optional): above this number of addresses, the displayed addresses are thinned (the shapes are computed from every address). Defaults to MAX_DISPLAYED_POINTS.
+        detail_zoom (int, optional): the level of detail of the displayed shapes (see `prepare_layer_polygons`). Defaults to None (the full resolution).
 
     Returns:
         pdk.Deck: pydeck with layers 'addresses' (one point per adress), 'communes' (one shape per commune), 'polygons' (one shape per bureau de vote, with the commune)
     """
-    assert mode.lower() in ["convex", "voronoi"]
+    assert mode.lower() in ["convex", "concave", "raster", "voronoi"]
     mode = mode.lower()
 
     if mode == "convex":
         geojson = geo.build_geojson_multipoint(addresses)
-    elif mode == "voronoi":
+    else:
         geojson = geo.build_geojson_point(addresses)
 
-    geojson.drop_duplicates(subset=["geometry"], inplace=True)
-    polygons_layer = prepare_layer_polygons(geojson, mode=mode, communes=communes)
+    polygons_layer = prepare_layer_polygons(
+        geojson, mode=mode, communes=communes, profiler=profiler, detail_zoom=detail_zoom
+    )
+    if max_points is not None and len(addresses) > max_points:
+        addresses = thin_addresses(addresses, max_points=max_points)
 
     if len(communes):
-        communes_layers = prepare_layer_communes(communes, filled=False)
+        communes_layers = prepare_layer_communes(communes, filled=False, detail_zoom=detail_zoom)
         layers = [communes_layers, polygons_layer, prepare_layer_addresses(addresses)]
     else:
         layers = [
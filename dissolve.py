@@ -0,0 +1,154 @@
+"""
+Dissolve the contours of the bureaux de vote (the output of `geo.get_clipped_voronoi_shapes`) into higher-level layers: communes, cantons
+and circonscriptions législatives, from a table mapping each bureau to its higher-level units.
+
+The layers are computed in one pass: the bureaux are first dissolved once per combination of units (the pieces of the communes split
+between several cantons or circonscriptions), and each layer is then dissolved from these pieces, so that every bureau is only unioned
+once. Since the contours tile the communes, the groups are dissolved by removing their shared edges (`shapely.coverage_union_all`) instead
+of an overlay union, which is faster and leaves no sliver along the shared edges. Groups whose contours are not an exact coverage fall back
+to a union snapped on a fine grid. The groups are dissolved in parallel.
+
+Usage:
+    python dissolve.py geojson/voronoi_contours_09.parquet bureaux_09.csv --output-dir layers/
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from contour_io import open_contour_writer, read_contours
+from geo import BORDER_GRID_SIZE
+
+DISSOLVE_LEVELS = ["commune", "canton", "circonscription"]
+# relative difference between the area of a coverage union and the sum of the areas of its parts, above which the parts overlap
+COVERAGE_TOLERANCE = 1e-9
+
+
+def dissolve_group(geometries: np.ndarray) -> shapely.Geometry:
+    """
+    Union of polygons that tile a region: shared-edge removal when they form a valid coverage, otherwise a union snapped on a grid of
+    BORDER_GRID_SIZE (the edges of the neighbouring polygons then merge instead of leaving slivers)
+    """
+    geometries = geometries[~shapely.is_missing(geometries) & ~shapely.is_empty(geometries)]
+    if len(geometries) == 1:
+        return geometries[0]
+    try:
+        union = shapely.coverage_union_all(geometries)
+        area = shapely.area(geometries).sum()
+        if shapely.is_valid(union) and abs(shapely.area(union) - area) <= COVERAGE_TOLERANCE * area:
+            return union
+    except shapely.errors.GEOSException:
+        pass
+    return shapely.union_all(shapely.make_valid(geometries), grid_size=BORDER_GRID_SIZE)
+
+
+def _dissolve_groups(groups: List[np.ndarray]) -> List[shapely.Geometry]:
+    return [dissolve_group(group) for group in groups]
+
+
+def _dissolve(
+    geometries: np.ndarray, codes: np.ndarray, workers: int = None, chunk_size: int = 50
+) -> np.ndarray:
+    """
+    Dissolve the geometries by group (`codes`, from 0 to the number of groups - 1), the groups being sorted once and dissolved in parallel
+
+    Returns:
+        np.ndarray: one geometry per group
+    """
+    order = np.argsort(codes, kind="stable")
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    groups = np.split(geometries[order], starts[1:])
+    chunks = [groups[start:start + chunk_size] for start in range(0, len(groups), chunk_size)]
+    if workers == 1:
+        results = [geometry for chunk in chunks for geometry in _dissolve_groups(chunk)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = [geometry for result in executor.map(_dissolve_groups, chunks) for geometry in result]
+    return np.array(results, dtype=object)
+
+
+def dissolve_levels(
+    shapes: gpd.GeoDataFrame,
+    mapping: pd.DataFrame,
+    levels: List[str] = DISSOLVE_LEVELS,
+    id_column: str = "id_bv",
+    workers: int = None,
+    chunk_size: int = 50,
+) -> Dict[str, gpd.GeoDataFrame]:
+    """
+    Dissolve the contours of the bureaux into one layer per level
+
+    Args:
+        shapes (gpd.GeoDataFrame): the contours of the bureaux, with column `id_column` (several rows per bureau are allowed) and optionally "result_citycode"
+        mapping (pd.DataFrame): one row per bureau, with column `id_column` and one column per level. When the level "commune" is missing from the table, the column "result_citycode" of `shapes` is used
+        levels (List[str], optional): the levels, from the finest to the coarsest. Defaults to DISSOLVE_LEVELS.
+        id_column (str, optional): Defaults to "id_bv".
+        workers (int, optional): number of processes. Defaults to None (the number of CPUs), 1 to run in the current process.
+        chunk_size (int, optional): number of groups sent at once to a process. Defaults to 50.
+
+    Returns:
+        Dict[str, gpd.GeoDataFrame]: for each level, one row per unit with columns `level`, "n_bureaux" and "geometry"
+    """
+    shapes = shapes[shapes.geometry.notna() & ~shapes.geometry.is_empty]
+    mapping = mapping.drop_duplicates(id_column).set_index(id_column)
+    units = pd.DataFrame(index=shapes.index)
+    for level in levels:
+        if level in mapping.columns:
+            units[level] = shapes[id_column].map(mapping[level]).to_numpy()
+        else:
+            assert level == "commune" and "result_citycode" in shapes.columns, f"the level {level} is missing from the mapping"
+            units[level] = shapes["result_citycode"].to_numpy()
+        missing = units[level].isna().sum()
+        if missing:
+            print(f"### {missing} contours without {level}")
+
+    # the pieces: one union per combination of units, from which all the layers are dissolved
+    piece_codes = units.groupby(levels, dropna=False, sort=False).ngroup().to_numpy()
+    _, first = np.unique(piece_codes, return_index=True)
+    pieces_units = units.iloc[first].reset_index(drop=True)
+    pieces = _dissolve(shapes.geometry.to_numpy(), piece_codes, workers=workers, chunk_size=chunk_size)
+    bureaux = shapes[id_column].groupby(piece_codes).nunique().to_numpy()
+
+    layers = {}
+    for level in levels:
+        known = np.flatnonzero(pieces_units[level].notna().to_numpy())
+        codes, names = pd.factorize(pieces_units[level].to_numpy()[known])
+        layers[level] = gpd.GeoDataFrame(
+            {level: np.asarray(names), "n_bureaux": np.bincount(codes, weights=bureaux[known], minlength=len(names)).astype(int)},
+            geometry=_dissolve(pieces[known], codes, workers=workers, chunk_size=chunk_size) if len(known) else [],
+            crs=shapes.crs,
+        )
+        print(f"### {level}: {len(layers[level])} shapes")
+    return layers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dissolve the contours of the bureaux into commune, canton and circonscription layers")
+    parser.add_argument("contours", help="the contours of the bureaux, e.g. geojson/voronoi_contours_09.parquet")
+    parser.add_argument("mapping", help="CSV or parquet table mapping each bureau to its higher-level units")
+    parser.add_argument("--levels", nargs="*", default=DISSOLVE_LEVELS)
+    parser.add_argument("--id-column", default="id_bv")
+    parser.add_argument("--output-dir", default="layers/")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    contours = read_contours(args.contours)
+    if args.mapping.endswith(".parquet"):
+        mapping_df = pd.read_parquet(args.mapping)
+    else:
+        mapping_df = pd.read_csv(args.mapping, dtype=str)
+    # the ids are compared as strings, whatever the format of both files
+    contours[args.id_column] = contours[args.id_column].astype(str)
+    mapping_df[args.id_column] = mapping_df[args.id_column].astype(str)
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = os.path.basename(args.contours)
+    for level_name, layer in dissolve_levels(
+        contours, mapping_df, levels=args.levels, id_column=args.id_column, workers=args.workers
+    ).items():
+        with open_contour_writer(os.path.join(args.output_dir, f"{level_name}_{name}")) as writer:
+            writer.write(layer)
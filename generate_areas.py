@@ -2,10 +2,9 @@
 # coding: utf-8
 
 import os
-import pandas as pd
 import geopandas as gpd
-from display import *
-import re
+from display import display_addresses, display_bureau_vote_shapes
+from loader import compact_id_bv, read_addresses
 
 # display just a departement/drom/com
 DEP_LIST = ["0"+str(i) for i in range(1,10)]+[str(i) for i in range(10,19)]+["2A","2B"]+[str(i) for i in range(21,96)] + [str(i) for i in range(971,977)]
@@ -21,17 +20,17 @@ for DEP in DEP_LIST:
 
     addresses_path = f"parquet/table_{DEP}.parquet"
 
-    # for this departement, determine the radio of addresses you want to plot
-    RATIO = 0.4 # 0 <= RATIO <= 1
+    # maximal number of points on the maps: in dense areas, neighbouring addresses are aggregated (see `display.thin_addresses`)
+    MAX_POINTS = 50_000
 
     # ## Loading the address file, and a file with the shape of communes.
     # ##### Warning: these files are heavy
 
-    df = pd.read_parquet(addresses_path)
+    df = read_addresses(addresses_path)
     # if id_brut_bv is not None, condition below should always be True
     if "id_bv" not in df.columns:
-        pat = re.compile(r"\d+")
-        df["id_bv"] = df["id_brut_bv"].apply(lambda row : int("".join(re.findall(pat, row))))
+        # concatenation of all the digits of id_brut_bv
+        df["id_bv"] = compact_id_bv(df["id_brut_bv"].astype(str).str.replace(r"\D+", "", regex=True))
 
 
     print(f"LOAD data in memory: {len(df)} rows")
@@ -41,8 +40,6 @@ for DEP in DEP_LIST:
 
     # add this unofficiel "id_bv" field id to recognize and to determine the color of id fields
 
-
-    #df_dep = df[df.dep_bv==DEP].sample(frac=RATIO, random_state=0)
     os.makedirs("html/dep", exist_ok=True)
     os.makedirs("html/bv", exist_ok=True)
 
@@ -56,14 +53,12 @@ for DEP in DEP_LIST:
             r_voronoi_bv.to_html(f"html/bv/voronoi_bv_{raw_id_bv}.html")
 
         
-    df_dep = df.sample(frac=RATIO, random_state=0)
-    
     print("Going to display addresses")
-    r = display_addresses(addresses=df_dep, communes=communes_dep)
-    r.to_html(f"html/dep/scatterplot_{DEP}_layer_ratio_{RATIO}.html")
+    r = display_addresses(addresses=df, communes=communes_dep, max_points=MAX_POINTS)
+    r.to_html(f"html/dep/scatterplot_{DEP}_layer.html")
 
-    r_voronoi = display_bureau_vote_shapes(addresses=df_dep, communes=communes_dep, mode="voronoi")
-    r_voronoi.to_html(f"html/dep/voronoi_{DEP}_layer_ratio_{RATIO}.html")
+    r_voronoi = display_bureau_vote_shapes(addresses=df, communes=communes_dep, mode="voronoi", max_points=MAX_POINTS)
+    r_voronoi.to_html(f"html/dep/voronoi_{DEP}_layer.html")
     
 
 
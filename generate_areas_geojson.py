@@ -5,10 +5,26 @@ import os
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-from shapely import Polygon
-from geo import build_geojson_point, get_clipped_voronoi_shapes
+import pyarrow.parquet as pq
+import shapely
+from geo import build_geojson_point, get_clipped_voronoi_shapes, resolve_plm
+from loader import read_addresses
+from contour_io import open_contour_writer
+from profiling import NULL_PROFILER, RunProfiler
+from streaming import iter_commune_groups
 pd.set_option('display.max_columns', None)
 
+# format of the outputs: "geojson", "geojsonl" (GeoJSON sequence), "parquet" (GeoParquet), "fgb" (FlatGeobuf) or "topojson"
+OUTPUT_FORMAT = "geojson"
+# encoding of the geometries of the "parquet" output: "WKB", or "geoarrow" (written from the coordinate arrays, see `arrow_geometry`)
+GEOMETRY_ENCODING = "geoarrow"
+# write a JSON run report per departement (timings, peak memory, slowest communes, repair fallbacks) in reports/
+PROFILE = False
+# the contours are computed by groups of communes with at most this number of distinct address points
+MAX_POINTS_PER_GROUP = 200_000
+# number of processes tessellating the tiles of the largest communes (see `geo.MAX_TILE_POINTS`), None for the number of CPUs
+TILE_WORKERS = None
+
 DEP_LIST = [
     "0"+str(i) for i in range(1, 10)
 ]+[
@@ -18,73 +34,88 @@ DEP_LIST = [
 ] + [
     str(i) for i in range(971, 977)
 ]
-commune_shapes_path = "./../communes-5m.geojson"
-communes_france = gpd.read_file(commune_shapes_path)
-communes_france = communes_france.rename(
-    {'code': 'insee'}, axis=1
-)[['insee', 'geometry']]
 
-for DEP in DEP_LIST:
-    print(DEP)
-    if f"voronoi_contours_{DEP}.geojson" not in os.listdir("geojson/"):
-        communes_dep = communes_france[communes_france.insee.str.startswith(str(DEP))]
-        codes2drop = ('13055', '75056', '69123')
-        communes_dep = communes_dep.loc[~(communes_dep['insee'].str.startswith(codes2drop))]
+if __name__ == '__main__':
+    commune_shapes_path = "./../communes-5m.geojson"
+    communes_france = gpd.read_file(commune_shapes_path)
+    communes_france = communes_france.rename(
+        {'code': 'insee'}, axis=1
+    )[['insee', 'geometry']]
 
-        addresses_path = f"parquet/table_{DEP}.parquet"
+    for DEP in DEP_LIST:
+        print(DEP)
+        if f"voronoi_contours_{DEP}.{OUTPUT_FORMAT}" not in os.listdir("geojson/"):
+            communes_dep = communes_france[communes_france.insee.str.startswith(str(DEP))]
 
-        addresses_df = pd.read_parquet(addresses_path)
-        # The lines below creates an (unofficial) identifier of bureau de vote
-        # We use it in this code mostly for displaying purposes
-        addresses_df['id_bv'] = addresses_df['id_brut_bv']
-        addresses_df['commune_bv'] = addresses_df['code_commune_ref']
+            addresses_path = f"parquet/table_{DEP}.parquet"
 
-        print(f"LOAD dep {DEP} in memory: {len(addresses_df)} rows")
-        geo_addresses = build_geojson_point(addresses_df)
-        hulls = get_clipped_voronoi_shapes(geo_addresses, communes_dep)
-        id_bvs = []
-        coordinates = []
-        # the block below just aims at formatting
-        # the cordinates into a list of [x, y]
-        exceptions = []
-        for _, row in hulls.iterrows():
-            id_bvs.append(row["id_bv"])
-            try:
-                coord = Polygon(
-                    [
-                        list(x)
-                        for x in np.transpose(
-                            [
-                                list(row["geometry"].exterior.coords.xy[0]),
-                                list(row["geometry"].exterior.coords.xy[1]),
-                            ]
-                        )
-                    ]
-                )
-                coordinates.append(coord)
-            except Exception as e:
-                exceptions.append({
-                    'error': e,
-                    'row': row
-                })
-                coordinates.append([])
-                pass
+            # only the columns needed by the geometry work are loaded (with the Lambert-93 coordinates when the extract has them)
+            columns = ["id_brut_bv", "code_commune_ref", "longitude", "latitude"]
+            columns += [col for col in ["X", "Y"] if col in pq.read_schema(addresses_path).names]
+            addresses_df = read_addresses(addresses_path, columns=columns)
+            # The lines below creates an (unofficial) identifier of bureau de vote
+            # We use it in this code mostly for displaying purposes
+            addresses_df['id_bv'] = addresses_df['id_brut_bv']
+            addresses_df['commune_bv'] = addresses_df['code_commune_ref']
 
-        voronoi_polygons = gpd.GeoDataFrame(
-            pd.DataFrame(data={"coordinates": coordinates, "id_bv": id_bvs}),
-            geometry='coordinates'
-        )
-        # handling overlaps
-        for main_idx in voronoi_polygons.index:
-            for side_idx in voronoi_polygons.index:
-                if main_idx != side_idx:
-                    if voronoi_polygons.loc[main_idx, 'coordinates'].contains(voronoi_polygons.loc[side_idx, 'coordinates']):
-                        voronoi_polygons.loc[main_idx, 'coordinates'] = voronoi_polygons.loc[main_idx, 'coordinates'].difference(voronoi_polygons.loc[side_idx, 'coordinates'])
-        # grouping polygons into multipolygons for each BdV
-        voronoi_polygons = voronoi_polygons.dissolve('id_bv').reset_index(names='id_bv').reset_index(names='id')
-        # int id as requested for downstream processes
-        voronoi_polygons['id'] = voronoi_polygons['id'].astype(int)
-        with open(f"geojson/voronoi_contours_{DEP}.geojson", 'w') as f:
-            f.write(voronoi_polygons.to_json())
-    else:
-        print("Already processed")
+            print(f"LOAD dep {DEP} in memory: {len(addresses_df)} rows")
+            profiler = RunProfiler(DEP) if PROFILE else NULL_PROFILER
+            with profiler.stage("build_geojson_point") as counts:
+                geo_addresses = build_geojson_point(addresses_df)
+                counts.update(n_addresses=len(addresses_df), n_points=len(geo_addresses))
+            # Paris, Marseille and Lyon: one set of shapes (whole city or arrondissements) matching the codes of the addresses
+            geo_addresses, communes_dep = resolve_plm(geo_addresses, communes_dep)
+            del addresses_df
+            n_contours = 0
+            # streamed by batches to a temporary file, moved to its final name once complete
+            with open_contour_writer(
+                f"geojson/voronoi_contours_{DEP}.{OUTPUT_FORMAT}", geometry_encoding=GEOMETRY_ENCODING
+            ) as writer:
+                # the contours are computed by groups of whole communes: only one group is in memory at a time
+                for points_group, communes_group in iter_commune_groups(
+                    geo_addresses, communes_dep, max_points=MAX_POINTS_PER_GROUP
+                ):
+                    hulls = get_clipped_voronoi_shapes(
+                        points_group, communes_group, profiler=profiler, workers=TILE_WORKERS
+                    )
+                    # the exterior ring of each Polygon, in bulk (the Points of the bureaux with a single address become empty polygons)
+                    polygonal = shapely.get_type_id(hulls.geometry.values) == shapely.GeometryType.POLYGON
+                    coordinates = np.full(len(hulls), shapely.Polygon(), dtype=object)
+                    coordinates[polygonal] = shapely.polygons(shapely.get_exterior_ring(hulls.geometry.values[polygonal]))
+                    voronoi_polygons = gpd.GeoDataFrame(
+                        pd.DataFrame(data={"coordinates": coordinates, "id_bv": hulls["id_bv"].to_numpy()}),
+                        geometry='coordinates'
+                    )
+                    # handling overlaps: a polygon that contains other polygons is cut by them
+                    with profiler.stage("handling_overlaps") as counts:
+                        containers, contained = voronoi_polygons.sindex.query(coordinates, predicate="contains")
+                        # identical polygons contain each other: as in the former pairwise loop, only the copy with the lower index is
+                        # cut, the one with the higher index is kept
+                        keep = (containers < contained) | (
+                            (containers > contained) & ~shapely.equals(coordinates[containers], coordinates[contained])
+                        )
+                        contained, containers = contained[keep], containers[keep]
+                        if len(containers):
+                            holes = pd.Series(coordinates[contained]).groupby(containers).agg(
+                                lambda parts: shapely.union_all(parts.to_numpy())
+                            )
+                            coordinates[holes.index] = shapely.difference(coordinates[holes.index], holes.to_numpy())
+                            voronoi_polygons = voronoi_polygons.set_geometry(coordinates)
+                        counts.update(n_polygons=len(voronoi_polygons), n_formatting_errors=int((~polygonal).sum()))
+                    # grouping polygons into multipolygons for each BdV
+                    voronoi_polygons = voronoi_polygons.dissolve('id_bv').reset_index(names='id_bv').reset_index(names='id')
+                    # int id as requested for downstream processes, unique over the groups of communes
+                    voronoi_polygons['id'] = voronoi_polygons['id'].astype(int) + n_contours
+                    # the index is the top-level "id" of the GeoJSON features: the same as the "id" property, as with `to_json()`
+                    voronoi_polygons.index = voronoi_polygons['id'].to_numpy()
+                    # the ids of a group follow those of the previous groups, so that they stay unique over the file
+                    assert voronoi_polygons.index.is_unique and voronoi_polygons.index.min() >= n_contours
+                    n_contours += len(voronoi_polygons)
+                    with profiler.stage("write_contours") as counts:
+                        writer.write(voronoi_polygons)
+                        counts.update(n_features=len(voronoi_polygons))
+            if PROFILE:
+                os.makedirs("reports", exist_ok=True)
+                profiler.to_json(f"reports/run_report_{DEP}.json")
+        else:
+            print("Already processed")
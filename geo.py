@@ -5,55 +5,142 @@ import pandas as pd
 import os
 import numpy as np
 import geopandas as gpd
-import pytess
-from typing import List
-from shapely.geometry import Polygon, Point
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List, Tuple, Union
+import pyarrow as pa
+from pyproj import Transformer
+import shapely
 from shapely import make_valid
-import requests
-
-
-def add_geoloc(df: pd.DataFrame) -> pd.DataFrame:
+from arrow_geometry import arrow_to_frame
+from profiling import NULL_PROFILER
+
+# metric CRS of the départements d'outre-mer (RGAF09, RGFG95, RGR92, RGSPM06 and RGM04 UTM zones), Lambert-93 elsewhere
+PROJECTED_CRS = {
+    "971": "EPSG:5490",
+    "972": "EPSG:5490",
+    "973": "EPSG:2972",
+    "974": "EPSG:2975",
+    "975": "EPSG:4467",
+    "976": "EPSG:4471",
+}
+# margin around each commune of the domain of its Voronoi cells, large enough for the points geocoded slightly outside of the commune
+VORONOI_BUFFER_METERS = 1000
+# communes with more distinct address points are tessellated by tiles
+MAX_TILE_POINTS = 20_000
+# Paris, Marseille and Lyon, and the prefix of the codes of their arrondissements municipaux
+PLM_ARRONDISSEMENTS = {"75056": "751", "13055": "132", "69123": "6938"}
+# secondary parts of a bureau smaller than this area, or with fewer addresses, are merged into a neighbouring bureau
+MIN_FRAGMENT_AREA_M2 = 1000
+MIN_FRAGMENT_ADDRESSES = 3
+# grid (in degrees, about 1 cm) on which the borders are snapped when measuring their shared length
+BORDER_GRID_SIZE = 1e-7
+# approximate conversion of areas from square degrees to square meters
+METERS_PER_DEGREE_LAT = 110540
+METERS_PER_DEGREE_LON = 111320
+
+
+def add_geoloc(df: pd.DataFrame, directory: str = ".") -> pd.DataFrame:
     """
     Locally save the raw base of addresses and call the API-adresse to geocode them (in particular: add coordinates and found city)
 
     Args:
         df (pd.DataFrame): a file with columns "geo_adresse" ((street number +) street type + street name/locality name), "Commune" (commune name), "CP" (postcode)
+        directory (str, optional): where the CSV files sent to and received from the API are written. Defaults to ".".
 
     Returns:
         pd.DataFrame: a dataframe with the input columns, and also latitudes, longitudes, result_postcode, result_citycode, etc.
     """
-    df.to_csv("concat_adr_bv.csv", index=False)
+    # the network client is only loaded when geocoding, the contour computations do not need it
+    import requests
+    from loader import read_addresses
+
+    sent_path = os.path.join(directory, "concat_adr_bv.csv")
+    geocoded_path = os.path.join(directory, "concat_adr_bv_geocoded.csv")
+    df.to_csv(sent_path, index=False)
     # os.system(
     #     "curl -X POST -F data=@concat_adr_bv.csv -F columns=adr_complete -F columns=Commune -F postcode=CP https://api-adresse.data.gouv.fr/search/csv/ > concat_adr_bv_geocoded.csv"
     # )
-    f = open('concat_adr_bv.csv', 'rb')
+    f = open(sent_path, 'rb')
     files = {'data': ('concat_adr_bv', f)}
     payload = {'columns': ['geo_adresse', 'Commune'], 'postcode': 'CP'}
     r = requests.post('https://api-adresse.data.gouv.fr/search/csv/', files=files, data=payload, stream=True)
-    with open('concat_adr_bv_geocoded.csv', 'wb') as fd:
+    with open(geocoded_path, 'wb') as fd:
         for chunk in r.iter_content(chunk_size=1024):
             fd.write(chunk)
 
-    geocoded = pd.read_csv("concat_adr_bv_geocoded.csv", dtype=str)
-    geocoded["latitude"] = geocoded["latitude"].astype(float)
-    geocoded["longitude"] = geocoded["longitude"].astype(float)
-    geocoded["result_score"] = geocoded["result_score"].astype(float)
-    geocoded = geocoded[geocoded["result_label"].notna()]
-    return geocoded
+    geocoded = read_addresses(geocoded_path, sep=",")
+    return geocoded.take(np.flatnonzero(geocoded["result_label"].notna()))
 
 
-def build_geojson_point(addresses: pd.DataFrame) -> gpd.GeoDataFrame:
+def _area_m2(geometries: np.ndarray) -> np.ndarray:
     """
-    Turn the dataframes with coordinates into a GeoDataFrame containing a Point object for each address
-    NB: when there is several addresses at the same point, the function keeps only one sample
+    Approximate area in square meters of geometries in longitude/latitude (equirectangular projection at their centroid)
+    """
+    latitudes = shapely.get_y(shapely.centroid(geometries))
+    return (
+        shapely.area(geometries)
+        * np.cos(np.radians(latitudes))
+        * METERS_PER_DEGREE_LON
+        * METERS_PER_DEGREE_LAT
+    )
+
+
+def deduplicate_points(
+    addresses: pd.DataFrame, precision: int = 6, weight_column: str = None
+) -> pd.DataFrame:
+    """
+    Keep one row per distinct position (coordinates rounded to `precision` decimals), working on the coordinate arrays.
+    When several bureaux de vote share a position, the position is given to the bureau with the most addresses there (ties are broken by the smallest "id_bv"), so that the result is deterministic
 
     Args:
-        addresses (pd.DataFrame): a dataframe that have already been processed with API-adresse, and that also contain ids for bureau de vote (function `cleaner.prepare_ids`)
+        addresses (pd.DataFrame): must include columns "longitude", "latitude" and "id_bv"
+        precision (int, optional): number of decimals kept on the coordinates (6 decimals is about 10 cm). Defaults to 6.
+        weight_column (str, optional): a column giving the number of voters of each row. Defaults to None (each row counts for one).
+
     Returns:
-        gpd.GeoDataFrame: includes columns: "geometry" (shapely Point), "result_citycode" (as string), "label" (commune name, as string) and "id_bv" (unique id we impose per bureau de vote, int)
+        pd.DataFrame: one row per position (the first row of the majority bureau), with rounded coordinates and a supplementary column "nb_addresses" (number of addresses, or sum of weights, at this position)
     """
+    keys = pd.DataFrame(
+        {
+            "longitude": np.round(addresses["longitude"].to_numpy(dtype=float), precision),
+            "latitude": np.round(addresses["latitude"].to_numpy(dtype=float), precision),
+            "id_bv": addresses["id_bv"].to_numpy(),
+            "position": np.arange(len(addresses)),
+            "weight": 1 if weight_column is None else addresses[weight_column].to_numpy(),
+        }
+    )
+    per_bv = (
+        keys.groupby(["longitude", "latitude", "id_bv"], sort=False, observed=True)
+        .agg(weight=("weight", "sum"), position=("position", "min"))
+        .reset_index()
+    )
+    per_bv["nb_addresses"] = per_bv.groupby(["longitude", "latitude"], sort=False)["weight"].transform("sum")
+    majority = (
+        per_bv.sort_values(["weight", "id_bv"], ascending=[False, True], kind="mergesort")
+        .drop_duplicates(subset=["longitude", "latitude"])
+        .sort_values("position")
+    )
+    unique = addresses.take(majority["position"].to_numpy())
+    unique["longitude"] = majority["longitude"].to_numpy()
+    unique["latitude"] = majority["latitude"].to_numpy()
+    unique["nb_addresses"] = majority["nb_addresses"].to_numpy()
+    return unique
 
-    geojson = {"type": "FeatureCollection", "features": []}
+
+def build_geojson_point(addresses: Union[pd.DataFrame, pa.Table], precision: int = 6) -> gpd.GeoDataFrame:
+    """
+    Turn the dataframes with coordinates into a GeoDataFrame containing a Point object for each address
+    NB: when there is several addresses at the same point, the function keeps only one sample (see `deduplicate_points`)
+
+    Args:
+        addresses (pd.DataFrame or pa.Table): a dataframe that have already been processed with API-adresse, and that also contain ids for bureau de vote (function `cleaner.prepare_ids`). An Arrow table (e.g. read from a département parquet file) may hold the coordinates as "longitude"/"latitude" columns or as a GeoArrow point column, it is converted without per-row Python objects (see `arrow_geometry.arrow_to_frame`)
+        precision (int, optional): number of decimals of the coordinates used to detect duplicates. Defaults to 6.
+    Returns:
+        gpd.GeoDataFrame: includes columns: "geometry" (shapely Point), "result_citycode" (as string), "label" (commune name, as string), "id_bv" (unique id we impose per bureau de vote, int) and "nb_addresses" (number of addresses at this point), and "x", "y" when the addresses have the Lambert-93 coordinates "X", "Y" of the REU extract
+    """
+    if isinstance(addresses, pa.Table):
+        addresses = arrow_to_frame(addresses)
     if "result_label" in addresses.columns:
         label_col = "result_label"
     else:
@@ -62,29 +149,29 @@ def build_geojson_point(addresses: pd.DataFrame) -> gpd.GeoDataFrame:
         code_col = "result_citycode"
     else:
         code_col = "code_commune_ref"
-    for _, row in addresses.iterrows():
-        if row[label_col]:
-            props = {
-                "label": row[label_col],
-                "id_bv": row["id_bv"],
-                "result_citycode": row[code_col],
-            }
-            geojson["features"].append(
-                {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [
-                            float(row["longitude"]),
-                            float(row["latitude"]),
-                        ],
-                    },
-                    "properties": props,
-                }
-            )
-    gdf = gpd.GeoDataFrame.from_features(geojson)
+    # rows with an empty or missing label ("" or None) are ignored
+    labels = addresses[label_col]
+    addresses = addresses.take(np.flatnonzero((labels.notna() & (labels.astype(object) != "")).to_numpy()))
     # IMPORTANT: when there is several addresses at the same point keep only one sample
-    return gdf.drop_duplicates(subset=["geometry"])
+    unique = deduplicate_points(addresses, precision=precision)
+    data = {
+        "label": unique[label_col].to_numpy(),
+        "id_bv": unique["id_bv"].to_numpy(),
+        "result_citycode": unique[code_col].to_numpy(),
+        "nb_addresses": unique["nb_addresses"].to_numpy(),
+    }
+    if "X" in unique.columns and "Y" in unique.columns:
+        x, y = unique["X"].to_numpy(dtype=float, copy=True), unique["Y"].to_numpy(dtype=float, copy=True)
+        # addresses without coordinates in the REU extract: their longitude/latitude are projected
+        missing = ~(np.isfinite(x) & np.isfinite(y))
+        if missing.any():
+            x[missing], y[missing] = _transformer("EPSG:2154").transform(
+                unique["longitude"].to_numpy(dtype=float)[missing], unique["latitude"].to_numpy(dtype=float)[missing]
+            )
+        data["x"], data["y"] = x, y
+    return gpd.GeoDataFrame(
+        data=data, geometry=gpd.points_from_xy(unique["longitude"], unique["latitude"])
+    )
 
 
 def build_geojson_multipoint(addresses: pd.DataFrame) -> gpd.GeoDataFrame:
@@ -106,7 +193,7 @@ def build_geojson_multipoint(addresses: pd.DataFrame) -> gpd.GeoDataFrame:
         return np.array(data[["longitude", "latitude"]]).tolist()
 
     for id_bv, data in addresses.groupby("id_bv"):
-        cp = data.result_citycode.min()
+        cp = min(data.result_citycode)  # the builtin min also works on categorical codes
 
         geojson["features"].append(
             {
@@ -122,6 +209,50 @@ def build_geojson_multipoint(addresses: pd.DataFrame) -> gpd.GeoDataFrame:
     return gdf
 
 
+def resolve_plm(
+    points: gpd.GeoDataFrame, communes: gpd.GeoDataFrame
+) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    """
+    Paris, Marseille and Lyon may be coded as a whole ("75056") or by arrondissement ("75101"...) in the addresses, and the shapes of the
+    communes may include the city, its arrondissements or both (which overlap). Keep one set of shapes per city, matching the codes of the
+    addresses: the arrondissements are dissolved into the city when the addresses use the code of the city, and the addresses coded by
+    arrondissement take the code of the city when only the shape of the city is available
+
+    Args:
+        points (gpd.GeoDataFrame): e.g. the output of `build_geojson_point`, with column "result_citycode"
+        communes (gpd.GeoDataFrame): the shapes of the communes, with column "insee"
+
+    Returns:
+        Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]: the points and the communes
+    """
+    citycodes = points["result_citycode"].astype(str)
+    insee = communes["insee"].astype(str)
+    drop = np.zeros(len(communes), dtype=bool)
+    dissolved = []
+    for city, prefix in PLM_ARRONDISSEMENTS.items():
+        is_city = (insee == city).to_numpy()
+        is_arrondissement = insee.str.startswith(prefix).to_numpy()
+        by_arrondissement = citycodes.str.startswith(prefix).to_numpy()
+        if not (is_city.any() or is_arrondissement.any()):
+            continue
+        if by_arrondissement.any() and is_arrondissement.any():
+            drop |= is_city
+            continue
+        drop |= is_arrondissement
+        if not is_city.any():
+            dissolved.append({"insee": city, "geometry": shapely.union_all(communes.geometry.values[is_arrondissement])})
+        if by_arrondissement.any():
+            citycodes = citycodes.where(~by_arrondissement, city)
+            points = points.assign(result_citycode=citycodes.to_numpy())
+    communes = communes.take(np.flatnonzero(~drop))
+    if dissolved:
+        communes = gpd.GeoDataFrame(
+            pd.concat([communes, gpd.GeoDataFrame(dissolved, crs=communes.crs)], ignore_index=True),
+            crs=communes.crs,
+        )
+    return points, communes
+
+
 def convex_hull(gdf: gpd.GeoDataFrame) -> gpd.GeoSeries:
     """
     Compute the convex hulls of input geometries
@@ -135,22 +266,67 @@ def convex_hull(gdf: gpd.GeoDataFrame) -> gpd.GeoSeries:
     return gpd.GeoSeries(gdf.geometry).convex_hull
 
 
+def concave_hull(
+    gdf: gpd.GeoDataFrame,
+    communes: gpd.GeoDataFrame = gpd.GeoDataFrame(),
+    ratio: float = 0.3,
+    min_width: float = 0.0005,
+) -> gpd.GeoDataFrame:
+    """
+    Compute one concave hull per bureau de vote around its addresses, in bulk, and clip it to the shape of its commune.
+    Much cheaper than the Voronoi cells (no tessellation nor union): a fast preview of the footprint of the bureaux, which may leave gaps
+    between them
+
+    Args:
+        gdf (gpd.GeoDataFrame): the output of `build_geojson_point`: Point geometries, with columns "id_bv" and "result_citycode"
+        communes (gpd.GeoDataFrame, optional): the shapes of the communes, with column "result_citycode" or "insee". Defaults to gpd.GeoDataFrame() (no clipping).
+        ratio (float, optional): from 0 (most concave) to 1 (convex hull), see `shapely.concave_hull`. Defaults to 0.3.
+        min_width (float, optional): bureaux with less than three distinct addresses (hull reduced to a point or a line) are widened by this distance, in degrees. Defaults to 0.0005.
+
+    Returns:
+        gpd.GeoDataFrame: one row per bureau de vote, with columns "id_bv", "result_citycode" and "geometry"
+    """
+    # the multipoints of all the bureaux are built at once from the coordinate array
+    id_bv_positions, id_bvs = pd.factorize(gdf["id_bv"], sort=True)
+    order = np.argsort(id_bv_positions, kind="stable")
+    multipoints = shapely.multipoints(
+        shapely.get_coordinates(gdf.geometry.values)[order], indices=id_bv_positions[order]
+    )
+    hulls = shapely.concave_hull(multipoints, ratio=ratio, allow_holes=False)
+    not_polygonal = ~np.isin(shapely.get_type_id(hulls), [3, 6])
+    hulls[not_polygonal] = shapely.buffer(hulls[not_polygonal], min_width)
+    # the commune of a bureau is the commune of its first address
+    first = np.unique(id_bv_positions[order], return_index=True)[1]
+    citycodes = gdf["result_citycode"].to_numpy()[order][first]
+    result = gpd.GeoDataFrame(
+        {"id_bv": np.asarray(id_bvs), "result_citycode": citycodes}, geometry=hulls
+    )
+    if len(communes):
+        code_col = "result_citycode" if "result_citycode" in communes.columns else "insee"
+        shapes = dict(zip(communes[code_col].astype(str), shapely.make_valid(communes.geometry.values)))
+        commune_of_hull = np.array([shapes.get(str(code)) for code in citycodes], dtype=object)
+        clipped = ~shapely.is_missing(commune_of_hull)
+        hulls[clipped] = shapely.intersection(shapely.make_valid(hulls[clipped]), commune_of_hull[clipped])
+        result = result.set_geometry(hulls)
+    return result
+
+
 def clip_to_communes(
-    gdf: gpd.GeoDataFrame, communes: gpd.GeoDataFrame
+    gdf: gpd.GeoDataFrame, communes: gpd.GeoDataFrame, profiler=None
 ) -> gpd.GeoDataFrame:
     """
     Clip the polygons of input geodataframe to the boundaries of specified communes.
 
     Args:
-        gdf (gpd.GeoDataFrame): must include columns "geometry" and "result_citycode"
+        gdf (gpd.GeoDataFrame): must include columns "geometry" and "result_citycode", and a RangeIndex (like the output of `voronoi_hull`). Its geometries are replaced in place
         communes (gpd.GeoDataFrame): must include columns `geometry` and "result_citycode"
+        profiler (profiling.RunProfiler, optional): records the communes that needed a repair fallback. Defaults to None (no instrumentation).
 
     Returns:
-        gpd.GeoDataFrame: the input GeoDataFrames have been clipped according to the input `communes` shapes
+        gpd.GeoDataFrame: the input GeoDataFrame, whose geometries have been clipped in place according to the input `communes` shapes
     """
-    gdf_copy = gdf.copy()
+    profiler = profiler or NULL_PROFILER
     multipolygons_communes_dict = {}
-    multipolygons_communes_list = list()
     if "result_citycode" in communes.columns:
         code_col = "result_citycode"
     else:
@@ -163,41 +339,44 @@ def clip_to_communes(
             communes[code_col] == cp
         ].geometry.unary_union
     # align the precomputed MultiPolygons with the input GeoDataFrame `gdf`
-    for _, row in gdf_copy.iterrows():
-        cp = row["result_citycode"]
-        multipolygons_communes_list.append(multipolygons_communes_dict[cp])
-    to_intersect = gpd.GeoSeries(multipolygons_communes_list)
+    to_intersect = gpd.GeoSeries(
+        [multipolygons_communes_dict[cp] for cp in gdf["result_citycode"]]
+    )
     try:
-        gdf_copy.geometry = gdf_copy.geometry.intersection(
+        gdf.geometry = gdf.geometry.intersection(
             to_intersect, align=False
         )
     except:
         # handling self-intersection cases
-        for k in range(len(gdf_copy)):
-            try:
-                # for rows where intersection works fine
-                gdf_copy.loc[k:k,'geometry'] = gdf_copy.loc[k:k,'geometry'].intersection(
-                    to_intersect.loc[k:k],
-                    align=False
-                )
-            except:
-                # removing points that are too close together to resolve the Polygon
+        for k in range(len(gdf)):
+            cp = gdf["result_citycode"].iloc[k]
+            with profiler.commune(cp, "clip_fallback"):
                 try:
-                    gdf_copy.loc[k:k,'geometry'] = gpd.GeoSeries(
-                            gdf_copy.loc[k:k,'geometry'].values[0].simplify(tolerance=1)
-                        ).intersection(
-                            gpd.GeoSeries(to_intersect.loc[k:k].values[0].simplify(tolerance=1)),
-                            align=False
-                        )
+                    # for rows where intersection works fine
+                    gdf.loc[k:k,'geometry'] = gdf.loc[k:k,'geometry'].intersection(
+                        to_intersect.loc[k:k],
+                        align=False
+                    )
                 except:
-                    # use make_valid to restore geometry
-                    gdf_copy.loc[k:k,'geometry'] = gpd.GeoSeries(
-                            make_valid(gdf_copy.loc[k:k,'geometry'].values[0].simplify(tolerance=1))
-                        ).intersection(
-                            gpd.GeoSeries(make_valid(to_intersect.loc[k:k].values[0].simplify(tolerance=1))),
-                            align=False
-                        )
-    return gdf_copy
+                    # removing points that are too close together to resolve the Polygon
+                    try:
+                        gdf.loc[k:k,'geometry'] = gpd.GeoSeries(
+                                gdf.loc[k:k,'geometry'].values[0].simplify(tolerance=1)
+                            ).intersection(
+                                gpd.GeoSeries(to_intersect.loc[k:k].values[0].simplify(tolerance=1)),
+                                align=False
+                            )
+                        profiler.fallback(cp, "clip_to_communes", "simplify")
+                    except:
+                        # use make_valid to restore geometry
+                        gdf.loc[k:k,'geometry'] = gpd.GeoSeries(
+                                make_valid(gdf.loc[k:k,'geometry'].values[0].simplify(tolerance=1))
+                            ).intersection(
+                                gpd.GeoSeries(make_valid(to_intersect.loc[k:k].values[0].simplify(tolerance=1))),
+                                align=False
+                            )
+                        profiler.fallback(cp, "clip_to_communes", "make_valid")
+    return gdf
 
 
 def polygon_union(
@@ -237,7 +416,7 @@ def polygon_union(
 
 
 def get_clipped_voronoi_shapes(
-    gdf: gpd.GeoDataFrame, communes: gpd.GeoDataFrame = gpd.GeoDataFrame()
+    gdf: gpd.GeoDataFrame, communes: gpd.GeoDataFrame = gpd.GeoDataFrame(), profiler=None, workers: int = 1
 ) -> gpd.GeoDataFrame:
     """
     Compute voronoi cells, clip them to the shapes of communes, and merge the clipped cells that share the same "id_bv"
@@ -245,181 +424,408 @@ def get_clipped_voronoi_shapes(
     Args:
         gdf (gpd.GeoDataFrame): must include "geometry", "result_citycode" (string) and "id_bv" (unique id we determine for each bureau de vote, int)
         communes (gpd.GeoDataFrame, optional): _description_. Defaults to gpd.GeoDataFrame().
+        profiler (profiling.RunProfiler, optional): records wall time, peak RSS and geometry counts per stage and per commune. Defaults to None (no instrumentation).
+        workers (int, optional): number of processes tessellating the tiles of the largest communes (see `voronoi_hull`). Defaults to 1.
 
     Returns:
         gpd.GeoDataFrame:
     """
-    hulls = voronoi_hull(gdf, communes)
+    profiler = profiler or NULL_PROFILER
+    with profiler.stage("voronoi_hull") as counts:
+        hulls = voronoi_hull(gdf, communes, profiler=profiler, workers=workers)
+        counts.update(n_points=len(gdf), n_cells=len(hulls))
     if len(communes):
-        hulls = clip_to_communes(hulls, communes)
-    return connected_components_polygon_union(hulls)
+        with profiler.stage("clip_to_communes") as counts:
+            hulls = clip_to_communes(hulls, communes, profiler=profiler)
+            counts.update(n_cells=len(hulls))
+    with profiler.stage("connected_components_polygon_union") as counts:
+        shapes = connected_components_polygon_union(hulls, profiler=profiler)
+        counts.update(n_cells=len(hulls), n_polygons=len(shapes))
+    return shapes
 
 
 def connected_components_polygon_union(
     gdf: gpd.GeoDataFrame,
     pivot_column: str = "id_bv",
     columns: List[str] = ["result_citycode"],
+    profiler=None,
+    min_fragment_area: float = MIN_FRAGMENT_AREA_M2,
+    min_fragment_addresses: int = MIN_FRAGMENT_ADDRESSES,
 ) -> gpd.GeoDataFrame:
     """
     Assuming the geometry of the input GeoDataFrame geometry consists of polygons, return the connected components of the union of these polygons given a pivot column
     Some columns of the input GeoDataFrame can be kept in the output, under the assumption that :
     (i) for a given pivot value, and a given column of "columns", the value of the column on this pivot value stays constant
+    The secondary components of a pivot value (all but its largest one) that are smaller than `min_fragment_area` or hold fewer than
+    `min_fragment_addresses` addresses, typically left by a few mis-geocoded points, are merged into the neighbouring component that
+    shares the longest border with them (see `_fragment_targets`). The components are processed commune by commune, so that the work
+    grows linearly with the number of cells
 
     Args:
-        gdf (gpd.GeoDataFrame): must contain the column `pivot_column` and the ancillary columns `columns`
+        gdf (gpd.GeoDataFrame): must contain the column `pivot_column` and the ancillary columns `columns`, and optionally "nb_addresses" (number of addresses of each polygon, 1 otherwise)
         pivot_column (str): the column that must be used as pivot. Defaults to "id_bv".
         columns (List[str], optional): The list of other columns (not `pivot_column` nor "geometry") to keep in the output. Defaults to ["result_citycode"].
+        profiler (profiling.RunProfiler, optional): records wall time and numbers of fragments per commune (requires the column "result_citycode"). Defaults to None (no instrumentation).
+        min_fragment_area (float, optional): area in square meters below which a secondary component is merged. Defaults to MIN_FRAGMENT_AREA_M2.
+        min_fragment_addresses (int, optional): number of addresses below which a secondary component is merged. Defaults to MIN_FRAGMENT_ADDRESSES.
 
     Returns:
         gpd.GeoDataFrame: consists of the geometry of merged connected components (that are necessary Polygon), `pivot_column` and the ancillary columns `columns`
     """
+    profiler = profiler or NULL_PROFILER
     geometries = list()
-    # "data" consists of the properties of the output GeoDataFrame
-    data = {pivot_column: []}
+    pivots = list()
+    # WARNING: this assumes that, for a given pivot value, and a given column of "columns", the value of the column on this pivot value stays constant
+    # in particular, it is right for the column "result_citycode" when the union is done on "id_bv")
+    values = gdf.groupby(pivot_column, sort=False)[columns].min()
+
+    cells = gdf.geometry.to_numpy()
+    cell_pivots = gdf[pivot_column].to_numpy()
+    weights = gdf["nb_addresses"].to_numpy(dtype=float) if "nb_addresses" in gdf.columns else np.ones(len(gdf))
+    # the components only merge with components of the same commune
+    if "result_citycode" in gdf.columns:
+        positions_city = gdf.groupby("result_citycode", sort=False, observed=True).indices
+    else:
+        positions_city = {None: np.arange(len(gdf))}
+
+    for citycode, positions in positions_city.items():
+        with profiler.commune(citycode, "connected_components_polygon_union") as counts:
+            # normally these shapes are Polygon, but could be Point if there is only one found voter in a bureau de vote
+            points = shapely.get_type_id(cells[positions]) == shapely.GeometryType.POINT
+            geometries.extend(cells[positions[points]])
+            pivots.extend(cell_pivots[positions[points]])
+            positions = positions[~points & ~shapely.is_missing(cells[positions])]
+            if len(positions) == 0:
+                continue
+            parts, part_pivots, part_weights = _bureau_fragments(cells[positions], cell_pivots[positions], weights[positions])
+            targets = _fragment_targets(parts, part_pivots, part_weights, min_fragment_area, min_fragment_addresses)
+            merged = targets != np.arange(len(parts))
+            counts.update(n_fragments=len(parts), n_merged=int(merged.sum()))
+            if merged.any():
+                # each merged fragment joins the component of the bureau it shares the longest border with
+                order = np.argsort(targets, kind="stable")
+                group_targets, starts = np.unique(targets[order], return_index=True)
+                unions = np.array(
+                    [shapely.union_all(group) for group in np.split(parts[order], starts[1:])], dtype=object
+                )
+                parts, index = shapely.get_parts(unions, return_index=True)
+                polygonal = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+                parts, part_pivots = parts[polygonal], part_pivots[group_targets][index[polygonal]]
+            geometries.extend(parts)
+            pivots.extend(part_pivots)
+
+    data = {pivot_column: pivots}
     for column in columns:
-        data[column] = list()
+        data[column] = values[column].reindex(pivots).to_numpy()
+    return gpd.GeoDataFrame(geometry=geometries, data=data)
 
-    def save_columns_values(pivot):
-        data[pivot_column].append(pivot)
-        for column in columns:
-            val = gdf[gdf[pivot_column] == pivot][column].min()
-            data[column].append(val)
 
-    for pivot in gdf[pivot_column].unique():
-        # WARNING: the 2 lines below assumes that, for a given pivot value, and a given column of "columns", the value of the column on this pivot value stays constant
-        # in particular, it is right for the column "result_citycode" when the union is done on "id_bv")
-        s = gdf[
-            gdf[pivot_column] == pivot
-        ].geometry  # normally these shapes are Polygon, but could be Point if there is only one found voter in a bureau de vote
-        if len(s) == 1 and s.iloc[0].geom_type == "Point":
-            geometries.append(s)
-            save_columns_values(pivot)
-        else:
-            merged_shape = s.unary_union
-            if merged_shape is not None:
-                if merged_shape.geom_type == "Polygon":
-                    geometries.append(merged_shape)
-                    save_columns_values(pivot)
-
-                elif merged_shape.geom_type == "MultiPolygon":
-                    for _, row in (
-                        gpd.GeoDataFrame(geometry=[merged_shape])
-                        .explode(index_parts=False)
-                        .iterrows()
-                    ):
-                        geometries.append(row["geometry"])
-                        save_columns_values(pivot)
-    return gpd.GeoDataFrame(geometry=geometries, data=data)
+def _bureau_fragments(
+    cells: np.ndarray, pivots: np.ndarray, weights: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Union the cells of each pivot value and split the unions into their connected components (the fragments)
+
+    Args:
+        cells (np.ndarray): the polygons
+        pivots (np.ndarray): the pivot value of each cell
+        weights (np.ndarray): the number of addresses of each cell
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: the fragments (Polygons), their pivot values, and their numbers of addresses (those of the cells whose representative point lies in them)
+    """
+    codes, uniques = pd.factorize(pivots)
+    order = np.argsort(codes, kind="stable")
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    unions = np.array([shapely.union_all(group) for group in np.split(cells[order], starts[1:])], dtype=object)
+    parts, index = shapely.get_parts(unions, return_index=True)
+    polygonal = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    parts, part_codes = parts[polygonal], codes[order][starts][index[polygonal]]
+
+    # each cell is counted in the fragment of its own bureau holding its representative point
+    cell_positions, part_positions = shapely.STRtree(parts).query(shapely.point_on_surface(cells), predicate="within")
+    same = codes[cell_positions] == part_codes[part_positions]
+    cell_positions, part_positions = cell_positions[same], part_positions[same]
+    _, first = np.unique(cell_positions, return_index=True)
+    part_weights = np.bincount(
+        part_positions[first], weights=weights[cell_positions[first]], minlength=len(parts)
+    )
+    return parts, np.asarray(uniques)[part_codes], part_weights
+
+
+def _fragment_targets(
+    parts: np.ndarray, pivots: np.ndarray, weights: np.ndarray, min_area: float, min_addresses: int
+) -> np.ndarray:
+    """
+    Choose the fragment into which each small fragment is merged. The largest fragment of each pivot value is never merged; the others are
+    small when their area is below `min_area` square meters or their number of addresses below `min_addresses`. The adjacency graph of the
+    small fragments is built from a spatial index, and each one is merged into the neighbouring fragment of another pivot value, not small
+    itself, with the longest shared border (small fragments without such a neighbour are kept)
+
+    Returns:
+        np.ndarray: the position of the fragment each fragment is merged into (its own position when it is kept)
+    """
+    targets = np.arange(len(parts))
+    areas = _area_m2(parts)
+    # the largest fragment of each pivot value comes first
+    codes = pd.factorize(pivots)[0]
+    order = np.lexsort((-areas, codes))
+    main = np.zeros(len(parts), dtype=bool)
+    main[order[np.flatnonzero(np.diff(codes[order], prepend=-1))]] = True
+    small = ~main & ((areas < min_area) | (weights < min_addresses))
+    if not small.any():
+        return targets
+
+    left, right = shapely.STRtree(parts).query(parts[small], predicate="intersects")
+    left = np.flatnonzero(small)[left]
+    neighbours = (codes[left] != codes[right]) & ~small[right]
+    left, right = left[neighbours], right[neighbours]
+    # the coordinates are snapped to a fine grid, so that the borders computed in different tiles still match
+    borders = shapely.length(
+        shapely.intersection(shapely.boundary(parts[left]), shapely.boundary(parts[right]), grid_size=BORDER_GRID_SIZE)
+    )
+    touching = borders > 0
+    left, right, borders = left[touching], right[touching], borders[touching]
+    order = np.lexsort((-borders, left))
+    _, first = np.unique(left[order], return_index=True)
+    targets[left[order][first]] = right[order][first]
+    return targets
+
+
+def projected_crs(citycode: str) -> str:
+    """
+    The metric CRS in which the Voronoi cells of a commune are computed: Lambert-93 in metropolitan France, the official UTM-based CRS of
+    each département d'outre-mer otherwise
+    """
+    return PROJECTED_CRS.get(str(citycode)[:3], "EPSG:2154")
+
+
+@lru_cache(maxsize=None)
+def _transformer(crs: str) -> Transformer:
+    return Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+
+
+def _voronoi_cells(xy: np.ndarray, domain: shapely.Geometry, core: np.ndarray = None) -> np.ndarray:
+    """
+    Voronoi cells of the points `xy` (in the same order as the points), clipped to `domain` (None if the cell of a point is missing).
+    With a boolean mask `core`, only the cells of these points are returned
+    """
+    parts = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(xy), extend_to=domain))
+    points = shapely.points(xy if core is None else xy[core])
+    # each point lies inside its own cell
+    point_positions, cell_positions = shapely.STRtree(parts).query(points, predicate="within")
+    cells = np.full(len(points), None, dtype=object)
+    cells[point_positions] = shapely.intersection(parts[cell_positions], domain)
+    return cells
+
+
+def _tile_cells(task: Tuple[np.ndarray, np.ndarray, shapely.Geometry]) -> np.ndarray:
+    """
+    Voronoi cells of the core points of a tile, tessellated with the points of its halo (run in the worker processes of `_tiled_cells`)
+    """
+    xy, core, domain = task
+    return _voronoi_cells(xy, domain, core)
 
 
-def voronoi_hull(gdf: gpd.GeoDataFrame, communes: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+def _tiled_cells(
+    xy: np.ndarray, domain: shapely.Geometry, max_tile_points: int = MAX_TILE_POINTS, workers: int = 1
+) -> np.ndarray:
     """
-    Compute voronoi cells around each of the input addresses, within an arbitrary large bounding box (hence, it is useful to clip afterwards the cells on limits relevant to our use cases)
-    It is a based on the voronoi method implemented in the library pytess
+    Voronoi cells of the points of a large commune, computed by tiles of at most about `max_tile_points` points, in parallel.
+    Each tile is tessellated with the points of a halo around it. A point outside of the halo cuts the cell of a point p if it is closer
+    than p to some point of the cell, which happens at a vertex v of the cell if it happens at all (the condition is linear in the position
+    in the cell): the cell is kept when no point outside of the halo lies in any circle of center v through p, otherwise the point is
+    tessellated again with a halo extended to these circles. The cells are thus those of a tessellation of the whole commune, and match exactly along
+    the borders of the tiles
 
     Args:
-        gdf (gpd.GeoDataFrame): must include "geometry", "result_citycode" (string) and "id_bv" (unique id we determine for each bureau de vote, int)
+        xy (np.ndarray): projected coordinates of the points, of shape (n, 2), without duplicates
+        domain (shapely.Geometry): the cells are clipped to this polygon
+        max_tile_points (int, optional): Defaults to MAX_TILE_POINTS.
+        workers (int, optional): number of processes tessellating the tiles (1 to run them in this process, None for the number of CPUs). Defaults to 1.
+
+    Returns:
+        np.ndarray: one Polygon per point (None if the cell of the point is missing)
+    """
+    n_side = int(np.ceil(np.sqrt(len(xy) / max_tile_points)))
+    # columns with the same number of points, cut into rows with the same number of points
+    columns = pd.qcut(xy[:, 0], n_side, labels=False, duplicates="drop")
+    tiles = np.zeros(len(xy), dtype=np.int64)
+    for column, in_column in pd.Series(np.arange(len(xy))).groupby(columns).indices.items():
+        rows = pd.qcut(xy[in_column, 1], n_side, labels=False, duplicates="drop")
+        tiles[in_column] = column * n_side + rows
+    tree = shapely.STRtree(shapely.points(xy))
+    cells = np.full(len(xy), None, dtype=object)
+    # the first halo holds a few rings of points around the tile
+    halo = 4 * np.sqrt(shapely.area(domain) / len(xy))
+    # (core points, lower and upper corners of the box of their halo)
+    todo = [
+        (core, xy[core].min(axis=0) - halo, xy[core].max(axis=0) + halo)
+        for core in pd.Series(np.arange(len(xy))).groupby(tiles).indices.values()
+    ]
+    executor = ProcessPoolExecutor(workers) if workers != 1 else None
+    try:
+        while todo:
+            tasks, halos = [], []
+            for core, lower, upper in todo:
+                members = np.flatnonzero(((xy >= lower) & (xy <= upper)).all(axis=1))
+                tasks.append((xy[members], np.isin(members, core), domain))
+                halos.append(members)
+            results = executor.map(_tile_cells, tasks) if executor is not None else map(_tile_cells, tasks)
+            retry = []
+            for (core, lower, upper), members, tile_cells in zip(todo, halos, results):
+                vertices, positions = shapely.get_coordinates(tile_cells, return_index=True)
+                radius = np.hypot(*(vertices - xy[core][positions]).T)
+                # every point of the box is in the halo: only the circles crossing its border are checked
+                crossing = np.flatnonzero(
+                    ((vertices - radius[:, None] < lower) | (vertices + radius[:, None] > upper)).any(axis=1)
+                )
+                vertex_positions, neighbours = tree.query(
+                    shapely.points(vertices[crossing]), predicate="dwithin", distance=radius[crossing]
+                )
+                in_halo = np.zeros(len(xy), dtype=bool)
+                in_halo[members] = True
+                exact = ~shapely.is_missing(tile_cells)
+                exact[positions[crossing[vertex_positions[~in_halo[neighbours]]]]] = False
+                # with every point in the halo, the cells are final
+                if len(members) == len(xy):
+                    exact[:] = True
+                cells[core[exact]] = tile_cells[exact]
+                # the other points are tessellated again one by one, the box of their halo being extended to the circles of their cell
+                for k in np.flatnonzero(~exact):
+                    circles = positions == k
+                    if circles.any():
+                        centers, radii = vertices[circles], radius[circles, None]
+                        retry.append(
+                            (
+                                core[[k]],
+                                np.minimum(lower, (centers - radii).min(axis=0)),
+                                np.maximum(upper, (centers + radii).max(axis=0)),
+                            )
+                        )
+                    else:
+                        retry.append((core[[k]], lower - (upper - lower), upper + (upper - lower)))
+            todo = retry
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return cells
+
+
+def _commune_cells(
+    xy: np.ndarray,
+    commune: shapely.Geometry,
+    crs: str,
+    buffer: float = VORONOI_BUFFER_METERS,
+    max_tile_points: int = MAX_TILE_POINTS,
+    workers: int = 1,
+) -> np.ndarray:
+    """
+    Voronoi cells of the points of a commune (in the same order as the points), computed in the metric CRS `crs` and bounded to the buffered
+    envelope of the commune and its points, then converted back to longitude/latitude
+
+    Args:
+        xy (np.ndarray): projected coordinates of the points, of shape (n, 2), without duplicates
+        commune (shapely.Geometry): the shape of the commune, in longitude/latitude (None if unknown)
+        crs (str): see `projected_crs`
+        buffer (float, optional): margin around the envelope, in meters. Defaults to VORONOI_BUFFER_METERS.
+        max_tile_points (int, optional): communes with more points are tessellated by tiles (see `_tiled_cells`). Defaults to MAX_TILE_POINTS.
+        workers (int, optional): number of processes tessellating the tiles. Defaults to 1.
+
+    Returns:
+        np.ndarray: one Polygon per point (None if the cell of the point is missing)
+    """
+    transformer = _transformer(crs)
+    extent = shapely.multipoints(xy)
+    if commune is not None:
+        commune_xy = shapely.transform(commune, lambda c: np.column_stack(transformer.transform(c[:, 0], c[:, 1])))
+        extent = shapely.union(extent, shapely.envelope(commune_xy))
+    domain = shapely.buffer(shapely.envelope(extent), buffer, join_style="mitre")
+    if len(xy) > max_tile_points:
+        cells = _tiled_cells(xy, domain, max_tile_points=max_tile_points, workers=workers)
+    else:
+        cells = _voronoi_cells(xy, domain)
+    return shapely.transform(
+        cells, lambda c: np.column_stack(transformer.transform(c[:, 0], c[:, 1], direction="INVERSE"))
+    )
+
+
+def voronoi_hull(
+    gdf: gpd.GeoDataFrame,
+    communes: gpd.GeoDataFrame,
+    profiler=None,
+    max_tile_points: int = MAX_TILE_POINTS,
+    workers: int = 1,
+) -> gpd.GeoDataFrame:
+    """
+    Compute voronoi cells around each of the input addresses. The cells of each commune are computed in a metric CRS (see `projected_crs`),
+    within the envelope of the commune buffered by VORONOI_BUFFER_METERS, so that they only need to be clipped to the commune afterwards.
+    The largest communes are tessellated by tiles (see `_tiled_cells`)
+
+    Args:
+        gdf (gpd.GeoDataFrame): must include "geometry", "result_citycode" (string) and "id_bv" (unique id we determine for each bureau de vote, int). When it includes columns "x" and "y" (Lambert-93 coordinates of the REU extract), they are used instead of reprojecting the metropolitan points
+        communes (gpd.GeoDataFrame): the shapes of the communes, with column "insee"
+        profiler (profiling.RunProfiler, optional): records wall time and number of points per commune. Defaults to None (no instrumentation).
+        max_tile_points (int, optional): communes with more points are tessellated by tiles. Defaults to MAX_TILE_POINTS.
+        workers (int, optional): number of processes tessellating the tiles of a large commune (1 to run them in this process, None for the number of CPUs). Defaults to 1.
 
     Returns:
-        gpd.GeoDataFrame: include "geometry", "result_citycode" and "id_bv"
+        gpd.GeoDataFrame: include "geometry", "result_citycode" and "id_bv", and "nb_addresses" (number of addresses of each cell) when the input has it
     """
+    profiler = profiler or NULL_PROFILER
     assert (
         "id_bv" in gdf.columns and "result_citycode" in gdf.columns
     ), "Some necessary columns are missing"
-    gdf_copy = gdf.copy()
-
     id_bvs, citycodes = [], []
+    nb_addresses = []
     polygons = []
-    gdf_copy.drop_duplicates(
-        subset=["geometry"], inplace=True
-    )  # delete duplicates of geolocated points
+    # delete duplicates of geolocated points, comparing coordinates (no-op on the output of `build_geojson_point`, which is already deduplicated)
+    gdf_unique = gdf.take(
+        np.flatnonzero(~pd.DataFrame(shapely.get_coordinates(gdf.geometry.values)).duplicated().to_numpy())
+    )
+    # positions of the addresses of each commune, computed in one pass instead of one mask per commune
+    positions_city = gdf_unique.groupby("result_citycode", observed=True).indices
+    commune_shapes = dict(zip(communes["insee"], communes.geometry.values))
     # on s'assure de parcourir toutes les communes, certaines sont absentes des adresses
-    for citycode in set(gdf_copy.result_citycode.unique()) | set(communes.insee.unique()):
-        gdf_city = gdf_copy[gdf_copy.result_citycode == citycode]
-        # rares cas sans aucune adresse de votant sur la commune
-        if len(gdf_city) == 0:
-            id_bvs.append(citycode+'_X')
-            citycodes.append(citycode)
-            polygons.append(communes.loc[communes['insee']==citycode, 'geometry'].values[0])
-        # un seul BdV dans la commune : le contour sera celui de la commune
-        elif gdf_city['id_bv'].nunique() == 1:
-            id_bvs.append(gdf_city['id_bv'].values[0])
-            citycodes.append(citycode)
-            polygons.append(communes.loc[communes['insee']==citycode, 'geometry'].values[0])
-        # cas général
-        elif len(gdf_city) >= 3:
-            points_city, id_bvs_city = [], []
-            for k in gdf_city.index:
-                try:
-                    points_city.append(
-                        (
-                            gdf_city.geometry[k].coords.xy[0][0],
-                            gdf_city.geometry[k].coords.xy[1][0],
-                        )
-                    )
-                    id_bvs_city.append(gdf_city.id_bv[k])
-                except:
-                    pass
-
-            # the condition "if k" exclude the corner of bounding box from the pytess.voronoi output
-            # the size of 'buffer_percent' defines the size of the virtual bounding box we compute Voronoi in
-            # pytess.voronoi returns a list of 2-tuples, with the first item in each tuple being the original input point (or None for each corner of the bounding box buffer), and the second item being the point's corressponding Voronoi polygon.
-
-            voronoi_city_dict = {
-                k: v for (k, v) in pytess.voronoi(points_city, buffer_percent=1000) if k
-            }
-            polygons_city = []
-            if (
-                type(points_city) == list
-            ):  # this list is supposed to be like [(lat, lon), (lat, lon), (lat, lon), ...]
-                for point in points_city:
-                    try:
-                        polygons_city.append(Polygon(voronoi_city_dict[point]))
-                    except:
-                        polygons_city.append(None)
-            id_bvs.extend(id_bvs_city)
-            citycodes.extend([citycode] * len(id_bvs_city))
-            polygons.extend(polygons_city)
-
-        # handling one known case : two points in one commune (due to bad geocoding), from two different BdV
-        # creating big triangles along the bisection between the two points, that will be cropped later to the commune's contours
-        elif len(gdf_city) == 2:
-            size = 10e6
-            middle_point = Point(
-                (gdf_city['geometry'].values[0].coords.xy[0][0] + gdf_city['geometry'].values[1].coords.xy[0][0])/2,
-                (gdf_city['geometry'].values[0].coords.xy[1][0] + gdf_city['geometry'].values[1].coords.xy[1][0])/2
-            )
-            for k in range(2):
-                point2middle_vector = [
-                    middle_point.coords.xy[0][0] - gdf_city['geometry'].values[k].coords.xy[0][0],
-                    middle_point.coords.xy[1][0] - gdf_city['geometry'].values[k].coords.xy[1][0]
-                ]
-                orthogonal_vector = [
-                    -point2middle_vector[1],
-                    point2middle_vector[0]
-                ]
-                accross_point = Point(
-                    gdf_city['geometry'].values[k].coords.xy[0][0] +
-                    size*point2middle_vector[0],
-                    gdf_city['geometry'].values[k].coords.xy[1][0] +
-                    size*point2middle_vector[1]
-                )
-                other_point1 = Point(
-                    middle_point.coords.xy[0][0] +
-                    size*orthogonal_vector[0],
-                    middle_point.coords.xy[1][0] +
-                    size*orthogonal_vector[1],
-                )
-                other_point2 = Point(
-                    middle_point.coords.xy[0][0] -
-                    size*orthogonal_vector[0],
-                    middle_point.coords.xy[1][0] -
-                    size*orthogonal_vector[1],
-                )
-                id_bvs.append(gdf_city['id_bv'].values[k])
+    for citycode in set(positions_city) | set(communes.insee.unique()):
+        with profiler.commune(citycode, "voronoi_hull") as counts:
+            gdf_city = gdf_unique.iloc[positions_city.get(citycode, [])]
+            counts["n_points"] = len(gdf_city)
+            # rares cas sans aucune adresse de votant sur la commune
+            if len(gdf_city) == 0:
+                id_bvs.append(citycode+'_X')
                 citycodes.append(citycode)
-                polygons.append(Polygon([accross_point, other_point1, other_point2]))
-                
-    return gpd.GeoDataFrame(
-        geometry=polygons, data={"id_bv": id_bvs, "result_citycode": citycodes}
-    )
+                nb_addresses.append(0)
+                polygons.append(communes.loc[communes['insee']==citycode, 'geometry'].values[0])
+            # un seul BdV dans la commune : le contour sera celui de la commune
+            elif gdf_city['id_bv'].nunique() == 1:
+                id_bvs.append(gdf_city['id_bv'].values[0])
+                citycodes.append(citycode)
+                nb_addresses.append(gdf_city['nb_addresses'].sum() if 'nb_addresses' in gdf_city.columns else len(gdf_city))
+                polygons.append(communes.loc[communes['insee']==citycode, 'geometry'].values[0])
+            # cas général (with two points, the two cells are the half-planes on each side of the bisector)
+            else:
+                crs = projected_crs(citycode)
+                if crs == "EPSG:2154" and "x" in gdf_city.columns and "y" in gdf_city.columns:
+                    xy = gdf_city[["x", "y"]].to_numpy(dtype=float, copy=True)
+                else:
+                    xy = np.full((len(gdf_city), 2), np.nan)
+                # points without projected coordinates (a NaN would make the Voronoi diagram fail)
+                missing = ~np.isfinite(xy).all(axis=1)
+                if missing.any():
+                    lonlat = shapely.get_coordinates(gdf_city.geometry.values[missing])
+                    xy[missing] = np.column_stack(_transformer(crs).transform(lonlat[:, 0], lonlat[:, 1]))
+                cells = _commune_cells(
+                    xy, commune_shapes.get(citycode), crs, max_tile_points=max_tile_points, workers=workers
+                )
+                if shapely.is_missing(cells).any():
+                    profiler.fallback(citycode, "voronoi_hull", "missing_cell")
+                id_bvs.extend(gdf_city["id_bv"].to_numpy())
+                citycodes.extend([citycode] * len(gdf_city))
+                nb_addresses.extend(gdf_city['nb_addresses'] if 'nb_addresses' in gdf_city.columns else [1] * len(gdf_city))
+                polygons.extend(cells)
+
+    data = {"id_bv": id_bvs, "result_citycode": citycodes}
+    if "nb_addresses" in gdf.columns:
+        data["nb_addresses"] = nb_addresses
+    return gpd.GeoDataFrame(geometry=polygons, data=data)
@@ -0,0 +1,119 @@
+"""
+Import time and memory budget of the headless compute core: the modules run by the batch workers (cleaning, contours, audit, dissolve)
+must load without the visualization (pydeck) and network (requests) backends, and without scipy, which are only imported by the functions
+that need them (`display`, `geo.add_geoloc`, `nearest_bureau`, `raster_preview`).
+
+Each module is imported in a fresh interpreter, as in a process-pool worker started with "spawn", after the scientific stack shared by
+all the modules (BASE_MODULES): the script reports the time and the peak resident memory added by the module itself, the optional
+backends it loaded, and the total start time of the interpreter. The exit code is 1 when a module exceeds its budget.
+
+Usage:
+    python import_budget.py
+    python import_budget.py --modules geo display --max-seconds 0.2
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import List
+
+import pandas as pd
+
+CORE_MODULES = [
+    "profiling",
+    "loader",
+    "arrow_geometry",
+    "topology",
+    "commune_store",
+    "contour_io",
+    "cleaner",
+    "geo",
+    "merge_departements",
+    "audit",
+    "dissolve",
+]
+# imported before the measured module: their cost is paid by every worker whatever it runs
+BASE_MODULES = ["numpy", "pandas", "pyarrow", "pyproj", "shapely", "geopandas"]
+# backends the core modules must not load
+OPTIONAL_BACKENDS = ["pydeck", "requests", "scipy", "jinja2"]
+# budget of each module, on top of BASE_MODULES
+MAX_IMPORT_SECONDS = 0.25
+MAX_IMPORT_RSS_MB = 25
+
+# run in the fresh interpreter, with the name of the module as argument
+_PROBE = """
+import importlib, json, sys, time
+from profiling import peak_rss_mb
+for name in {base}:
+    importlib.import_module(name)
+rss = peak_rss_mb()
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "rss_mb": None if rss is None else peak_rss_mb() - rss,
+    "backends": [name for name in {backends} if name in sys.modules],
+}}))
+"""
+
+
+def measure_import(module: str) -> dict:
+    """
+    Import a module in a fresh interpreter (after BASE_MODULES) and measure its cost
+
+    Returns:
+        dict: "module", "seconds" and "rss_mb" (time and peak memory added by the module), "backends" (the OPTIONAL_BACKENDS it loaded) and "total_seconds" (start of the interpreter included)
+    """
+    probe = _PROBE.format(base=BASE_MODULES, backends=OPTIONAL_BACKENDS)
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", probe, module],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True,
+    )
+    total = time.perf_counter() - start
+    return {"module": module, **json.loads(result.stdout.strip().splitlines()[-1]), "total_seconds": total}
+
+
+def check_budget(
+    modules: List[str] = CORE_MODULES,
+    max_seconds: float = MAX_IMPORT_SECONDS,
+    max_rss_mb: float = MAX_IMPORT_RSS_MB,
+    repeat: int = 3,
+) -> pd.DataFrame:
+    """
+    Measure the import of each module (best of `repeat` runs, to leave out the cold file cache) and compare it to the budget
+
+    Returns:
+        pd.DataFrame: one row per module (see `measure_import`), with column "ok"
+    """
+    rows = []
+    for module in modules:
+        runs = [measure_import(module) for _ in range(repeat)]
+        row = min(runs, key=lambda run: run["seconds"])
+        row["ok"] = (
+            row["seconds"] <= max_seconds
+            and (row["rss_mb"] is None or row["rss_mb"] <= max_rss_mb)
+            and not row["backends"]
+        )
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the import time and memory of the headless compute core")
+    parser.add_argument("--modules", nargs="*", default=CORE_MODULES)
+    parser.add_argument("--max-seconds", type=float, default=MAX_IMPORT_SECONDS)
+    parser.add_argument("--max-rss-mb", type=float, default=MAX_IMPORT_RSS_MB)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    report = check_budget(args.modules, args.max_seconds, args.max_rss_mb, args.repeat)
+    print(report.to_string(index=False))
+    if not report["ok"].all():
+        print(f"### over budget: {', '.join(report.loc[~report['ok'], 'module'])}")
+        sys.exit(1)
@@ -0,0 +1,118 @@
+"""
+Typed loading of the address tables. Instead of keeping every column as Python strings, the codes (citycodes, postcodes, département...)
+are stored as categoricals, the coordinates as float arrays and `id_bv` as the narrowest integer type that can hold it
+"""
+import os
+from collections import defaultdict
+from typing import List, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+# columns holding codes, with few distinct values compared to the number of addresses
+CATEGORICAL_COLUMNS = [
+    # raw INSEE file (before and after renaming by `cleaner.clean_dataset`)
+    "Code commune\nRéférentiel",
+    "Code communeRéférentiel",
+    "Libellé commune\nRéférentiel",
+    "Libellé communeRéférentiel",
+    "Commune",
+    "CP",
+    "CP_BV",
+    "Code_BV",
+    # API-adresse output
+    "result_citycode",
+    "result_postcode",
+    "result_city",
+    "result_type",
+    # REU extract
+    "code_commune_ref",
+    "commune_bv",
+    "code_bv",
+    "id_brut_bv",
+    "dep_bv",
+]
+FLOAT_COLUMNS = {
+    "latitude": "float64",
+    "longitude": "float64",
+    # Lambert-93 coordinates of the REU extract
+    "X": "float64",
+    "Y": "float64",
+    "result_score": "float32",
+    "geo_score": "float32",
+}
+
+
+def compact_id_bv(ids: pd.Series) -> pd.Series:
+    """
+    Store identifiers of bureaux de vote with the narrowest integer type, or as a categorical when they are not numeric
+
+    Args:
+        ids (pd.Series): identifiers, as integers or strings
+
+    Returns:
+        pd.Series: the same identifiers, as int32/int64 (or categorical)
+    """
+    numeric = pd.to_numeric(ids, errors="coerce")
+    if numeric.notna().all():
+        return pd.to_numeric(numeric, downcast="integer")
+    return ids.astype("category")
+
+
+def compact_addresses(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert the known columns of an address table to compact dtypes (see `CATEGORICAL_COLUMNS` and `FLOAT_COLUMNS`).
+    The columns are converted in place: no copy of the whole table is made
+
+    Args:
+        df (pd.DataFrame): an address table, raw or geocoded
+
+    Returns:
+        pd.DataFrame: the same dataframe, with compact dtypes
+    """
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    for col, dtype in FLOAT_COLUMNS.items():
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(dtype)
+    if "id_bv" in df.columns:
+        df["id_bv"] = compact_id_bv(df["id_bv"])
+    return df
+
+
+def departement_of(citycodes: pd.Series) -> pd.Series:
+    """
+    The département of INSEE codes of communes ("09001" -> "09", "97411" -> "974")
+    """
+    codes = citycodes.astype(str)
+    return codes.str[:2].where(~codes.str.startswith("97"), codes.str[:3])
+
+
+def read_addresses(
+    path: str, columns: Optional[List[str]] = None, sep: str = ";"
+) -> pd.DataFrame:
+    """
+    Read an address table (CSV or parquet) with compact dtypes
+
+    Args:
+        path (str): path of a ".csv" or ".parquet" file
+        columns (List[str], optional): the subset of columns to read. Defaults to None (all columns).
+        sep (str, optional): separator of CSV files. Defaults to ";".
+
+    Returns:
+        pd.DataFrame: the address table, where codes are categoricals and coordinates are floats
+    """
+    if os.path.splitext(path)[1] == ".parquet":
+        # the code columns are read as dictionaries, so that their values never become one Python string per row
+        names = pq.read_schema(path).names
+        df = pq.read_table(
+            path,
+            columns=columns,
+            read_dictionary=[col for col in CATEGORICAL_COLUMNS if col in names and (columns is None or col in columns)],
+        ).to_pandas()
+    else:
+        # every other column stays a string, so that codes keep their leading zeros
+        dtype = defaultdict(lambda: str, {col: "category" for col in CATEGORICAL_COLUMNS})
+        df = pd.read_csv(path, sep=sep, dtype=dtype, usecols=columns)
+    return compact_addresses(df)
@@ -0,0 +1,186 @@
+"""
+Find the bureau de vote of coordinates, using the contours produced by `generate_areas_geojson.py`.
+The lookups are vectorized: a grid index gives the candidate contours of each point, and a bulk point-in-polygon test on prepared geometries
+keeps the contour containing it. Points falling in gaps between contours get the nearest contour.
+
+Usage as a local HTTP service:
+    python lookup.py geojson/ --port 8000
+    curl "http://127.0.0.1:8000/bureau?lon=1.47&lat=43.05"
+    curl -X POST -d '{"longitude": [1.47, 1.6], "latitude": [43.05, 42.9]}' http://127.0.0.1:8000/bureau
+"""
+import argparse
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from urllib.parse import parse_qs, urlparse
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from contour_io import read_contours
+from merge_departements import departement_files
+
+
+class BureauLocator:
+    """
+    Point-to-bureau lookups over a set of contours
+
+    Args:
+        contours (gpd.GeoDataFrame): the contours of the bureaux de vote (Polygon or MultiPolygon), in longitude/latitude
+        id_column (str, optional): the column identifying the bureaux. Defaults to "id_bv".
+        cells_per_contour (float, optional): size of the cells of the grid index, relatively to the median size of the contours (more cells means fewer candidate contours per point). Defaults to 4.
+    """
+
+    def __init__(
+        self,
+        contours: gpd.GeoDataFrame,
+        id_column: str = "id_bv",
+        cells_per_contour: float = 4,
+    ):
+        contours = contours[contours.geometry.notna() & ~contours.geometry.is_empty]
+        self.ids = contours[id_column].to_numpy()
+        self.geometries = contours.geometry.to_numpy()
+        shapely.prepare(self.geometries)
+        # used for the fallback on the nearest contour only
+        self.tree = shapely.STRtree(self.geometries)
+
+        # grid index: every cell knows the contours whose bounding box overlaps it
+        bounds = shapely.bounds(self.geometries)
+        sizes = np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1])
+        self.cell_size = float(np.median(sizes)) / cells_per_contour or 1e-3
+        self.origin = bounds[:, :2].min(axis=0)
+        ix0, iy0 = self._cell(bounds[:, 0], bounds[:, 1])
+        ix1, iy1 = self._cell(bounds[:, 2], bounds[:, 3])
+        self.n_columns = int(ix1.max()) + 1
+        nx, ny = ix1 - ix0 + 1, iy1 - iy0 + 1
+        contour_idx = np.repeat(np.arange(len(self.geometries)), nx * ny)
+        # position of each (contour, cell) pair inside the block of cells of its contour
+        rank = np.arange(len(contour_idx)) - np.repeat(np.cumsum(nx * ny) - nx * ny, nx * ny)
+        ix = ix0[contour_idx] + rank % nx[contour_idx]
+        iy = iy0[contour_idx] + rank // nx[contour_idx]
+        keys = iy * self.n_columns + ix
+        order = np.argsort(keys, kind="stable")
+        self.cell_contours = contour_idx[order]
+        self.cell_keys, self.cell_starts, self.cell_counts = np.unique(
+            keys[order], return_index=True, return_counts=True
+        )
+
+    def _cell(self, longitudes: np.ndarray, latitudes: np.ndarray):
+        ix = np.floor((longitudes - self.origin[0]) / self.cell_size).astype(np.int64)
+        iy = np.floor((latitudes - self.origin[1]) / self.cell_size).astype(np.int64)
+        return ix, iy
+
+    @classmethod
+    def from_files(cls, paths: List[str], id_column: str = "id_bv") -> "BureauLocator":
+        """
+        Load one or several contour files (e.g. "geojson/voronoi_contours_09.geojson", in any format of `contour_io`)
+        """
+        contours = pd.concat(
+            [read_contours(path, columns=[id_column]) for path in paths],
+            ignore_index=True,
+        )
+        return cls(gpd.GeoDataFrame(contours, geometry="geometry"), id_column=id_column)
+
+    @classmethod
+    def from_directory(
+        cls, directory: str = "geojson/", departements: List[str] = None
+    ) -> "BureauLocator":
+        """
+        Load the contours of some départements (all of them by default) from the output directory of `generate_areas_geojson.py`
+        """
+        files = [path for dep, path in departement_files(directory) if departements is None or dep in departements]
+        assert len(files), f"no contour file found in {directory}"
+        return cls.from_files(files)
+
+    def locate(
+        self, longitudes: np.ndarray, latitudes: np.ndarray, nearest: bool = True
+    ) -> np.ndarray:
+        """
+        Find the bureau de vote of a batch of points
+
+        Args:
+            longitudes (np.ndarray):
+            latitudes (np.ndarray):
+            nearest (bool, optional): if True, points that are not inside any contour get the nearest contour. Defaults to True.
+
+        Returns:
+            np.ndarray: the identifier of the bureau of each point (None where no bureau was found)
+        """
+        x = np.asarray(longitudes, dtype=float)
+        y = np.asarray(latitudes, dtype=float)
+        ix, iy = self._cell(x, y)
+        keys = iy * self.n_columns + ix
+        pos = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+        found = (self.cell_keys[pos] == keys) & (ix >= 0) & (ix < self.n_columns)
+        counts = np.where(found, self.cell_counts[pos], 0)
+        # one (point, candidate contour) pair per contour of the cell of the point
+        point_idx = np.repeat(np.arange(len(x)), counts)
+        rank = np.arange(len(point_idx)) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = self.cell_contours[np.repeat(self.cell_starts[pos], counts) + rank]
+        hit = shapely.contains_xy(self.geometries[candidates], x[point_idx], y[point_idx])
+
+        located = np.full(len(x), -1, dtype=np.int64)
+        located[point_idx[hit]] = candidates[hit]
+        if nearest and (located < 0).any():
+            missing = np.flatnonzero(located < 0)
+            input_idx, tree_idx = self.tree.query_nearest(shapely.points(x[missing], y[missing]))
+            # keep one contour per point in case of ties
+            _, first = np.unique(input_idx, return_index=True)
+            located[missing[input_idx[first]]] = tree_idx[first]
+        result = np.full(len(x), None, dtype=object)
+        result[located >= 0] = self.ids[located[located >= 0]]
+        return result
+
+
+def serve(locator: BureauLocator, host: str = "127.0.0.1", port: int = 8000):
+    """
+    Answer lookups over HTTP:
+        GET /bureau?lon=<longitude>&lat=<latitude> returns {"id_bv": ...}
+        POST /bureau with a JSON body {"longitude": [...], "latitude": [...]} returns {"id_bv": [...]}
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _answer(self, status: int, body: dict):
+            payload = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path != "/bureau" or "lon" not in query or "lat" not in query:
+                return self._answer(400, {"error": "expected /bureau?lon=<longitude>&lat=<latitude>"})
+            try:
+                ids = locator.locate([float(query["lon"][0])], [float(query["lat"][0])])
+            except ValueError:
+                return self._answer(400, {"error": "lon and lat must be numbers"})
+            self._answer(200, {"id_bv": ids[0]})
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/bureau":
+                return self._answer(404, {"error": "unknown path"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                ids = locator.locate(body["longitude"], body["latitude"])
+            except (ValueError, KeyError, TypeError):
+                return self._answer(400, {"error": 'expected a JSON body {"longitude": [...], "latitude": [...]}'})
+            self._answer(200, {"id_bv": ids.tolist()})
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"### Serving lookups on http://{host}:{port}/bureau")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve point-to-bureau lookups over the generated contours")
+    parser.add_argument("directory", nargs="?", default="geojson/", help="directory of the voronoi_contours_{DEP} files")
+    parser.add_argument("--departements", nargs="*", default=None, help="only load these départements")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    serve(BureauLocator.from_directory(args.directory, args.departements), args.host, args.port)
@@ -0,0 +1,226 @@
+"""
+Merge the contour files of the départements (`voronoi_contours_{DEP}` produced by `generate_areas_geojson.py`) into one national file.
+The départements are read and written one at a time; only the cells along the border of each département (the seam) are kept in memory,
+to check after the merge that neighbouring départements neither overlap nor leave gaps between them.
+
+Usage:
+    python merge_departements.py geojson/ --output voronoi_contours_france.parquet --report seam_report.csv
+"""
+import argparse
+import os
+import re
+from typing import List, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from contour_io import open_contour_writer, read_contours
+from geo import _area_m2
+
+# the contour files of the départements, read in this order of preference when a département has several of them
+CONTOUR_FORMAT_PREFERENCE = (".parquet", ".fgb", ".geojsonl", ".geojsons", ".geojson", ".topojson")
+# codes of the départements (01 to 95, 2A, 2B, 971 to 976)
+DEPARTEMENT_CODE = re.compile(r"\d{2,3}|2[AB]")
+
+
+def departement_files(directory: str, preference: Tuple[str, ...] = CONTOUR_FORMAT_PREFERENCE) -> List[Tuple[str, str]]:
+    """
+    List the contour files of the départements in a directory: one file per département (when it was written in several formats, e.g.
+    after a change of `OUTPUT_FORMAT`, the first format of `preference` is used), the other files (such as the national
+    `voronoi_contours_france` written by `merge_departements`) being ignored
+
+    Args:
+        directory (str): the output directory of `generate_areas_geojson.py`
+        preference (Tuple[str, ...], optional): the extensions read, from the preferred one. Defaults to CONTOUR_FORMAT_PREFERENCE.
+
+    Returns:
+        List[Tuple[str, str]]: (département, path), sorted by département
+    """
+    candidates = {}
+    for name in os.listdir(directory):
+        stem, extension = os.path.splitext(name)
+        dep = stem[len("voronoi_contours_"):]
+        if stem.startswith("voronoi_contours_") and extension in preference and DEPARTEMENT_CODE.fullmatch(dep):
+            candidates.setdefault(dep, []).append(name)
+    files = []
+    for dep in sorted(candidates):
+        names = sorted(candidates[dep], key=lambda name: preference.index(os.path.splitext(name)[1]))
+        if len(names) > 1:
+            print(f"### {dep}: several contour files ({', '.join(names)}), reading {names[0]}")
+        files.append((dep, os.path.join(directory, names[0])))
+    return files
+
+
+def border_cells(contours: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    Find the cells along the outline of a département (outer border, and borders of the holes such as communes left out)
+
+    Returns:
+        np.ndarray: booleans, True for the cells touching the outline
+    """
+    geometries = contours.geometry.to_numpy()
+    outline = shapely.boundary(shapely.union_all(shapely.make_valid(geometries)))
+    return shapely.intersects(geometries, outline)
+
+
+def check_seams(seam: gpd.GeoDataFrame, gap_tolerance: float = 1e-4, min_area: float = 1) -> pd.DataFrame:
+    """
+    Check the cells along the borders of the départements: overlaps between cells of different départements, and gaps between the
+    cells of two neighbouring départements (holes enclosed by their cells, and slivers of less than `gap_tolerance` wide, even when they
+    are open to the outside)
+
+    Args:
+        seam (gpd.GeoDataFrame): the border cells, with columns "id", "departement" and "geometry"
+        gap_tolerance (float, optional): cells closer than this distance (in degrees) are considered neighbours. Defaults to 1e-4 (about 10 m).
+        min_area (float, optional): overlaps and gaps below this area (in square meters) are ignored. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: one row per defect, with columns "type" ("overlap" or "gap"), "departement_a", "departement_b", "id_a", "id_b" (for overlaps), "area_m2", "longitude" and "latitude" (a point inside the defect)
+    """
+    geometries = seam.geometry.to_numpy()
+    departements = seam["departement"].to_numpy()
+    ids = seam["id"].to_numpy()
+    left, right = shapely.STRtree(geometries).query(geometries, predicate="dwithin", distance=gap_tolerance)
+    keep = (left < right) & (departements[left] != departements[right])
+    left, right = left[keep], right[keep]
+    defects = []
+
+    # overlaps: bulk intersection of all the pairs of touching cells from different départements
+    overlaps = shapely.intersection(geometries[left], geometries[right])
+    # the cells separated by a gap do not intersect
+    areas = np.zeros(len(overlaps))
+    non_empty = ~shapely.is_empty(overlaps)
+    if non_empty.any():
+        areas[non_empty] = _area_m2(overlaps[non_empty])
+    for k in np.flatnonzero(areas > min_area):
+        point = shapely.point_on_surface(overlaps[k])
+        defects.append(
+            {
+                "type": "overlap",
+                "departement_a": departements[left[k]],
+                "departement_b": departements[right[k]],
+                "id_a": ids[left[k]],
+                "id_b": ids[right[k]],
+                "area_m2": areas[k],
+                "longitude": point.x,
+                "latitude": point.y,
+            }
+        )
+
+    # gaps: areas covered by neither département between their border cells, touching both of them. The holes of the union of the
+    # cells are completed by a closing (dilation then erosion by `gap_tolerance`) of the union, which also fills the slivers open to
+    # the outside (reaching the coast or a third département)
+    neighbours = pd.DataFrame(
+        {
+            "departement_a": np.minimum(departements[left], departements[right]),
+            "departement_b": np.maximum(departements[left], departements[right]),
+        }
+    ).drop_duplicates()
+    tree = shapely.STRtree(geometries)
+    for dep_a, dep_b in neighbours.itertuples(index=False):
+        cells_ab = np.flatnonzero((departements == dep_a) | (departements == dep_b))
+        union = shapely.union_all(shapely.make_valid(geometries[cells_ab]))
+        closed = shapely.buffer(shapely.buffer(union, gap_tolerance), -gap_tolerance)
+        filled = shapely.union_all(
+            [closed] + [shapely.Polygon(part.exterior) for part in shapely.get_parts(union) if part.geom_type == "Polygon"]
+        )
+        gaps = shapely.difference(filled, union)
+        # the cells of the other départements are not gaps
+        others = tree.query(gaps, predicate="intersects")
+        others = others[~np.isin(departements[others], [dep_a, dep_b])]
+        if len(others):
+            gaps = shapely.difference(gaps, shapely.union_all(shapely.make_valid(geometries[others])))
+        holes = shapely.get_parts(gaps)
+        holes = holes[shapely.get_type_id(holes) == shapely.GeometryType.POLYGON]
+        if not len(holes):
+            continue
+        hole_idx, cell_idx = shapely.STRtree(geometries[cells_ab]).query(
+            holes, predicate="dwithin", distance=gap_tolerance
+        )
+        touched = pd.DataFrame({"hole": hole_idx, "departement": departements[cells_ab][cell_idx]})
+        # holes surrounded by the cells of a single département are not seam defects
+        on_seam = touched.groupby("hole")["departement"].nunique()
+        on_seam = on_seam.index[on_seam.to_numpy() == 2].to_numpy()
+        areas = _area_m2(holes[on_seam]) if len(on_seam) else np.array([])
+        for k, area in zip(on_seam, areas):
+            if area <= min_area:
+                continue
+            point = shapely.point_on_surface(holes[k])
+            defects.append(
+                {
+                    "type": "gap",
+                    "departement_a": dep_a,
+                    "departement_b": dep_b,
+                    "id_a": None,
+                    "id_b": None,
+                    "area_m2": area,
+                    "longitude": point.x,
+                    "latitude": point.y,
+                }
+            )
+    return pd.DataFrame(
+        defects,
+        columns=["type", "departement_a", "departement_b", "id_a", "id_b", "area_m2", "longitude", "latitude"],
+    )
+
+
+def merge_departements(
+    directory: str = "geojson/",
+    output: str = "voronoi_contours_france.parquet",
+    report: str = None,
+    gap_tolerance: float = 1e-4,
+    min_area: float = 1,
+) -> pd.DataFrame:
+    """
+    Stream the contours of every département of `directory` into one national file, with a new globally unique integer "id"
+    and a column "departement", then check the seams between départements (see `check_seams`)
+
+    Args:
+        directory (str, optional): the directory of the `voronoi_contours_{DEP}` files. Defaults to "geojson/".
+        output (str, optional): the national file, in any format of `contour_io`. Defaults to "voronoi_contours_france.parquet".
+        report (str, optional): path of a CSV file where the seam defects are written. Defaults to None.
+        gap_tolerance (float, optional): see `check_seams`. Defaults to 1e-4.
+        min_area (float, optional): see `check_seams`. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: the seam defects
+    """
+    seams = []
+    offset = 0
+    with open_contour_writer(output) as writer:
+        for dep, path in departement_files(directory):
+            contours = read_contours(path)
+            contours = contours[contours.geometry.notna() & ~contours.geometry.is_empty]
+            contours = contours.drop(columns=["id"], errors="ignore").reset_index(drop=True)
+            contours.insert(0, "id", np.arange(offset, offset + len(contours)))
+            contours.insert(1, "departement", dep)
+            # identifiers of the bureaux may be integers in a département and strings in another one
+            contours["id_bv"] = contours["id_bv"].astype(str)
+            offset += len(contours)
+            writer.write(contours)
+            border = border_cells(contours)
+            seams.append(contours.loc[border, ["id", "departement", "geometry"]])
+            print(f"### {dep}: {len(contours)} contours, {border.sum()} along the border")
+            del contours
+    defects = check_seams(
+        gpd.GeoDataFrame(pd.concat(seams, ignore_index=True), geometry="geometry"),
+        gap_tolerance=gap_tolerance,
+        min_area=min_area,
+    )
+    if report is not None:
+        defects.to_csv(report, index=False)
+    print(f"### {offset} contours merged, {(defects['type'] == 'overlap').sum()} overlaps and {(defects['type'] == 'gap').sum()} gaps along the seams")
+    return defects
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the contours of the départements into one national file")
+    parser.add_argument("directory", nargs="?", default="geojson/")
+    parser.add_argument("--output", default="voronoi_contours_france.parquet")
+    parser.add_argument("--report", default="seam_report.csv")
+    parser.add_argument("--gap-tolerance", type=float, default=1e-4, help="in degrees")
+    parser.add_argument("--min-area", type=float, default=1, help="in square meters")
+    args = parser.parse_args()
+    merge_departements(args.directory, args.output, args.report, args.gap_tolerance, args.min_area)
@@ -0,0 +1,105 @@
+"""
+Attach new addresses to a bureau de vote without recomputing the contours: the bureau of a new address is the one of the nearest
+already known address of the same commune, which is exactly the Voronoi cell (computed per commune by `geo.voronoi_hull`) the address falls in.
+Optionally, a majority vote among the k nearest addresses makes the assignment less sensitive to isolated mis-geocoded addresses
+"""
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from geo import METERS_PER_DEGREE_LAT, METERS_PER_DEGREE_LON, deduplicate_points
+
+
+def _project(longitudes: np.ndarray, latitudes: np.ndarray, ref_latitude: float) -> np.ndarray:
+    """
+    Local equirectangular projection (in meters), accurate at the scale of a commune
+    """
+    return np.column_stack(
+        [
+            longitudes * np.cos(np.radians(ref_latitude)) * METERS_PER_DEGREE_LON,
+            latitudes * METERS_PER_DEGREE_LAT,
+        ]
+    )
+
+
+class NearestBureauIndex:
+    """
+    One KD-tree per commune over the cleaned, geocoded addresses, with their "id_bv"
+
+    Args:
+        addresses (pd.DataFrame): the output of `cleaner.clean_failed_geocoding` and `cleaner.prepare_ids`, with columns "longitude", "latitude", "id_bv" and `citycode_column`
+        citycode_column (str, optional): the column giving the commune of the addresses. Defaults to "result_citycode".
+    """
+
+    def __init__(self, addresses: pd.DataFrame, citycode_column: str = "result_citycode"):
+        # one point per position, given to the majority bureau, with its number of addresses as weight of the votes
+        points = deduplicate_points(addresses)
+        longitudes = points["longitude"].to_numpy(dtype=float)
+        latitudes = points["latitude"].to_numpy(dtype=float)
+        id_bvs = points["id_bv"].to_numpy()
+        weights = points["nb_addresses"].to_numpy(dtype=float)
+        # commune -> (reference latitude, tree, id_bv of the points, weights of the points)
+        self.communes: Dict[str, Tuple[float, cKDTree, np.ndarray, np.ndarray]] = {}
+        for citycode, positions in points.groupby(citycode_column, observed=True).indices.items():
+            ref_latitude = float(np.median(latitudes[positions]))
+            self.communes[str(citycode)] = (
+                ref_latitude,
+                cKDTree(_project(longitudes[positions], latitudes[positions], ref_latitude)),
+                id_bvs[positions],
+                weights[positions],
+            )
+        # for addresses in communes without any known address
+        ref_latitude = float(np.median(latitudes))
+        self.fallback = (ref_latitude, cKDTree(_project(longitudes, latitudes, ref_latitude)), id_bvs, weights)
+
+    @staticmethod
+    def _query(index: Tuple, longitudes: np.ndarray, latitudes: np.ndarray, k: int) -> np.ndarray:
+        ref_latitude, tree, id_bvs, weights = index
+        k = min(k, tree.n)
+        _, neighbours = tree.query(_project(longitudes, latitudes, ref_latitude), k=k)
+        if k == 1:
+            return id_bvs[neighbours]
+        # weighted majority vote among the k nearest points; argmax keeps the nearest bureau in case of ties
+        votes = id_bvs[neighbours]
+        same = votes[:, :, None] == votes[:, None, :]
+        scores = (same * weights[neighbours][:, None, :]).sum(axis=2)
+        return votes[np.arange(len(votes)), scores.argmax(axis=1)]
+
+    def assign(
+        self,
+        longitudes: np.ndarray,
+        latitudes: np.ndarray,
+        citycodes: np.ndarray,
+        k: int = 1,
+    ) -> np.ndarray:
+        """
+        Find the bureau de vote of new addresses
+
+        Args:
+            longitudes (np.ndarray):
+            latitudes (np.ndarray):
+            citycodes (np.ndarray): the commune of each new address
+            k (int, optional): number of neighbours taking part in the vote. Defaults to 1 (nearest neighbour, same answer as the Voronoi cell).
+
+        Returns:
+            np.ndarray: the "id_bv" of each new address
+        """
+        longitudes = np.asarray(longitudes, dtype=float)
+        latitudes = np.asarray(latitudes, dtype=float)
+        codes = pd.Series(np.asarray(citycodes).astype(str))
+        id_bvs = np.empty(len(codes), dtype=self.fallback[2].dtype)
+        for citycode, positions in codes.groupby(codes).indices.items():
+            index = self.communes.get(citycode, self.fallback)
+            id_bvs[positions] = self._query(index, longitudes[positions], latitudes[positions], k)
+        return id_bvs
+
+    def assign_addresses(
+        self, df: pd.DataFrame, citycode_column: str = "result_citycode", k: int = 1
+    ) -> pd.DataFrame:
+        """
+        Add the column "id_bv" (in place) to a table of new geocoded addresses, with columns "longitude", "latitude" and `citycode_column`
+        """
+        df["id_bv"] = self.assign(df["longitude"], df["latitude"], df[citycode_column], k=k)
+        return df
@@ -0,0 +1,348 @@
+"""
+Stage-based pipeline from the raw INSEE addresses to the maps of the bureaux de vote. Every stage writes a checkpoint (typed parquet for
+the tables, HTML for the maps) in the work directory, along with a fingerprint of its inputs and parameters: a stage whose fingerprint
+did not change since its last run is skipped. Stages can be requested individually (their missing or outdated inputs are rebuilt first),
+for a subset of départements, and stages that do not depend on each other run concurrently.
+
+Stages:
+    - "load": read and clean the raw addresses (names removed, normalized columns)
+    - "geocode": geocode the addresses with the API-adresse
+    - "partition": split the geocoded addresses into one parquet file per département, in one pass over the national table
+    - "communes": load the shapes of the communes (see `commune_store`)
+    - "clean" (per département): remove failed geocoding and outliers, add the "id_bv" and keep one point per position
+    - "addresses_map" (per département): map with one point per address
+    - "voronoi_map" (per département): map of the Voronoi contours of the bureaux
+
+Usage:
+    python pipeline.py addresses.csv --communes communes-20220101.shp --departements 09 --stages voronoi_map
+"""
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Dict, List
+
+import geopandas as gpd
+import pandas as pd
+
+from commune_store import CommuneStore, write_commune_store
+from loader import departement_of, read_addresses
+
+STAGES = ["load", "geocode", "partition", "communes", "clean", "addresses_map", "voronoi_map"]
+PER_DEPARTEMENT = ["clean", "addresses_map", "voronoi_map"]
+DEPENDENCIES = {
+    "load": [],
+    "geocode": ["load"],
+    "partition": ["geocode"],
+    "communes": [],
+    "clean": ["partition", "communes"],
+    "addresses_map": ["clean", "communes"],
+    "voronoi_map": ["clean", "communes"],
+}
+# parameters of the stages, part of their fingerprint
+PARAMETERS = {
+    "clean": {"max_distance_ratio": 10, "min_outlier_distance": 1000},
+}
+
+
+def _file_fingerprint(path: str) -> str:
+    """
+    Fingerprint of an input file of the pipeline, from its size and modification time (hashing gigabytes of addresses would take longer
+    than some of the stages)
+    """
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _fingerprint(**content) -> str:
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@contextmanager
+def _atomic_output(path: str):
+    """
+    Yield a temporary path, moved to `path` once the block completes, so that an interrupted stage never leaves a checkpoint behind
+    """
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".tmp_{name}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _stage_load(inputs: Dict[str, str], output: str, source: str, **_):
+    from cleaner import clean_dataset
+
+    df = clean_dataset(read_addresses(source, sep=";"))
+    # check that names preceded with a "chez" have been removed
+    df = df.drop(columns=["libelle_voie_clean", "comp_adr_1_clean", "comp_adr_2_clean", "lieu-dit-clean"], errors="ignore")
+    with _atomic_output(output) as tmp_path:
+        df.to_parquet(tmp_path, index=False)
+
+
+def _stage_geocode(inputs: Dict[str, str], output: str, **_):
+    from geo import add_geoloc
+
+    # the CSV files exchanged with the API-adresse stay out of the working directory
+    with tempfile.TemporaryDirectory() as directory:
+        geocoded = add_geoloc(pd.read_parquet(inputs["load"]), directory=directory)
+    with _atomic_output(output) as tmp_path:
+        geocoded.to_parquet(tmp_path, index=False)
+
+
+def _stage_partition(inputs: Dict[str, str], output: str, **_):
+    from streaming import iter_address_batches, partition_by_departement
+
+    # the files of a previous run are removed, a département may have disappeared from the addresses
+    if os.path.isdir(output):
+        for name in os.listdir(output):
+            if name.startswith("table_") and name.endswith(".parquet"):
+                os.remove(os.path.join(output, name))
+    partition_by_departement(iter_address_batches(inputs["geocode"]), output_dir=output, citycode_column="result_citycode")
+
+
+def _stage_communes(inputs: Dict[str, str], output: str, communes_path: str, **_):
+    communes = gpd.read_file(communes_path)
+    communes = communes.rename(columns={"code": "insee"})[["insee", "geometry"]].dropna()
+    communes["insee"] = communes["insee"].astype(str).str.split(".").str[0]
+    # memory-mapped by the per-département stages, each one parsing only the communes of its département
+    write_commune_store(communes, output)
+
+
+def _read_communes(path: str, departement: str) -> gpd.GeoDataFrame:
+    return CommuneStore(path).departement(departement)
+
+
+def _stage_clean(inputs: Dict[str, str], output: str, departement: str, max_distance_ratio: float, min_outlier_distance: float, **_):
+    from cleaner import clean_failed_geocoding, clean_geocoded_types, prepare_ids
+    from geo import deduplicate_points
+
+    # only the file of the département is read (see the "partition" stage)
+    geocoded = clean_geocoded_types(read_addresses(os.path.join(inputs["partition"], f"table_{departement}.parquet")))
+    geocoded = clean_failed_geocoding(
+        geocoded,
+        communes=_read_communes(inputs["communes"], departement),
+        max_distance_ratio=max_distance_ratio,
+        min_outlier_distance=min_outlier_distance,
+    )
+    geocoded = prepare_ids(geocoded)
+    # IMPORTANT: when there is two points at the position lat-lon, keep only one (the one of the majority bureau de vote)
+    geocoded = deduplicate_points(geocoded)
+    with _atomic_output(output) as tmp_path:
+        geocoded.to_parquet(tmp_path, index=False)
+
+
+def _stage_addresses_map(inputs: Dict[str, str], output: str, departement: str, **_):
+    from display import display_addresses
+
+    deck = display_addresses(
+        addresses=read_addresses(inputs["clean"]), communes=_read_communes(inputs["communes"], departement)
+    )
+    with _atomic_output(output) as tmp_path:
+        deck.to_html(tmp_path)
+
+
+def _stage_voronoi_map(inputs: Dict[str, str], output: str, departement: str, profile: bool = False, **_):
+    from display import display_bureau_vote_shapes
+    from profiling import RunProfiler
+
+    profiler = RunProfiler(departement) if profile else None
+    deck = display_bureau_vote_shapes(
+        addresses=read_addresses(inputs["clean"]),
+        communes=_read_communes(inputs["communes"], departement),
+        mode="voronoi",
+        profiler=profiler,
+    )
+    with _atomic_output(output) as tmp_path:
+        deck.to_html(tmp_path)
+    if profile:
+        profiler.to_json(os.path.join(os.path.dirname(output), f"run_report_{departement}.json"))
+
+
+STAGE_FUNCTIONS = {
+    "load": _stage_load,
+    "geocode": _stage_geocode,
+    "partition": _stage_partition,
+    "communes": _stage_communes,
+    "clean": _stage_clean,
+    "addresses_map": _stage_addresses_map,
+    "voronoi_map": _stage_voronoi_map,
+}
+
+
+def _run_task(stage: str, inputs: Dict[str, str], output: str, fingerprint: str, kwargs: dict) -> str:
+    STAGE_FUNCTIONS[stage](inputs, output, **kwargs)
+    with _atomic_output(output + ".fingerprint") as tmp_path:
+        with open(tmp_path, "w") as file:
+            file.write(fingerprint)
+    return output
+
+
+class Pipeline:
+    """
+    The tasks (one per stage, and per département for the stages of `PER_DEPARTEMENT`) of a run, with their checkpoints
+
+    Args:
+        source (str): the raw addresses (INSEE file, CSV separated by ";")
+        communes_path (str, optional): the shapes of the communes (any format read by geopandas, with column "insee" or "code"). Defaults to "communes-20220101.shp".
+        work_dir (str, optional): where the checkpoints and the maps are written. Defaults to "work".
+        profile (bool, optional): write a JSON run report of the Voronoi computation of every département. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        communes_path: str = "communes-20220101.shp",
+        work_dir: str = "work",
+        profile: bool = False,
+    ):
+        self.source = source
+        self.communes_path = communes_path
+        self.work_dir = work_dir
+        self.profile = profile
+        os.makedirs(work_dir, exist_ok=True)
+
+    def output(self, stage: str, departement: str = None) -> str:
+        names = {
+            "load": "addresses_clean.parquet",
+            "geocode": "addresses_geocoded.parquet",
+            "partition": "departements",
+            "communes": "communes.store",
+            "clean": f"points_{departement}.parquet",
+            "addresses_map": f"scatterplot_layer_{departement}.html",
+            "voronoi_map": f"voronoi_layer_{departement}.html",
+        }
+        return os.path.join(self.work_dir, names[stage])
+
+    def _tasks(self, stages: List[str], departements: List[str]) -> Dict[tuple, dict]:
+        """
+        The tasks needed by `stages` (dependencies included), keyed by (stage, département), with their fingerprints
+        """
+        tasks = {}
+
+        def add(stage: str, departement: str = None) -> str:
+            key = (stage, departement)
+            if key in tasks:
+                return tasks[key]["fingerprint"]
+            dependencies = [
+                (upstream, departement if upstream in PER_DEPARTEMENT else None)
+                for upstream in DEPENDENCIES[stage]
+            ]
+            upstream_fingerprints = [add(*dependency) for dependency in dependencies]
+            kwargs = dict(PARAMETERS.get(stage, {}))
+            if stage == "load":
+                kwargs["source"] = self.source
+                upstream_fingerprints.append(_file_fingerprint(self.source))
+            if stage == "communes":
+                kwargs["communes_path"] = self.communes_path
+                upstream_fingerprints.append(_file_fingerprint(self.communes_path))
+            if stage in PER_DEPARTEMENT:
+                kwargs["departement"] = departement
+            if stage == "voronoi_map":
+                kwargs["profile"] = self.profile
+            tasks[key] = {
+                "dependencies": dependencies,
+                "inputs": {upstream: self.output(upstream, dep) for upstream, dep in dependencies},
+                "output": self.output(stage, departement),
+                "kwargs": kwargs,
+                "fingerprint": _fingerprint(stage=stage, kwargs=kwargs, upstream=upstream_fingerprints),
+            }
+            return tasks[key]["fingerprint"]
+
+        for stage in stages:
+            for departement in departements if stage in PER_DEPARTEMENT else [None]:
+                add(stage, departement)
+        return tasks
+
+    def is_up_to_date(self, task: dict) -> bool:
+        try:
+            with open(task["output"] + ".fingerprint") as file:
+                return os.path.exists(task["output"]) and file.read() == task["fingerprint"]
+        except FileNotFoundError:
+            return False
+
+    def departements(self) -> List[str]:
+        """
+        The départements found in the geocoded addresses
+        """
+        self.run(["geocode"], [])
+        citycodes = pd.read_parquet(self.output("geocode"), columns=["result_citycode"])["result_citycode"]
+        return sorted(departement_of(citycodes.dropna()).unique())
+
+    def run(
+        self,
+        stages: List[str] = None,
+        departements: List[str] = None,
+        workers: int = None,
+        force: bool = False,
+    ) -> List[str]:
+        """
+        Run the requested stages, and the stages they depend on, skipping the stages whose checkpoint is up to date
+
+        Args:
+            stages (List[str], optional): Defaults to None (all of them).
+            departements (List[str], optional): Defaults to None (the départements found in the geocoded addresses).
+            workers (int, optional): number of processes running independent stages. Defaults to None (the number of CPUs), 1 to run in the current process.
+            force (bool, optional): run the requested stages (not their dependencies) even if their checkpoint is up to date. Defaults to False.
+
+        Returns:
+            List[str]: the outputs of the stages that were run
+        """
+        stages = stages or STAGES
+        assert set(stages) <= set(STAGES), f"unknown stages: {set(stages) - set(STAGES)}"
+        if departements is None and any(stage in PER_DEPARTEMENT for stage in stages):
+            departements = self.departements()
+        tasks = self._tasks(stages, departements or [])
+        pending = {
+            key: task for key, task in tasks.items()
+            if not self.is_up_to_date(task) or (force and key[0] in stages)
+        }
+        done, outputs = set(), []
+        for key in tasks:
+            if key not in pending:
+                print(f"### {':'.join(filter(None, key))} up to date, skipped")
+                done.add(key)
+        if workers == 1:
+            # dependencies are inserted before the tasks needing them
+            for key, task in pending.items():
+                outputs.append(_run_task(key[0], task["inputs"], task["output"], task["fingerprint"], task["kwargs"]))
+                print(f"### {':'.join(filter(None, key))} done")
+            return outputs
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            while pending or running:
+                for key in [k for k, task in pending.items() if set(task["dependencies"]) <= done]:
+                    task = pending.pop(key)
+                    future = executor.submit(
+                        _run_task, key[0], task["inputs"], task["output"], task["fingerprint"], task["kwargs"]
+                    )
+                    running[future] = key
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    outputs.append(future.result())
+                    done.add(key)
+                    print(f"### {':'.join(filter(None, key))} done")
+        return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stages of the pipeline, skipping the stages that are up to date")
+    parser.add_argument("source", help="the raw addresses (INSEE file)")
+    parser.add_argument("--communes", default="communes-20220101.shp", help="the shapes of the communes")
+    parser.add_argument("--work-dir", default="work")
+    parser.add_argument("--stages", nargs="*", choices=STAGES, default=None)
+    parser.add_argument("--departements", nargs="*", default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="run the requested stages even if they are up to date")
+    parser.add_argument("--profile", action="store_true", help="write a run report of the Voronoi computation")
+    args = parser.parse_args()
+    Pipeline(args.source, args.communes, args.work_dir, args.profile).run(
+        args.stages, args.departements, args.workers, args.force
+    )
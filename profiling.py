@@ -0,0 +1,154 @@
+"""
+Optional instrumentation of the contour computation: wall time, peak memory and geometry counts per stage and per commune.
+When no profiler is given, the geo functions use `NULL_PROFILER`, whose methods do nothing
+"""
+import json
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Peak resident set size of the current process since its start
+
+    Returns:
+        Optional[float]: the peak RSS in MB, or None if it cannot be measured on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak / 1024**2
+    return peak / 1024
+
+
+class NullProfiler:
+    """
+    Profiler that records nothing, used by default so that instrumentation costs (almost) nothing when disabled
+    """
+
+    enabled = False
+
+    def stage(self, name: str):
+        return nullcontext({})
+
+    def commune(self, citycode: str, stage: str):
+        return nullcontext({})
+
+    def fallback(self, citycode: str, stage: str, level: str):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class RunProfiler:
+    """
+    Record wall time, peak RSS and geometry counts for each stage of a run, and wall time per commune inside the stages.
+    The context managers `stage` and `commune` yield a dictionary where the caller can store counts (e.g. number of output geometries)
+
+    Args:
+        name (str, optional): a name for the run (typically the département), written in the report. Defaults to "".
+    """
+
+    enabled = True
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.start = time.perf_counter()
+        self.stages = []
+        # (stage, citycode) -> {"seconds": float, "calls": int, counts...}
+        self.communes = defaultdict(lambda: {"seconds": 0.0, "calls": 0})
+        self.fallbacks = []
+
+    @contextmanager
+    def stage(self, name: str):
+        counts = {}
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            rss_after = peak_rss_mb()
+            self.stages.append(
+                {
+                    "stage": name,
+                    "seconds": time.perf_counter() - start,
+                    "peak_rss_mb": rss_after,
+                    "peak_rss_growth_mb": None
+                    if rss_before is None
+                    else rss_after - rss_before,
+                    **counts,
+                }
+            )
+
+    @contextmanager
+    def commune(self, citycode: str, stage: str):
+        counts = {}
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            record = self.communes[(stage, citycode)]
+            record["seconds"] += time.perf_counter() - start
+            record["calls"] += 1
+            for key, value in counts.items():
+                record[key] = record.get(key, 0) + value
+
+    def fallback(self, citycode: str, stage: str, level: str):
+        """
+        Record that a commune needed a repair fallback (e.g. row-by-row intersection, simplify, make_valid)
+        """
+        self.fallbacks.append({"result_citycode": citycode, "stage": stage, "level": level})
+
+    def report(self, top: int = 20) -> Dict:
+        """
+        Build the run report
+
+        Args:
+            top (int, optional): number of slowest communes to list. Defaults to 20.
+
+        Returns:
+            Dict: a JSON-serializable report with the stages, the slowest communes (all stages summed) and the repair fallbacks
+        """
+        per_commune = defaultdict(lambda: {"seconds": 0.0, "stages": {}})
+        for (stage, citycode), record in self.communes.items():
+            per_commune[citycode]["seconds"] += record["seconds"]
+            per_commune[citycode]["stages"][stage] = dict(record)
+        slowest = sorted(
+            per_commune.items(), key=lambda item: item[1]["seconds"], reverse=True
+        )[:top]
+        fallbacks_per_commune = defaultdict(list)
+        for fallback in self.fallbacks:
+            fallbacks_per_commune[fallback["result_citycode"]].append(
+                f"{fallback['stage']}:{fallback['level']}"
+            )
+        return {
+            "name": self.name,
+            "total_seconds": time.perf_counter() - self.start,
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": self.stages,
+            "slowest_communes": [
+                {"result_citycode": citycode, **record} for citycode, record in slowest
+            ],
+            "fallbacks": [
+                {"result_citycode": citycode, "levels": levels}
+                for citycode, levels in fallbacks_per_commune.items()
+            ],
+        }
+
+    def to_json(self, path: str, top: int = 20):
+        """
+        Write the run report (see `report`) to a JSON file
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(top=top), f, indent=2, default=str)
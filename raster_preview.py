@@ -0,0 +1,196 @@
+"""
+Raster preview of the bureaux de vote of a département, in seconds instead of the exact Voronoi computation of
+`geo.get_clipped_voronoi_shapes`: a regular grid covers the communes, each grid cell is given to the commune containing its centre
+(`shapely.contains_xy`, commune by commune on the window of its bounding box), then to the bureau of the nearest address of this commune
+(bulk KD-tree queries, see `nearest_bureau.NearestBureauIndex`), which is the Voronoi cell its centre falls in. The grid can be vectorized
+back into polygons, at the resolution of the grid.
+
+The preview is meant for a first look at a département, and to pick the communes worth the exact computation (see `commune_report`).
+
+Usage:
+    python raster_preview.py 09 --communes ../communes-5m.geojson --output preview_09.parquet --report preview_09.csv
+"""
+import argparse
+from typing import Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from dissolve import _dissolve
+from geo import METERS_PER_DEGREE_LAT, METERS_PER_DEGREE_LON
+from nearest_bureau import NearestBureauIndex
+
+# side of the grid cells
+RASTER_RESOLUTION_METERS = 100
+
+
+def rasterize_communes(
+    communes: gpd.GeoDataFrame, resolution: float = RASTER_RESOLUTION_METERS
+) -> Tuple[np.ndarray, Tuple[float, float, float, float]]:
+    """
+    Grid covering the communes, each cell holding the position of the commune containing its centre
+
+    Args:
+        communes (gpd.GeoDataFrame): the shapes of the communes, in longitude/latitude
+        resolution (float, optional): side of the cells in meters. Defaults to RASTER_RESOLUTION_METERS.
+
+    Returns:
+        Tuple[np.ndarray, Tuple[float, float, float, float]]: the grid (rows from north to south, -1 outside the communes), and its transform (xmin, ymax, dx, dy) in degrees
+    """
+    xmin, ymin, xmax, ymax = communes.total_bounds
+    dy = resolution / METERS_PER_DEGREE_LAT
+    dx = resolution / (METERS_PER_DEGREE_LON * np.cos(np.radians((ymin + ymax) / 2)))
+    n_cols, n_rows = int(np.ceil((xmax - xmin) / dx)), int(np.ceil((ymax - ymin) / dy))
+    grid = np.full((n_rows, n_cols), -1, dtype=np.int32)
+    geometries = communes.geometry.to_numpy()
+    shapely.prepare(geometries)
+    for position, (geometry, (gxmin, gymin, gxmax, gymax)) in enumerate(zip(geometries, shapely.bounds(geometries))):
+        if geometry is None or shapely.is_empty(geometry):
+            continue
+        # the window of the grid covering the bounding box of the commune
+        col0, col1 = int((gxmin - xmin) / dx), min(int(np.ceil((gxmax - xmin) / dx)), n_cols)
+        row0, row1 = int((ymax - gymax) / dy), min(int(np.ceil((ymax - gymin) / dy)), n_rows)
+        xs = xmin + (np.arange(col0, col1) + 0.5) * dx
+        ys = ymax - (np.arange(row0, row1) + 0.5) * dy
+        window = grid[row0:row1, col0:col1]
+        inside = shapely.contains_xy(geometry, xs[None, :], ys[:, None]) & (window < 0)
+        window[inside] = position
+    return grid, (xmin, ymax, dx, dy)
+
+
+def raster_preview(
+    gdf: gpd.GeoDataFrame, communes: gpd.GeoDataFrame, resolution: float = RASTER_RESOLUTION_METERS
+) -> Tuple[np.ndarray, pd.DataFrame, Tuple[float, float, float, float]]:
+    """
+    Give each cell of a grid over the communes the bureau of the nearest address of its commune
+
+    Args:
+        gdf (gpd.GeoDataFrame): Points of the addresses, with columns "id_bv" and "result_citycode" (the output of `geo.build_geojson_point`)
+        communes (gpd.GeoDataFrame): the shapes of the communes, with column "insee"
+        resolution (float, optional): side of the cells in meters. Defaults to RASTER_RESOLUTION_METERS.
+
+    Returns:
+        Tuple[np.ndarray, pd.DataFrame, Tuple[float, float, float, float]]: the grid of the positions of the bureaux in the table (-1 outside the communes), the table of the bureaux (columns "id_bv" and "result_citycode"; "{insee}_X" for the communes without any address, as in `geo.voronoi_hull`), and the transform of the grid (see `rasterize_communes`)
+    """
+    commune_grid, transform = rasterize_communes(communes, resolution)
+    xmin, ymax, dx, dy = transform
+    rows, cols = np.nonzero(commune_grid >= 0)
+    citycodes = communes["insee"].astype(str).to_numpy()[commune_grid[rows, cols]]
+    addresses = pd.DataFrame(
+        {
+            "longitude": shapely.get_x(gdf.geometry.values),
+            "latitude": shapely.get_y(gdf.geometry.values),
+            "id_bv": gdf["id_bv"].to_numpy(),
+            "result_citycode": gdf["result_citycode"].astype(str).to_numpy(),
+        }
+    )
+    index = NearestBureauIndex(addresses)
+    known = np.isin(citycodes, list(index.communes))
+    id_bvs = np.char.add(citycodes, "_X").astype(object)
+    if known.any():
+        id_bvs[known] = index.assign(
+            xmin + (cols[known] + 0.5) * dx, ymax - (rows[known] + 0.5) * dy, citycodes[known]
+        )
+    cells = pd.DataFrame({"id_bv": id_bvs, "result_citycode": citycodes})
+    codes = cells.groupby(["id_bv", "result_citycode"], sort=False).ngroup().to_numpy()
+    _, first = np.unique(codes, return_index=True)
+    grid = np.full(commune_grid.shape, -1, dtype=np.int32)
+    grid[rows, cols] = codes
+    return grid, cells.iloc[first].reset_index(drop=True), transform
+
+
+def raster_to_polygons(
+    grid: np.ndarray, bureaux: pd.DataFrame, transform: Tuple[float, float, float, float]
+) -> gpd.GeoDataFrame:
+    """
+    Vectorize a grid of bureaux: the runs of consecutive cells of the same bureau along the rows become rectangles, dissolved by bureau
+
+    Returns:
+        gpd.GeoDataFrame: the columns of `bureaux` and the geometry (Polygon or MultiPolygon) of each bureau present in the grid
+    """
+    xmin, ymax, dx, dy = transform
+    # starts of the runs: first column, or change of label along the row
+    starts = np.ones(grid.shape, dtype=bool)
+    starts[:, 1:] = grid[:, 1:] != grid[:, :-1]
+    rows, cols = np.nonzero(starts)
+    ends = np.append(cols[1:], grid.shape[1])
+    ends[np.flatnonzero(np.diff(rows))] = grid.shape[1]
+    labels = grid[rows, cols]
+    keep = labels >= 0
+    rows, cols, ends, labels = rows[keep], cols[keep], ends[keep], labels[keep]
+    boxes = shapely.box(xmin + cols * dx, ymax - (rows + 1) * dy, xmin + ends * dx, ymax - rows * dy)
+    present = np.unique(labels)
+    shapes = _dissolve(boxes, np.searchsorted(present, labels), workers=1)
+    return gpd.GeoDataFrame(bureaux.iloc[present].reset_index(drop=True), geometry=shapes, crs="EPSG:4326")
+
+
+def raster_preview_shapes(
+    gdf: gpd.GeoDataFrame, communes: gpd.GeoDataFrame, resolution: float = RASTER_RESOLUTION_METERS
+) -> gpd.GeoDataFrame:
+    """
+    Approximate shapes of the bureaux de vote (see `raster_preview` and `raster_to_polygons`)
+
+    Returns:
+        gpd.GeoDataFrame: include "geometry", "id_bv" and "result_citycode", one row per bureau
+    """
+    return raster_to_polygons(*raster_preview(gdf, communes, resolution))
+
+
+def commune_report(shapes: gpd.GeoDataFrame) -> pd.DataFrame:
+    """
+    Summary of the preview shapes per commune, to pick the communes worth the exact computation: the communes with many bureaux, or
+    with bureaux split in several parts (mixed addresses), deserve it first
+
+    Args:
+        shapes (gpd.GeoDataFrame): the output of `raster_preview_shapes`
+
+    Returns:
+        pd.DataFrame: one row per commune, with columns "result_citycode", "n_bureaux", "n_parts" (number of connected parts of the bureaux) and "n_split_bureaux", sorted by decreasing "n_split_bureaux" and "n_bureaux"
+    """
+    n_parts = shapely.get_num_geometries(shapes.geometry.to_numpy())
+    report = (
+        pd.DataFrame({"result_citycode": shapes["result_citycode"], "n_parts": n_parts, "split": n_parts > 1})
+        .groupby("result_citycode")
+        .agg(n_bureaux=("n_parts", "size"), n_parts=("n_parts", "sum"), n_split_bureaux=("split", "sum"))
+        .reset_index()
+    )
+    return report.sort_values(["n_split_bureaux", "n_bureaux"], ascending=False, ignore_index=True)
+
+
+if __name__ == "__main__":
+    import time
+
+    from contour_io import open_contour_writer
+    from geo import build_geojson_point
+    from loader import read_addresses
+
+    parser = argparse.ArgumentParser(description="Approximate map of the bureaux de vote of a département, from a grid")
+    parser.add_argument("departement")
+    parser.add_argument("--addresses", default=None, help="defaults to parquet/table_{DEP}.parquet")
+    parser.add_argument("--communes", default="./../communes-5m.geojson")
+    parser.add_argument("--resolution", type=float, default=RASTER_RESOLUTION_METERS, help="side of the grid cells (m)")
+    parser.add_argument("--output", default=None, help="file of the preview shapes (any format of contour_io)")
+    parser.add_argument("--report", default=None, help="CSV file of the summary per commune")
+    args = parser.parse_args()
+
+    DEP = args.departement
+    addresses_df = read_addresses(
+        args.addresses or f"parquet/table_{DEP}.parquet",
+        columns=["id_brut_bv", "code_commune_ref", "longitude", "latitude"],
+    )
+    addresses_df["id_bv"] = addresses_df["id_brut_bv"]
+    addresses_df["commune_bv"] = addresses_df["code_commune_ref"]
+    addresses_df["result_citycode"] = addresses_df["code_commune_ref"]
+    communes_france = gpd.read_file(args.communes).rename({"code": "insee"}, axis=1)[["insee", "geometry"]]
+    communes_dep = communes_france[communes_france.insee.str.startswith(str(DEP))]
+
+    start = time.perf_counter()
+    preview = raster_preview_shapes(build_geojson_point(addresses_df), communes_dep, args.resolution)
+    print(f"### {len(preview)} bureaux in {time.perf_counter() - start:.1f}s")
+    if args.output:
+        with open_contour_writer(args.output) as writer:
+            writer.write(preview)
+    if args.report:
+        commune_report(preview).to_csv(args.report, index=False)
@@ -0,0 +1,179 @@
+"""
+Out-of-core processing of the national address table. The table is never loaded as a whole: it is read by Arrow record batches, every
+batch is cleaned and given its "id_bv" on its own (these steps only look at one row at a time), and the rows are appended to one parquet
+file per département. The geometry work then loads a département with only the columns it needs, and computes the contours by groups of
+whole communes (`iter_commune_groups`), so that only one group of communes is in memory at a time.
+"""
+import os
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+from cleaner import clean_failed_geocoding, clean_geocoded_types, prepare_ids
+from loader import compact_addresses, departement_of
+
+
+def iter_address_batches(
+    path: str, columns: List[str] = None, batch_size: int = 500_000, sep: str = ";"
+) -> Iterator[pd.DataFrame]:
+    """
+    Read an address table (CSV or parquet) by batches of rows, with compact dtypes (see `loader.compact_addresses`)
+
+    Args:
+        path (str): path of a ".csv" or ".parquet" file
+        columns (List[str], optional): the subset of columns to read. Defaults to None (all columns).
+        batch_size (int, optional): number of rows of the batches (approximate for CSV files). Defaults to 500_000.
+        sep (str, optional): separator of CSV files. Defaults to ";".
+
+    Yields:
+        pd.DataFrame: the successive batches of the table
+    """
+    if os.path.splitext(path)[1] == ".parquet":
+        batches = pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns)
+    else:
+        parse_options = pv.ParseOptions(delimiter=sep)
+        names = pv.open_csv(path, parse_options=parse_options).schema.names
+        batches = pv.open_csv(
+            path,
+            # blocks of about `batch_size` rows of 200 bytes
+            read_options=pv.ReadOptions(block_size=batch_size * 200),
+            parse_options=parse_options,
+            # every column stays a string, so that codes keep their leading zeros
+            convert_options=pv.ConvertOptions(
+                column_types={name: pa.string() for name in names}, include_columns=columns
+            ),
+        )
+    for batch in batches:
+        yield compact_addresses(batch.to_pandas())
+
+
+def _arrow_table(df: pd.DataFrame, schema: pa.Schema = None) -> pa.Table:
+    """
+    Arrow table of a batch, with the same schema for every batch: the categoricals are written as strings (their dictionaries differ
+    from one batch to the other) and the integers as int64 (`loader.compact_id_bv` picks the narrowest type of each batch)
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in table.schema:
+        if pa.types.is_dictionary(field.type):
+            field = field.with_type(field.type.value_type)
+        elif pa.types.is_integer(field.type):
+            field = field.with_type(pa.int64())
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    table = table.cast(pa.schema(fields))
+    return table if schema is None else table.cast(schema)
+
+
+def clean_batch(df: pd.DataFrame, communes: gpd.GeoDataFrame = None) -> pd.DataFrame:
+    """
+    The cleaning steps that only need one row at a time, applied to a batch of geocoded addresses: types, failed geocoding, points outside
+    their commune (see `cleaner.clean_failed_geocoding`) and "id_bv" (see `cleaner.prepare_ids`).
+    The distance outliers need all the addresses of a bureau de vote, they are removed once the département is loaded
+
+    Args:
+        df (pd.DataFrame): a batch of geocoded addresses
+        communes (gpd.GeoDataFrame, optional): the shapes of the communes. Defaults to None (no spatial check).
+
+    Returns:
+        pd.DataFrame: the cleaned batch
+    """
+    return prepare_ids(clean_failed_geocoding(clean_geocoded_types(df), communes=communes))
+
+
+def partition_by_departement(
+    batches: Iterable[pd.DataFrame],
+    output_dir: str = "parquet/",
+    citycode_column: str = "code_commune_ref",
+    transform: Callable[[pd.DataFrame], pd.DataFrame] = None,
+    skip: List[str] = (),
+) -> Dict[str, int]:
+    """
+    Append the batches of an address table to one parquet file per département (`{output_dir}/table_{DEP}.parquet`), one row group per
+    batch and département. The files are written under temporary names and moved to their final paths once every batch is written
+
+    Args:
+        batches (Iterable[pd.DataFrame]): the batches of the table, e.g. `iter_address_batches(path)`
+        output_dir (str, optional): Defaults to "parquet/".
+        citycode_column (str, optional): the column giving the commune of the addresses. Defaults to "code_commune_ref".
+        transform (Callable, optional): applied to each batch before it is written, e.g. `clean_batch`. Defaults to None.
+        skip (List[str], optional): départements not written (e.g. already processed). Defaults to ().
+
+    Returns:
+        Dict[str, int]: the number of rows written per département
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    writers: Dict[str, pq.ParquetWriter] = {}
+    counts: Dict[str, int] = {}
+
+    def tmp_path(dep: str) -> str:
+        return os.path.join(output_dir, f".tmp_table_{dep}.parquet")
+
+    try:
+        for batch in batches:
+            if transform is not None:
+                batch = transform(batch)
+            departements = departement_of(batch[citycode_column]).to_numpy()
+            for dep, positions in pd.Series(np.arange(len(batch))).groupby(departements).indices.items():
+                if dep in skip:
+                    continue
+                if dep not in writers:
+                    table = _arrow_table(batch.take(positions))
+                    writers[dep] = pq.ParquetWriter(tmp_path(dep), table.schema)
+                else:
+                    table = _arrow_table(batch.take(positions), writers[dep].schema)
+                writers[dep].write_table(table)
+                counts[dep] = counts.get(dep, 0) + len(positions)
+    except BaseException:
+        for dep, writer in writers.items():
+            writer.close()
+            os.remove(tmp_path(dep))
+        raise
+    for dep, writer in writers.items():
+        writer.close()
+        os.replace(tmp_path(dep), os.path.join(output_dir, f"table_{dep}.parquet"))
+    return counts
+
+
+def iter_commune_groups(
+    points: gpd.GeoDataFrame,
+    communes: gpd.GeoDataFrame,
+    max_points: int = 200_000,
+    citycode_column: str = "result_citycode",
+) -> Iterator[Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]]:
+    """
+    Split the points of a département into groups of whole communes, with at most `max_points` points per group (unless a single commune
+    has more), to compute the contours one group at a time (the Voronoi cells of a commune only depend on the points of the commune)
+
+    Args:
+        points (gpd.GeoDataFrame): e.g. the output of `geo.build_geojson_point`
+        communes (gpd.GeoDataFrame): the shapes of the communes, with column "insee"
+        max_points (int, optional): Defaults to 200_000.
+        citycode_column (str, optional): the column giving the commune of the points. Defaults to "result_citycode".
+
+    Yields:
+        Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]: the points and the communes of each group
+    """
+    positions = points.groupby(citycode_column, observed=True).indices
+    commune_positions = communes.groupby("insee", observed=True).indices
+    # communes without any point are also processed (their contour is the commune itself)
+    citycodes = sorted(set(map(str, positions)) | set(map(str, commune_positions)))
+    positions = {str(code): pos for code, pos in positions.items()}
+    commune_positions = {str(code): pos for code, pos in commune_positions.items()}
+    group, n_points = [], 0
+    for k, citycode in enumerate(citycodes):
+        group.append(citycode)
+        n_points += len(positions.get(citycode, []))
+        following = len(positions.get(citycodes[k + 1], [])) if k + 1 < len(citycodes) else 0
+        if k + 1 == len(citycodes) or n_points + following > max_points:
+            yield (
+                points.take(np.concatenate([positions.get(code, np.array([], dtype=np.int64)) for code in group])),
+                communes.take(np.concatenate([commune_positions.get(code, np.array([], dtype=np.int64)) for code in group])),
+            )
+            group, n_points = [], 0
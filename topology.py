@@ -0,0 +1,296 @@
+"""
+Shared-edge (TopoJSON) representation of contours. Neighbouring bureaux share their common border: in a topology, this border is stored
+once as an "arc" referenced by both polygons, instead of twice as in GeoJSON. Simplifying the arcs (instead of each polygon independently)
+keeps the neighbours glued together: no gap nor overlap appears between them.
+
+The topology is a dict following the TopoJSON specification (https://github.com/topojson/topojson-specification), with quantized and
+delta-encoded arcs, so it can be written as is with `json.dump` and read by the usual web mapping libraries
+"""
+import json
+from typing import Dict, List
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+
+def _polygonal(geometry):
+    """
+    Keep only the polygonal parts of a geometry (intersections with the communes can produce GeometryCollections)
+    """
+    if geometry is None or geometry.geom_type in ("Polygon", "MultiPolygon", "Point"):
+        return geometry
+    polygons = [part for part in shapely.get_parts(geometry) if part.geom_type == "Polygon"]
+    return shapely.MultiPolygon(polygons) if polygons else None
+
+
+def build_topology(
+    gdf: gpd.GeoDataFrame, quantization: int = 10**6, name: str = "contours"
+) -> Dict:
+    """
+    Build the topology of a set of contours: the rings of the polygons are cut where three or more rings meet (junctions), and the
+    resulting arcs are stored once, whatever the number of polygons they border
+
+    Args:
+        gdf (gpd.GeoDataFrame): Polygon, MultiPolygon or Point geometries, and their attributes
+        quantization (int, optional): number of distinct values of each coordinate (1e6 over a département is below the meter). Defaults to 10**6.
+        name (str, optional): name of the object in the topology. Defaults to "contours".
+
+    Returns:
+        Dict: a TopoJSON topology
+    """
+    geometries = np.array([_polygonal(g) for g in gdf.geometry], dtype=object)
+    valid = np.array([g is not None and not g.is_empty for g in geometries], dtype=bool)
+    x0, y0, x1, y1 = shapely.total_bounds(geometries[valid]) if valid.any() else (0, 0, 1, 1)
+    scale = [max(x1 - x0, 1e-12) / (quantization - 1), max(y1 - y0, 1e-12) / (quantization - 1)]
+
+    # every vertex of every ring, quantized; the closing vertex of each ring is dropped
+    polygon_mask = np.array([valid[k] and g.geom_type != "Point" for k, g in enumerate(geometries)], dtype=bool)
+    parts, part_geom = shapely.get_parts(geometries[polygon_mask], return_index=True)
+    part_geom = np.flatnonzero(polygon_mask)[part_geom]
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    qx = np.round((coords[:, 0] - x0) / scale[0]).astype(np.int64)
+    qy = np.round((coords[:, 1] - y0) / scale[1]).astype(np.int64)
+    keys = qx * quantization + qy
+    # drop consecutive duplicates (including the closing vertex) created by the quantization
+    keep = np.ones(len(keys), dtype=bool)
+    same_ring = coord_ring[1:] == coord_ring[:-1]
+    keep[1:] = ~(same_ring & (keys[1:] == keys[:-1]))
+    ring_start = np.flatnonzero(np.r_[True, ~same_ring])
+    ring_end = np.r_[ring_start[1:], len(keys)]
+    for start, end in zip(ring_start, ring_end):
+        # the last vertex of a ring closes it, unless it was already dropped as a consecutive duplicate
+        kept = np.flatnonzero(keep[start:end]) + start
+        if len(kept) > 1 and keys[kept[-1]] == keys[start]:
+            keep[kept[-1]] = False
+    keys, coord_ring = keys[keep], coord_ring[keep]
+
+    # rings with less than 3 distinct vertices are degenerated
+    ring_sizes = np.bincount(coord_ring, minlength=len(rings))
+    ring_start = np.r_[0, np.cumsum(ring_sizes)[:-1]]
+    position = np.arange(len(keys)) - ring_start[coord_ring]
+    size = ring_sizes[coord_ring]
+    next_key = keys[ring_start[coord_ring] + (position + 1) % np.maximum(size, 1)]
+    previous_key = keys[ring_start[coord_ring] + (position - 1) % np.maximum(size, 1)]
+
+    # junctions: vertices with more than two distinct neighbours among all the rings they belong to
+    neighbours = pd.DataFrame(
+        {"key": np.r_[keys, keys], "neighbour": np.r_[next_key, previous_key]}
+    ).drop_duplicates()
+    n_neighbours = neighbours.groupby("key").size()
+    junction_keys = n_neighbours.index[n_neighbours.to_numpy() > 2].to_numpy()
+    is_junction = np.isin(keys, junction_keys)
+
+    arcs: List[np.ndarray] = []
+    arc_index: Dict[bytes, int] = {}
+
+    def add_arc(arc_keys: np.ndarray, closed: bool) -> int:
+        """
+        Return the reference of an arc (~index when it is stored in the reverse direction), storing it if it is new
+        """
+        forward = arc_keys.tobytes()
+        if forward in arc_index:
+            return arc_index[forward]
+        backward = arc_keys[::-1]
+        if closed:
+            # a ring without junction may be stored with another starting vertex: rotate it to its smallest vertex
+            backward = np.roll(backward[:-1], -int(np.argmin(backward[:-1])))
+            backward = np.r_[backward, backward[:1]]
+        backward = backward.tobytes()
+        if backward in arc_index:
+            return ~arc_index[backward]
+        arc_index[forward] = len(arcs)
+        arcs.append(arc_keys)
+        return len(arcs) - 1
+
+    ring_arcs = []
+    for r in range(len(rings)):
+        start, n = ring_start[r], ring_sizes[r]
+        if n < 3:
+            ring_arcs.append(None)
+            continue
+        ring_keys = keys[start:start + n]
+        cuts = np.flatnonzero(is_junction[start:start + n])
+        if len(cuts) == 0:
+            rotated = np.roll(ring_keys, -int(np.argmin(ring_keys)))
+            ring_arcs.append([add_arc(np.r_[rotated, rotated[:1]], closed=True)])
+            continue
+        rotated = np.roll(ring_keys, -int(cuts[0]))
+        rotated = np.r_[rotated, rotated[:1]]
+        bounds = np.r_[cuts - cuts[0], n]
+        ring_arcs.append(
+            [add_arc(rotated[a:b + 1], closed=False) for a, b in zip(bounds[:-1], bounds[1:])]
+        )
+
+    # geometries referencing the arcs
+    polygons_of_geom: Dict[int, List] = {}
+    rings_of_part: Dict[int, List] = {}
+    exterior = np.r_[True, ring_part[1:] != ring_part[:-1]]
+    for r, part in enumerate(ring_part):
+        if exterior[r]:
+            # degenerated exterior ring: the polygon is dropped (its holes too)
+            rings_of_part[part] = None if ring_arcs[r] is None else [ring_arcs[r]]
+        elif rings_of_part[part] is not None and ring_arcs[r] is not None:
+            rings_of_part[part].append(ring_arcs[r])
+    for part, geom in enumerate(part_geom):
+        if rings_of_part.get(part):
+            polygons_of_geom.setdefault(geom, []).append(rings_of_part[part])
+
+    properties = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    records = json.loads(properties.to_json(orient="records")) if len(properties.columns) else [{}] * len(gdf)
+    objects = []
+    for k, geometry in enumerate(geometries):
+        if valid[k] and geometry.geom_type == "Point":
+            topo_geometry = {
+                "type": "Point",
+                "coordinates": [
+                    int(round((geometry.x - x0) / scale[0])),
+                    int(round((geometry.y - y0) / scale[1])),
+                ],
+            }
+        elif k in polygons_of_geom:
+            polygons = polygons_of_geom[k]
+            if len(polygons) == 1:
+                topo_geometry = {"type": "Polygon", "arcs": polygons[0]}
+            else:
+                topo_geometry = {"type": "MultiPolygon", "arcs": polygons}
+        else:
+            topo_geometry = {"type": None}
+        topo_geometry["properties"] = records[k]
+        objects.append(topo_geometry)
+
+    return {
+        "type": "Topology",
+        "transform": {"scale": scale, "translate": [x0, y0]},
+        "objects": {name: {"type": "GeometryCollection", "geometries": objects}},
+        # the key of a vertex encodes its quantized coordinates
+        "arcs": [_encode_arc(np.column_stack([arc // quantization, arc % quantization])) for arc in arcs],
+    }
+
+
+def _encode_arc(points: np.ndarray) -> List[List[int]]:
+    """
+    Delta-encode the quantized coordinates of an arc
+    """
+    return np.diff(points, axis=0, prepend=[[0, 0]]).tolist()
+
+
+def _decode_arcs(topology: Dict) -> List[np.ndarray]:
+    """
+    Quantized (integer) coordinates of the arcs of a topology
+    """
+    return [np.cumsum(np.array(arc, dtype=np.int64).reshape(-1, 2), axis=0) for arc in topology["arcs"]]
+
+
+def simplify_topology(topology: Dict, tolerance: float) -> Dict:
+    """
+    Simplify every arc once (Douglas-Peucker, the ends of the arcs being kept), so that neighbouring polygons keep the same border
+
+    Args:
+        topology (Dict): a topology built by `build_topology`
+        tolerance (float): in the units of the contours (degrees for longitude/latitude)
+
+    Returns:
+        Dict: a new topology, with simplified arcs
+    """
+    scale = topology["transform"]["scale"]
+    arcs = _decode_arcs(topology)
+    # simplification in quantized units, with the same tolerance along both axes
+    factor = np.array([1.0, scale[1] / scale[0]])
+    if not arcs:
+        return {**topology, "arcs": []}
+    lines = shapely.linestrings(
+        np.concatenate(arcs) * factor, indices=np.repeat(np.arange(len(arcs)), [len(arc) for arc in arcs])
+    )
+    simplified = shapely.simplify(lines, tolerance / scale[0], preserve_topology=False)
+    new_arcs = []
+    for arc, line in zip(arcs, simplified):
+        points = np.round(shapely.get_coordinates(line) / factor).astype(np.int64)
+        closed = (arc[0] == arc[-1]).all()
+        # a closed arc (ring without junction) must keep at least 3 distinct vertices
+        if closed and len(points) < 4:
+            points = arc
+        new_arcs.append(_encode_arc(points))
+    return {**topology, "arcs": new_arcs}
+
+
+def topology_to_geodataframe(topology: Dict, name: str = None) -> gpd.GeoDataFrame:
+    """
+    Rebuild the contours (GeoDataFrame with one row per geometry of the object `name`) from a topology
+
+    Args:
+        topology (Dict):
+        name (str, optional): the object to rebuild. Defaults to None (the first object of the topology).
+
+    Returns:
+        gpd.GeoDataFrame:
+    """
+    scale = np.array(topology["transform"]["scale"])
+    translate = np.array(topology["transform"]["translate"])
+    arcs = _decode_arcs(topology)
+    name = name or next(iter(topology["objects"]))
+
+    def ring(refs: List[int]) -> np.ndarray:
+        points = []
+        for k, ref in enumerate(refs):
+            arc = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+            points.append(arc if k == 0 else arc[1:])
+        return np.concatenate(points) * scale + translate
+
+    def polygon(rings: List[List[int]]):
+        coords = [ring(refs) for refs in rings]
+        # rings collapsed by the simplification are dropped
+        coords = [c for c in coords if len(np.unique(c, axis=0)) >= 3]
+        if not coords:
+            return None
+        return shapely.Polygon(coords[0], coords[1:])
+
+    geometries, records = [], []
+    for geometry in topology["objects"][name]["geometries"]:
+        records.append(geometry.get("properties", {}))
+        if geometry["type"] == "Polygon":
+            geometries.append(polygon(geometry["arcs"]))
+        elif geometry["type"] == "MultiPolygon":
+            polygons = [p for p in (polygon(rings) for rings in geometry["arcs"]) if p is not None]
+            geometries.append(shapely.MultiPolygon(polygons) if polygons else None)
+        elif geometry["type"] == "Point":
+            geometries.append(shapely.Point(np.array(geometry["coordinates"]) * scale + translate))
+        else:
+            geometries.append(None)
+    return gpd.GeoDataFrame(pd.DataFrame.from_records(records, index=range(len(records))), geometry=geometries)
+
+
+def tolerance_for_zoom(zoom: float, pixels: float = 1) -> float:
+    """
+    Size in degrees of `pixels` screen pixels at a zoom level of the web maps (tiles of 256 pixels covering 360 degrees at zoom 0)
+    """
+    return pixels * 360 / (256 * 2**zoom)
+
+
+def simplification_levels(
+    gdf: gpd.GeoDataFrame, zooms: List[int], pixels: float = 1, quantization: int = 10**6
+) -> Dict[int, gpd.GeoDataFrame]:
+    """
+    Precompute simplified versions of polygons for several zoom levels, from a single topology: the borders shared by neighbouring polygons
+    are simplified once per level, so that the polygons stay glued together at every level
+
+    Args:
+        gdf (gpd.GeoDataFrame): polygons in longitude/latitude (e.g. communes or contours of bureaux)
+        zooms (List[int]): the zoom levels
+        pixels (float, optional): the tolerance of the simplification, in screen pixels at each zoom level. Defaults to 1.
+        quantization (int, optional): see `build_topology`. Defaults to 10**6.
+
+    Returns:
+        Dict[int, gpd.GeoDataFrame]: for each zoom level, `gdf` with simplified geometries, without the polygons vanishing at this level
+        (smaller than the tolerance: restoring their original geometry would break the borders shared with their simplified neighbours)
+    """
+    original = gdf.geometry.to_numpy()
+    topology = build_topology(gpd.GeoDataFrame(geometry=original), quantization=quantization)
+    levels = {}
+    for zoom in zooms:
+        simplified = topology_to_geodataframe(simplify_topology(topology, tolerance_for_zoom(zoom, pixels))).geometry.to_numpy()
+        kept = ~(shapely.is_missing(simplified) | shapely.is_empty(simplified))
+        levels[zoom] = gdf[kept].set_geometry(gpd.GeoSeries(simplified[kept], index=gdf.index[kept], crs=gdf.crs))
+    return levels